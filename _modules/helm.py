@@ -1,16 +1,69 @@
+import base64
+import contextlib
+import copy
+import errno
+import hashlib
+import json
 import logging
+import os
+import random
 import re
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
 
+from multiprocessing.pool import ThreadPool
 from salt.serializers import yaml
 from salt.exceptions import CommandExecutionError
+from yaml import load as _load_yaml
+
+try:
+  from yaml import CSafeLoader as _IndexLoader
+except ImportError:
+  from yaml import SafeLoader as _IndexLoader
+
+try:
+  import contextvars
+except ImportError:
+  contextvars = None
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+try:
+  from urllib.request import Request, urlopen
+  from urllib.error import HTTPError
+except ImportError:
+  from urllib2 import Request, urlopen, HTTPError
 
 LOG = logging.getLogger(__name__)
 
+_LOCAL = threading.local()
+
 class HelmExecutionError(CommandExecutionError):
   def __init__(self, cmd, error):
     self.cmd = cmd
     self.error = error
 
+def in_context(fn):
+  '''
+  Bind the supplied function to a copy of the current context so that the
+  Salt loader globals (`__salt__` and friends) resolve inside worker threads.
+  The helm states use this through `__salt__['helm.in_context']` for the
+  releases and clusters they manage concurrently; it is not useful from the
+  command line.
+  '''
+  if contextvars is None:
+    return fn
+  # captured here, in the calling thread: a worker's own context is empty
+  context = contextvars.copy_context()
+  return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
 def _helm_cmd(*args, **kwargs):
     if kwargs.get('tiller_host'):
         addtl_args = ('--host', kwargs['tiller_host'])
@@ -33,49 +86,672 @@ def _helm_cmd(*args, **kwargs):
         'env': env,
     }
 
+def _run_salt(cmd):
+  return __salt__['cmd.run_all'](**cmd)
+
+def _subprocess_env(env):
+  '''
+  Get the environment for a directly spawned helm process; the minion's
+  environment is only copied once per run and reused for every call with the
+  same additional variables.
+  '''
+  key = 'helm.subprocess_env:%s' % sorted(env.items())
+  if key not in __context__:
+    full_env = os.environ.copy()
+    full_env.update(env)
+    __context__[key] = full_env
+  return __context__[key]
+
+def _run_subprocess(cmd):
+  try:
+    proc = subprocess.Popen(list(cmd['cmd']), env=_subprocess_env(cmd['env']),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = proc.communicate()
+  except OSError as e:
+    return {'retcode': 127, 'stdout': '', 'stderr': '%s' % e}
+  return {
+    'retcode': proc.returncode,
+    'stdout': stdout.decode('utf-8', 'replace').rstrip(),
+    'stderr': stderr.decode('utf-8', 'replace').rstrip(),
+  }
+
+_RUNNERS = {
+  'salt': _run_salt,
+  'subprocess': _run_subprocess,
+}
+
+def _setting(setting, default=None, **kwargs):
+  '''
+  Get a module setting: the keyword argument of the same name if supplied,
+  otherwise the `helm:client:<setting>` minion config or pillar value, which
+  is only looked up once per run.
+  '''
+  if kwargs.get(setting) is not None:
+    return kwargs[setting]
+  key = 'helm.setting:%s' % setting
+  if key not in __context__:
+    __context__[key] = __salt__['config.get']('helm:client:%s' % setting, 
+                                              default)
+  return __context__[key]
+
+def _runner(**kwargs):
+  '''
+  Get the name of the runner used to execute helm commands: the `runner`
+  keyword argument if supplied, otherwise the `helm:client:runner` minion
+  config or pillar value, defaulting to Salt's cmd module.
+  '''
+  return _setting('runner', 'salt', **kwargs)
+
+def _backend(**kwargs):
+  '''
+  Get the backend used to query releases: `grpc` to talk to Tiller directly
+  through the tiller execution module, or `cli` to run the helm binary. The 
+  `backend` keyword argument takes precedence over the `helm:client:backend`
+  minion config or pillar value. The gRPC backend is only used when Tiller's
+  address is known and the tiller module is available.
+  '''
+  if _setting('backend', 'cli', **kwargs) == 'grpc':
+    if kwargs.get('tiller_host') and 'tiller.get_release' in __salt__:
+      return 'grpc'
+    LOG.debug("gRPC backend requires tiller_host and the tiller module, "
+              "falling back to the helm CLI")
+  return 'cli'
+
+_SUBCOMMANDS = ('get', 'repo', 'dependency')
+
+def _command_label(cmd):
+  binary = os.path.basename(cmd['cmd'][0])
+  prefix = '' if binary == 'helm' else binary + ' '
+  args = [arg for arg in cmd['cmd'][1:3] if not arg.startswith('-')]
+  if len(args) > 1 and args[0] in _SUBCOMMANDS and args[1] in (
+      'values', 'manifest', 'hooks', 'notes', 'add', 'remove', 'list', 
+      'update', 'build'):
+    return prefix + ' '.join(args)
+  return prefix + (args[0] if args else '')
+
+def _record(cmd, result, runner):
+  '''
+  Record the metrics of a helm command in this run's stats, remembering the
+  entry so that the time spent parsing the command's output in this thread 
+  can be added to it.
+  '''
+  metrics = {
+    'command': _command_label(cmd),
+    'cmd': ' '.join(cmd['cmd']),
+    'runner': runner,
+    'retcode': result['retcode'],
+    'duration': result['duration'],
+    'stdout_bytes': result.get('stdout_bytes', len(result['stdout'] or '')),
+    'stderr_bytes': len(result['stderr'] or ''),
+    'parse_time': 0.0,
+  }
+  __context__.setdefault('helm.stats', []).append(metrics)
+  _LOCAL.metrics = metrics
+
+def _timed_parse(parse, *args):
+  '''
+  Call the supplied parser, adding the time it takes to the metrics of the 
+  last helm command run in this thread.
+  '''
+  start = time.time()
+  try:
+    return parse(*args)
+  finally:
+    metrics = getattr(_LOCAL, 'metrics', None)
+    if metrics is not None:
+      metrics['parse_time'] += time.time() - start
+
+#
+# helm commands that read the repositories and chart indexes of the helm home;
+# installs and upgrades are given a fetched chart archive instead (see
+# `_chart_ref`) so that they don't hold the lock while waiting for releases
+#
+_REPOSITORY_COMMANDS = ('fetch', 'dependency', 'search', 'repo')
+
+def _reads_repositories(cmd):
+  args = cmd['cmd']
+  return (len(args) > 1 and args[0] == 'helm' and 
+          args[1] in _REPOSITORY_COMMANDS)
+
+@contextlib.contextmanager
+def _home_lock(exclusive=False, **kwargs):
+  '''
+  Hold an advisory lock on the repositories of the helm home (shared by any
+  helm home linked to it by `prepare_home`) for the duration of a block: an
+  exclusive lock while they are modified and a shared lock while they are 
+  read, so that concurrent Salt jobs never see a partially written 
+  repositories.yaml or index. Locks are reentrant within a thread, and an 
+  exclusive lock covers shared use. Waiting for the lock is given up after
+  `helm:client:home_lock_timeout` seconds (default 300). The lock file lives
+  in the home's `repository` directory, which is created if need be.
+  '''
+  if fcntl is None:
+    yield
+    return
+
+  directory = os.path.join(_helm_home(**kwargs), 'repository')
+  try:
+    os.makedirs(directory)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+
+  path = os.path.realpath(os.path.join(directory, '.salt.lock'))
+  held = _LOCAL.__dict__.setdefault('home_locks', {})
+  if path in held:
+    if exclusive and not held[path]:
+      raise CommandExecutionError('Unable to lock %s exclusively while '
+                                  'holding a shared lock on it' % path)
+    yield
+    return
+
+  timeout = float(_setting('home_lock_timeout', 300, **kwargs))
+  deadline = time.time() + timeout
+  delay = 0.05
+  with open(path, 'a') as lock_stream:
+    while True:
+      try:
+        fcntl.flock(lock_stream.fileno(), 
+                    (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | 
+                    fcntl.LOCK_NB)
+        break
+      except (IOError, OSError) as e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+          raise
+        if time.time() >= deadline:
+          raise CommandExecutionError('Timed out after %ss waiting for the '
+                                      'lock on %s' % (timeout, path))
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+    held[path] = exclusive
+    try:
+      yield
+    finally:
+      del held[path]
+      fcntl.flock(lock_stream.fileno(), fcntl.LOCK_UN)
+
+def _run(cmd, **kwargs):
+  runner = _runner(**kwargs)
+  if runner not in _RUNNERS:
+    raise CommandExecutionError('Unknown helm runner "%s", expected one of: '
+                                '%s' % (runner, ', '.join(sorted(_RUNNERS))))
+  if _reads_repositories(cmd):
+    with _home_lock(**kwargs):
+      start = time.time()
+      result = _RUNNERS[runner](cmd)
+  else:
+    start = time.time()
+    result = _RUNNERS[runner](cmd)
+  result['duration'] = time.time() - start
+  LOG.debug("%s finished in %.3fs using the %s runner" % (
+    " ".join(cmd['cmd']), result['duration'], runner))
+  _record(cmd, result, runner)
+  return result
+
+def _streaming(**kwargs):
+  '''
+  Whether commands with potentially large output should be streamed (see 
+  `_stream`), as configured by the `stream_output` keyword argument or the 
+  `helm:client:stream_output` minion config or pillar value.
+  '''
+  return bool(_setting('stream_output', False, **kwargs))
+
+def _stream(cmd, consume, **kwargs):
+  '''
+  Run a helm command directly, passing an iterator over the lines of its 
+  output to the supplied consumer as helm writes them rather than buffering
+  the whole output in memory. Any output the consumer doesn't read is 
+  discarded. Returns the usual retcode, stderr and duration along with the
+  consumer's return value as `result`; `stdout` is always empty.
+  '''
+  if _reads_repositories(cmd):
+    with _home_lock(**kwargs):
+      return _stream_unlocked(cmd, consume, **kwargs)
+  return _stream_unlocked(cmd, consume, **kwargs)
+
+def _stream_unlocked(cmd, consume, **kwargs):
+  start = time.time()
+  stderr = tempfile.TemporaryFile()
+  counted = {'bytes': 0}
+  consume_time = 0.0
+  try:
+    try:
+      proc = subprocess.Popen(list(cmd['cmd']), 
+                              env=_subprocess_env(cmd['env']),
+                              stdout=subprocess.PIPE, stderr=stderr)
+    except OSError as e:
+      result = {'retcode': 127, 'stdout': '', 'stderr': '%s' % e, 
+                'result': None}
+    else:
+      def lines():
+        for line in iter(proc.stdout.readline, b''):
+          counted['bytes'] += len(line)
+          yield line.decode('utf-8', 'replace')
+
+      consume_start = time.time()
+      try:
+        consumed = consume(lines())
+      finally:
+        consume_time = time.time() - consume_start
+        for chunk in iter(lambda: proc.stdout.read(65536), b''):
+          counted['bytes'] += len(chunk)
+        proc.stdout.close()
+        proc.wait()
+      stderr.seek(0)
+      result = {
+        'retcode': proc.returncode,
+        'stdout': '',
+        'stderr': stderr.read().decode('utf-8', 'replace').rstrip(),
+        'result': consumed,
+      }
+  finally:
+    stderr.close()
+
+  result['duration'] = time.time() - start
+  result['stdout_bytes'] = counted['bytes']
+  LOG.debug("%s streamed %s bytes in %.3fs" % (
+    " ".join(cmd['cmd']), counted['bytes'], result['duration']))
+  _record(cmd, result, 'stream')
+  _LOCAL.metrics['parse_time'] = consume_time
+  return result
+
+def _cmd_string(cmd):
+  env_string = "".join(['%s="%s" ' % (k, v) for (k, v) in cmd.get('env', {}).items()])
+  return env_string + " ".join(cmd['cmd'])
+
+def _cmd_and_stream(consume, *args, **kwargs):
+  '''
+  Run a helm command as `_cmd_and_result` does, but stream its output to the
+  supplied consumer (see `_stream`), returning the consumer's return value as
+  `result`.
+  '''
+  cmd = _helm_cmd(*args, **kwargs)
+  cmd_string = _cmd_string(cmd)
+  result = _stream(cmd, consume, **kwargs)
+  if result['retcode'] != 0:
+    raise HelmExecutionError(cmd_string, 
+                             CommandExecutionError(result['stderr']))
+  return {
+    'cmd': cmd_string,
+    'stdout': '',
+    'stderr': result['stderr'],
+    'duration': result['duration'],
+    'result': result['result'],
+  }
+
 def _cmd_and_result(*args, **kwargs):
   cmd = _helm_cmd(*args, **kwargs)
-  env_string = "".join(['%s="%s" ' % (k, v) for (k, v) in cmd.get('env', {}).items()])
-  cmd_string = env_string + " ".join(cmd['cmd'])
+  cmd_string = _cmd_string(cmd)
   result = None
   try:
-    result = __salt__['cmd.run_all'](**cmd)
+    result = _run(cmd, **kwargs)
     if result['retcode'] != 0:
       raise CommandExecutionError(result['stderr'])
     return {
       'cmd': cmd_string,
       'stdout': result['stdout'],
-      'stderr': result['stderr']
+      'stderr': result['stderr'],
+      'duration': result['duration'],
     }
   except CommandExecutionError as e:
     raise HelmExecutionError(cmd_string, e)
 
 
-def _parse_release(output):
+def _context_key(prefix, **kwargs):
+  '''
+  Build a `__context__` key scoped to the Tiller installation, kubeconfig and
+  helm home that a call is made against, so cached data is never shared 
+  between clusters.
+  '''
+  scope = [kwargs.get(key) or '' for key in
+           ('tiller_host', 'tiller_namespace', 'kube_config', 'helm_home')]
+  return '%s:%s' % (prefix, ':'.join(scope))
+
+def _invalidate_release(name, **kwargs):
+  __context__.pop(_context_key('helm.releases', **kwargs), None)
+  __context__.get(_context_key('helm.release', **kwargs), {}).pop(name, None)
+  try:
+    os.remove(_release_cache_file(name, **kwargs))
+  except OSError:
+    pass
+
+def _release_cache_size(**kwargs):
+  return int(_setting('release_cache_size', 512, **kwargs) or 0)
+
+def _release_cache_dir(**kwargs):
+  scope = hashlib.sha1(_context_key('', **kwargs).encode('utf-8')).hexdigest()
+  return os.path.join(_helm_home(**kwargs), 'cache', 'salt', 'releases', scope)
+
+def _release_cache_file(name, **kwargs):
+  return os.path.join(_release_cache_dir(**kwargs), '%s.json' % name)
+
+def _read_cached_release(name, summary, **kwargs):
+  '''
+  Read the release content stored on disk by an earlier run, provided it was
+  stored for the revision and deployment time in the supplied summary from
+  the release listing; returns an empty dict otherwise.
+  '''
+  if not _release_cache_size(**kwargs):
+    return {}
+  path = _release_cache_file(name, **kwargs)
+  try:
+    with open(path) as stream:
+      cached = json.load(stream)
+  except (IOError, OSError, ValueError):
+    return {}
+  if (cached.get('revision') != summary['revision'] or 
+      cached.get('updated') != summary.get('updated')):
+    return {}
+  try:
+    os.utime(path, None)
+  except OSError:
+    pass
+  return cached.get('fields') or {}
+
+def _write_cached_release(name, summary, release, **kwargs):
+  '''
+  Store the content fields of a release on disk for later runs, then evict
+  the least recently used releases beyond the `release_cache_size` limit.
+  '''
+  limit = _release_cache_size(**kwargs)
+  fields = dict((key, value) for (key, value) in release.items()
+                if key in _CONTENT_FIELDS)
+  if not limit or not fields:
+    return
+
+  directory = _release_cache_dir(**kwargs)
+  record = {
+    'name': name,
+    'revision': summary['revision'],
+    'updated': summary.get('updated'),
+    'fields': fields,
+  }
+  # the values of a release may well hold secrets
+  try:
+    if not os.path.isdir(directory):
+      os.makedirs(directory, 0o700)
+    _write_atomic(_release_cache_file(name, **kwargs),
+                  json.dumps(record, default=str).encode('utf-8'),
+                  mode=0o600)
+  except (IOError, OSError) as e:
+    LOG.warning('Unable to cache release %s on disk: %s', name, e)
+    return
+  _evict_oldest(directory, limit, '.json')
+
+def _evict_oldest(directory, limit, suffix):
+  '''
+  Remove the least recently modified files with the supplied suffix from a
+  directory, keeping at most `limit` of them.
+  '''
+  entries = []
+  for filename in os.listdir(directory):
+    if not filename.endswith(suffix):
+      continue
+    path = os.path.join(directory, filename)
+    try:
+      entries.append((os.path.getmtime(path), path))
+    except OSError:
+      continue
+  entries.sort()
+  for (_, path) in entries[:max(len(entries) - limit, 0)]:
+    try:
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      else:
+        os.remove(path)
+    except OSError:
+      pass
+
+
+def _spool_output(result, label, **kwargs):
+  '''
+  Move the stdout of a command beyond the `helm:client:max_output` number of
+  characters (default 65536, 0 for no limit) to a file in the helm home's 
+  `cache/salt/output` directory, keeping only the start of it in the result
+  along with the path of the file as `stdout_file`. The most recent 50 
+  output files are kept.
+  '''
+  limit = int(_setting('max_output', 65536, **kwargs) or 0)
+  stdout = result.get('stdout') or ''
+  if not limit or len(stdout) <= limit:
+    return result
+
+  directory = os.path.join(_helm_home(**kwargs), 'cache', 'salt', 'output')
+  path = os.path.join(directory, '%s-%d.log' % (label, time.time() * 1000))
+  try:
+    if not os.path.isdir(directory):
+      os.makedirs(directory, 0o700)
+    _write_atomic(path, stdout.encode('utf-8'), mode=0o600)
+    _evict_oldest(directory, 50, '.log')
+    location = '; full output in %s' % path
+  except (IOError, OSError) as e:
+    LOG.warning('Unable to spool output of %s: %s', label, e)
+    path = None
+    location = ''
+  result['stdout'] = '%s\n... (%s more characters%s)' % (
+    stdout[:limit], len(stdout) - limit, location)
+  result['stdout_file'] = path
+  return result
+
+def _parse_chart(chart_string):
+  chart_match = re.search(r'([^0-9]+)-([^\s]+)', chart_string)
+  if not chart_match:
+    return None, None
+  return chart_match.group(1), chart_match.group(2)
+
+def _parse_release_list(output):
+  '''
+  Parse the tabular output of `helm list` into a dict keyed by release name,
+  returning the name of the next release to page from (if any) alongside it.
+  '''
+  releases = {}
+  next_release = None
+  columns = None
+  for line in output.split("\n"):
+    stripped = line.strip()
+    if not stripped:
+      continue
+    # helm 2 prints the paging marker indented, as "\tnext: <name>"
+    if stripped.lower().startswith('next:'):
+      next_release = stripped.split(':', 1)[1].strip()
+      continue
+    fields = [field.strip() for field in line.split("\t")]
+    if columns is None:
+      if fields[0] == 'NAME':
+        columns = dict((column, i) for (i, column) in enumerate(fields))
+      continue
+
+    row = dict((column, fields[i]) for (column, i) in columns.items()
+               if i < len(fields))
+    chart, version = _parse_chart(row.get('CHART', ''))
+    revision = row.get('REVISION')
+    releases[row['NAME']] = {
+      'name': row['NAME'],
+      'revision': int(revision) if revision and revision.isdigit() else None,
+      'status': row.get('STATUS'),
+      'updated': row.get('UPDATED'),
+      'chart': chart,
+      'version': version,
+      'namespace': row.get('NAMESPACE'),
+    }
+  return releases, next_release
+
+def _release_index(**kwargs):
+  '''
+  Return the per-run release index from `list_releases`, or None if Tiller
+  could not be listed so callers can fall back to querying releases one by
+  one.
+  '''
+  try:
+    return list_releases(**kwargs)
+  except CommandExecutionError as e:
+    LOG.debug("unable to list releases, not using release index: %s" % e)
+    return None
+
+_RELEASE_FIELDS = ('REVISION', 'RELEASED', 'CHART', 'NAMESPACE')
+_RELEASE_SECTIONS = ('USER-SUPPLIED VALUES', 'COMPUTED VALUES', 'HOOKS', 
+                     'MANIFEST')
+
+class _ReleaseSections(object):
+  '''
+  The fields and sections of `helm get` output, split in a single pass over
+  its lines. Section headers are only recognized in the order helm prints 
+  them, and the YAML sections are only deserialized when first requested.
+  If `keep` is supplied, only the text of those sections is retained, so 
+  large sections that aren't needed (such as the manifest) can be skipped 
+  while streaming the output.
+  '''
+  def __init__(self, lines, keep=None):
+    self.fields = {}
+    self._sections = {}
+    self._deserialized = {}
+
+    current = None
+    next_sections = list(_RELEASE_SECTIONS)
+    for line in lines:
+      line = line.rstrip('\r\n')
+      if current == 'MANIFEST':
+        if line.startswith('Release "') and ' has been upgraded' in line:
+          break
+        if keep is None or current in keep:
+          self._sections[current].append(line)
+        continue
+
+      if line.endswith(':') and line[:-1] in next_sections:
+        current = line[:-1]
+        next_sections = next_sections[next_sections.index(current) + 1:]
+        self._sections[current] = []
+        continue
+
+      if current is None:
+        key, separator, value = line.partition(': ')
+        if separator and key in _RELEASE_FIELDS:
+          self.fields.setdefault(key, value)
+        continue
+
+      if keep is None or current in keep:
+        self._sections[current].append(line)
+
+  def __contains__(self, section):
+    return section in self._sections
+
+  def text(self, section):
+    '''
+    Get the raw text of the supplied section, or None if the section was not
+    in the output or is blank.
+    '''
+    text = '\n'.join(self._sections.get(section, [])).strip('\n')
+    return text or None
+
+  def deserialize(self, section):
+    if section not in self._deserialized:
+      text = self.text(section)
+      self._deserialized[section] = (yaml.deserialize(text) 
+                                     if text is not None else None)
+    return self._deserialized[section]
+
+_SUMMARY_FIELDS = ('chart', 'version', 'namespace', 'revision', 'status')
+_CONTENT_FIELDS = ('values', 'computed_values', 'manifest')
+
+def _release_fields(fields=None):
+  if fields is None:
+    return _SUMMARY_FIELDS + _CONTENT_FIELDS
+  if not isinstance(fields, (list, tuple)):
+    fields = [field.strip() for field in fields.split(',')]
+  unknown = [field for field in fields 
+             if field not in _SUMMARY_FIELDS + _CONTENT_FIELDS]
+  if unknown:
+    raise CommandExecutionError('Unknown release fields requested: %s' % 
+                                ', '.join(unknown))
+  return tuple(fields)
+
+_FIELD_SECTIONS = {
+  'values': 'USER-SUPPLIED VALUES',
+  'computed_values': 'COMPUTED VALUES',
+  'manifest': 'MANIFEST',
+}
+
+def _parse_release(output, fields=None):
+  '''
+  Parse the output of `helm get`, supplied as a string or any iterable of 
+  lines (such as a stream), keeping only the sections the requested fields 
+  need.
+  '''
+  if isinstance(output, (str, type(u''))):
+    output = output.split('\n')
+  fields = _release_fields(fields)
+  sections = _ReleaseSections(output, keep=[
+    _FIELD_SECTIONS[field] for field in fields if field in _FIELD_SECTIONS])
+
   result = {}
-  chart_match = re.search(r'CHART\: ([^0-9]+)-([^\s]+)', output)
-  if chart_match:
-    result['chart'] = chart_match.group(1)
-    result['version'] = chart_match.group(2)
-  
-  user_values_match = re.search(r"(?<=USER-SUPPLIED VALUES\:\n)(\n*.+)+?(?=\n*COMPUTED VALUES\:)", output, re.MULTILINE)
-  if user_values_match:
-    result['values'] = yaml.deserialize(user_values_match.group(0))
+  chart, version = _parse_chart(sections.fields.get('CHART', ''))
+  if chart:
+    result['chart'] = chart
+    result['version'] = version
+
+  if sections.fields.get('REVISION', '').isdigit():
+    result['revision'] = int(sections.fields['REVISION'])
 
-  computed_values_match = re.search(r"(?<=COMPUTED VALUES\:\n)(\n*.+)+?(?=\n*HOOKS\:)", output, re.MULTILINE)
-  if computed_values_match:
-    result['computed_values'] = yaml.deserialize(computed_values_match.group(0))
+  if 'values' in fields:
+    result['values'] = sections.deserialize('USER-SUPPLIED VALUES')
 
-  manifest_match = re.search(r"(?<=MANIFEST\:\n)(\n*(?!Release \".+\" has been upgraded).*)+", output, re.MULTILINE)
-  if manifest_match:
-    result['manifest'] = manifest_match.group(0)
+  if 'computed_values' in fields:
+    result['computed_values'] = sections.deserialize('COMPUTED VALUES')
 
-  namespace_match = re.search(r"(?<=NAMESPACE\: )(.*)", output)
-  if namespace_match:
-    result['namespace'] = namespace_match.group(0)
+  if 'manifest' in fields and 'MANIFEST' in sections:
+    result['manifest'] = sections.text('MANIFEST') or ''
+
+  if 'NAMESPACE' in sections.fields:
+    result['namespace'] = sections.fields['NAMESPACE']
 
   return result
 
+def _resource_key(resource):
+  metadata = resource.get('metadata') or {}
+  return ':'.join(['%s' % (part or '') for part in (
+    resource.get('apiVersion'), resource.get('kind'),
+    metadata.get('namespace'), metadata.get('name'))])
+
+def _manifest_index(manifest):
+  '''
+  Split a multi-document manifest into an index of its resources, keyed by
+  `apiVersion:kind:namespace:name`, with a hash of each resource's canonical
+  form as the value so that resources can be compared without comparing 
+  their content.
+  '''
+  index = {}
+  for document in _manifest_documents(manifest):
+    if not document.strip():
+      continue
+    resource = yaml.deserialize(document)
+    if not isinstance(resource, dict):
+      continue
+    canonical = json.dumps(resource, sort_keys=True, separators=(',', ':'),
+                           default=str)
+    index[_resource_key(resource)] = hashlib.sha256(
+      canonical.encode('utf-8')).hexdigest()
+  return index
+
+def _manifest_documents(manifest):
+  '''
+  Yield the documents of a manifest supplied as a string, or as an iterable
+  of lines so that only one document is held in memory at a time.
+  '''
+  if manifest is None or isinstance(manifest, (str, type(u''))):
+    for document in re.split(r'^---\s*$', manifest or '', flags=re.MULTILINE):
+      yield document
+    return
+
+  document = []
+  for line in manifest:
+    if line.rstrip() == '---':
+      yield ''.join(document)
+      document = []
+    else:
+      document.append(line)
+  yield ''.join(document)
+
 def _parse_repo(repo_string = None):
   split_string = repo_string.split('\t')
   return {
@@ -86,7 +762,7 @@ def _parse_repo(repo_string = None):
 
 def _get_release_namespace(name, tiller_namespace="kube-system", **kwargs):
   cmd = _helm_cmd("list", name, **kwargs)
-  result = __salt__['cmd.run_stdout'](**cmd)
+  result = _run(cmd, **kwargs)['stdout']
   if not result or len(result.split("\n")) < 2:
     return None
 
@@ -101,7 +777,7 @@ def list_repos(**kwargs):
     * url: the url registered for the repository
   '''
   cmd = _helm_cmd('repo', 'list', **kwargs)
-  result = __salt__['cmd.run_stdout'](**cmd)
+  result = _run(cmd, **kwargs)['stdout']
   if result is None:
     return result
 
@@ -123,7 +799,8 @@ def add_repo(name, url, **kwargs):
   url
       The url for the chart repository.
   '''
-  return _cmd_and_result('repo', 'add', name, url, **kwargs)
+  with _home_lock(exclusive=True, **kwargs):
+    return _cmd_and_result('repo', 'add', name, url, **kwargs)
 
 def remove_repo(name, **kwargs):
   '''
@@ -133,9 +810,242 @@ def remove_repo(name, **kwargs):
   name
       The name (as registered with the Helm client) for the repository to remove
   '''
-  return _cmd_and_result('repo', 'remove', name, **kwargs)
+  with _home_lock(exclusive=True, **kwargs):
+    return _cmd_and_result('repo', 'remove', name, **kwargs)
+
+def _helm_home(**kwargs):
+  return (kwargs.get('helm_home') or os.environ.get('HELM_HOME') or
+          os.path.expanduser('~/.helm'))
+
+def _repositories_file(**kwargs):
+  return os.path.join(_helm_home(**kwargs), 'repository', 'repositories.yaml')
+
+def _read_repositories(**kwargs):
+  '''
+  Read the repository definitions from the helm home's repositories.yaml
+  '''
+  try:
+    with _home_lock(**kwargs):
+      with open(_repositories_file(**kwargs)) as repositories_stream:
+        repositories = yaml.deserialize(repositories_stream) or {}
+  except (IOError, OSError) as e:
+    raise CommandExecutionError('Unable to read repositories file: %s' % e)
+  return repositories.get('repositories') or []
+
+def _repo_cache_file(repo, **kwargs):
+  cache = repo.get('cache') or '%s-index.yaml' % repo['name']
+  if os.path.isabs(cache):
+    return cache
+  return os.path.join(_helm_home(**kwargs), 'repository', 'cache', cache)
+
+def _write_atomic(path, content, mode=None):
+  '''
+  Replace the file at the supplied path with the supplied content, through a
+  temporary file renamed into place. With a `mode`, the file is created with
+  those permissions instead of the umask's.
+  '''
+  tmp_path = '%s.%s.tmp' % (path, os.getpid())
+  fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+               0o666 if mode is None else mode)
+  if mode is not None:
+    os.fchmod(fd, mode)
+  with os.fdopen(fd, 'wb') as stream:
+    stream.write(content)
+  os.rename(tmp_path, path)
+
+def _check_repo_index(content):
+  '''
+  Make sure a downloaded index is a chart repository index, as helm does
+  before caching one, so that an error page served with a 200 status never
+  replaces a good cached index.
+  '''
+  index = _load_yaml(content, Loader=_IndexLoader)
+  if not isinstance(index, dict) or not index.get('apiVersion'):
+    raise ValueError('not a chart repository index: no API version '
+                     'specified')
+  if not isinstance(index.get('entries') or {}, dict):
+    raise ValueError('not a chart repository index: entries is not a '
+                     'mapping')
+
+def _fetch_repo_index(repo, cache_file, ttl=0, timeout=60):
+  '''
+  Refresh the cached index of the supplied repository, skipping the request
+  if the cache was checked within the last `ttl` seconds and otherwise
+  sending a conditional request with the ETag and Last-Modified values from
+  the previous response. Returns a dict with the repository name, the status
+  (`updated`, `not_modified`, `fresh` or `failed`), the duration in seconds 
+  and any error.
+  '''
+  start = time.time()
+  meta_file = cache_file + '.meta'
+  try:
+    with open(meta_file) as meta_stream:
+      meta = json.load(meta_stream)
+  except (IOError, OSError, ValueError):
+    meta = {}
+  if not os.path.exists(cache_file):
+    meta = {}
+
+  result = {'name': repo['name'], 'status': 'fresh'}
+  if meta.get('checked') and time.time() - meta['checked'] < ttl:
+    result['duration'] = time.time() - start
+    return result
+
+  request = Request(repo['url'].rstrip('/') + '/index.yaml')
+  if meta.get('etag'):
+    request.add_header('If-None-Match', meta['etag'])
+  if meta.get('last_modified'):
+    request.add_header('If-Modified-Since', meta['last_modified'])
+  if repo.get('username'):
+    credentials = '%s:%s' % (repo['username'], repo.get('password', ''))
+    request.add_header('Authorization', 'Basic %s' % 
+      base64.b64encode(credentials.encode('utf-8')).decode('ascii'))
+
+  open_args = {'timeout': timeout}
+  if repo.get('caFile') or repo.get('certFile'):
+    context = ssl.create_default_context(cafile=repo.get('caFile') or None)
+    if repo.get('certFile'):
+      context.load_cert_chain(repo['certFile'], repo.get('keyFile') or None)
+    open_args['context'] = context
+
+  try:
+    response = urlopen(request, **open_args)
+    content = response.read()
+    _check_repo_index(content)
+    if not os.path.isdir(os.path.dirname(cache_file)):
+      os.makedirs(os.path.dirname(cache_file))
+    _write_atomic(cache_file, content)
+    meta = {
+      'etag': response.headers.get('ETag'),
+      'last_modified': response.headers.get('Last-Modified'),
+    }
+    result['status'] = 'updated'
+  except HTTPError as e:
+    if e.code == 304:
+      result['status'] = 'not_modified'
+    else:
+      result['status'] = 'failed'
+      result['error'] = '%s' % e
+  except Exception as e:
+    result['status'] = 'failed'
+    result['error'] = '%s' % e
+
+  if result['status'] != 'failed':
+    meta['checked'] = time.time()
+    try:
+      _write_atomic(meta_file, json.dumps(meta).encode('utf-8'))
+    except (IOError, OSError) as e:
+      LOG.warning("unable to record index metadata for %s: %s" % (
+        repo['name'], e))
+
+  result['duration'] = time.time() - start
+  return result
+
+def _manage_repos_batch(present, absent, exclusive, concurrency=4, **kwargs):
+  repositories_file = _repositories_file(**kwargs)
+  try:
+    with open(repositories_file) as repositories_stream:
+      repositories = yaml.deserialize(repositories_stream) or {}
+  except (IOError, OSError) as e:
+    raise CommandExecutionError('Unable to read repositories file: %s' % e)
+  existing_repos = dict((repo['name'], repo) for repo
+                        in repositories.get('repositories') or [])
+  result = {
+    "already_present": [],
+    "added": [],
+    "already_absent": [],
+    "removed": [],
+    "failed": []
+  }
 
-def manage_repos(present={}, absent=[], exclusive=False, **kwargs):
+  to_add = []
+  for name, url in present.items():
+    if not name or not url:
+      raise CommandExecutionError(('Supplied repo to add must have a name (%s) '
+                                   'and url (%s)' % (name, url)))
+
+    if name in existing_repos and existing_repos[name]['url'] == url:
+      result['already_present'].append({ "name": name, "url": url })
+      continue
+
+    to_add.append({
+      'name': name,
+      'url': url,
+      'cache': os.path.join(_helm_home(**kwargs), 'repository', 'cache',
+                            '%s-index.yaml' % name),
+      'caFile': '',
+      'certFile': '',
+      'keyFile': '',
+    })
+
+  if exclusive:
+    # a copy: neither the caller's dict nor the default may change
+    present = dict(present, stable="exclude")
+    absent = [name for name in existing_repos if not name in present]
+
+  to_remove = []
+  for name in absent:
+    if not name or not isinstance(name, str):
+      raise CommandExecutionError(('Supplied repo name to be absent must be a '
+                                   'string: %s' % name))
+    if name not in existing_repos:
+      result['already_absent'].append(name)
+      continue
+    to_remove.append(name)
+
+  #
+  # only the indexes of newly added repositories need to be fetched, and they
+  # can all be fetched at once
+  #
+  if to_add:
+    for repo in to_add:
+      if os.path.exists(repo['cache'] + '.meta'):
+        os.remove(repo['cache'] + '.meta')
+    pool = ThreadPool(max(1, min(int(concurrency), len(to_add))))
+    try:
+      fetched = pool.map(
+        lambda repo: _fetch_repo_index(repo, repo['cache']), to_add)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    fetched = []
+
+  for repo, fetch_result in zip(to_add, fetched):
+    if fetch_result['status'] == 'failed':
+      result['failed'].append({
+        "type": "addition",
+        "name": repo['name'],
+        'url': repo['url'],
+        'error': fetch_result['error']
+      })
+      continue
+    existing_repos[repo['name']] = repo
+    result['added'].append({
+      'name': repo['name'],
+      'url': repo['url'],
+      'stdout': '"%s" has been added to your repositories' % repo['name']
+    })
+
+  for name in to_remove:
+    cache_file = _repo_cache_file(existing_repos.pop(name), **kwargs)
+    for path in (cache_file, cache_file + '.meta'):
+      if os.path.exists(path):
+        os.remove(path)
+    result['removed'].append({
+      'name': name,
+      'stdout': '"%s" has been removed from your repositories' % name
+    })
+
+  if result['added'] or result['removed']:
+    repositories['repositories'] = [existing_repos[name] for name 
+                                    in sorted(existing_repos)]
+    _write_atomic(repositories_file, yaml.serialize(
+      repositories, default_flow_style=False).encode('utf-8'))
+  return result
+
+def manage_repos(present={}, absent=[], exclusive=False, batch=False, 
+                 **kwargs):
   '''
   Manage the repositories registered with the Helm client's local cache. 
 
@@ -188,7 +1098,20 @@ def manage_repos(present={}, absent=[], exclusive=False, **kwargs):
       parameter will be ignored and only the repositories configured via the 
       `present` parameter will be registered with the Helm client. Defaults to 
       False.
+
+  batch
+      A flag indicating whether to apply all additions and removals with a
+      single rewrite of the helm home's repositories.yaml, fetching the 
+      indexes of the newly added repositories concurrently, instead of running
+      `helm repo add` and `helm repo remove` for each repository. Defaults to
+      False.
   '''
+  with _home_lock(exclusive=True, **kwargs):
+    if batch:
+      return _manage_repos_batch(present, absent, exclusive, **kwargs)
+    return _manage_repos(present, absent, exclusive, **kwargs)
+
+def _manage_repos(present, absent, exclusive, **kwargs):
   existing_repos = list_repos(**kwargs)
   result = {
     "already_present": [],
@@ -198,7 +1121,7 @@ def manage_repos(present={}, absent=[], exclusive=False, **kwargs):
     "failed": []
   }
 
-  for name, url in present.iteritems():
+  for name, url in present.items():
     if not name or not url:
       raise CommandExecutionError(('Supplied repo to add must have a name (%s) '
                                    'and url (%s)' % (name, url)))
@@ -214,7 +1137,7 @@ def manage_repos(present={}, absent=[], exclusive=False, **kwargs):
         'stdout': add_repo(name, url, **kwargs)['stdout']
       })
       existing_repos = {
-        n: u for (n, u) in existing_repos.iteritems() if name != n
+        n: u for (n, u) in existing_repos.items() if name != n
       }
     except CommandExecutionError as e:
       result['failed'].append({ 
@@ -228,9 +1151,9 @@ def manage_repos(present={}, absent=[], exclusive=False, **kwargs):
   # Handle removal of repositories configured to be absent (or not configured
   # to be present if the `exclusive` flag is set)
   #
-  existing_names = [name for (name, url) in existing_repos.iteritems()]
+  existing_names = [name for (name, url) in existing_repos.items()]
   if exclusive:
-    present['stable'] = "exclude"
+    present = dict(present, stable="exclude")
     absent = [name for name in existing_names if not name in present]
   
   for name in absent:
@@ -254,52 +1177,482 @@ def manage_repos(present={}, absent=[], exclusive=False, **kwargs):
 
   return result
 
-def update_repos(**kwargs):
+def prepare_home(helm_home, repository_home=None):
   '''
-  Ensures the local helm repository cache for each repository is up to date. 
-  Proxies the `helm repo update` command.
+  Create a helm home directory (as `helm init --client-only` would) so that
+  separate clusters can be managed from separate helm homes. If 
+  `repository_home` is supplied, the new home's repository directory is 
+  linked to that helm home's, so that the repositories and their cached 
+  indexes are managed once and shared. Returns a dict with the helm home and
+  whether anything was created.
+
+  helm_home
+      The path of the helm home to prepare
+
+  repository_home : None
+      The path of an existing helm home whose repositories to share
   '''
-  return _cmd_and_result('repo', 'update', **kwargs)
+  created = False
+  for directory in ('cache/archive', 'plugins', 'starters'):
+    path = os.path.join(helm_home, directory)
+    if not os.path.isdir(path):
+      os.makedirs(path)
+      created = True
+
+  repository = os.path.join(helm_home, 'repository')
+  if repository_home:
+    source = os.path.join(repository_home, 'repository')
+    if os.path.islink(repository) and os.readlink(repository) != source:
+      os.remove(repository)
+    if not os.path.lexists(repository):
+      os.symlink(source, repository)
+      created = True
+    elif not os.path.islink(repository):
+      raise CommandExecutionError('Unable to share the repositories of %s: '
+                                  '%s already exists' % (repository_home, 
+                                                         repository))
+  else:
+    if not os.path.isdir(os.path.join(repository, 'cache')):
+      os.makedirs(os.path.join(repository, 'cache'))
+      created = True
+    if not os.path.exists(_repositories_file(helm_home=helm_home)):
+      _write_atomic(_repositories_file(helm_home=helm_home), 
+                    yaml.serialize({'apiVersion': 'v1', 'repositories': []},
+                                   default_flow_style=False).encode('utf-8'))
+      created = True
+  return {'helm_home': helm_home, 'created': created}
 
-def get_release(name, tiller_namespace="kube-system", **kwargs):
+def update_repos(conditional=False, ttl=0, concurrency=4, **kwargs):
   '''
-  Get the parsed release metadata from calling `helm get {{ release }}` for the 
-  supplied release name, or None if no release is found. The following keys may 
-  or may not be in the returned dict:
+  Ensures the local helm repository cache for each repository is up to date. 
+  Proxies the `helm repo update` command, unless `conditional` is set.
 
-    * chart
-    * version
-    * values
-    * computed_values
-    * manifest
-    * namespace
+  conditional : False
+      Instead of running `helm repo update`, refresh each repository's 
+      cached index directly, only downloading indexes that changed upstream
+      according to their ETag or Last-Modified response headers. Returns a
+      dict with the following keys:
+
+        * updated: the names of the repositories whose index was downloaded
+        * skipped: the names of the repositories whose index was unchanged 
+          upstream or checked within the last `ttl` seconds
+        * failed: the names of the repositories that could not be refreshed
+        * repos: a dict keyed by repository name with the status, duration
+          in seconds and any error for each repository
+
+  ttl : 0
+      When refreshing conditionally, the number of seconds for which an
+      index is considered fresh after it was last checked.
+
+  concurrency : 4
+      When refreshing conditionally, the number of indexes to refresh at 
+      once.
   '''
-  kwargs['tiller_namespace'] = tiller_namespace
-  cmd = _helm_cmd('get', name, **kwargs)
-  result = __salt__['cmd.run_stdout'](**cmd)
-  if not result:
-    return None
+  with _home_lock(exclusive=True, **kwargs):
+    if not conditional:
+      return _cmd_and_result('repo', 'update', **kwargs)
 
-  release = _parse_release(result)
+    repos = _read_repositories(**kwargs)
+    pool = ThreadPool(max(1, min(int(concurrency), len(repos) or 1)))
+    try:
+      refreshed = pool.map(
+        lambda repo: _fetch_repo_index(
+          repo, _repo_cache_file(repo, **kwargs), ttl=float(ttl)),
+        repos
+      )
+    finally:
+      pool.close()
+      pool.join()
 
-  #
-  # `helm get {{ release }}` doesn't currently (2.6.2) return the namespace, so 
-  # separately retrieve it if it's not available
-  #
-  if not 'namespace' in release:
-    release['namespace'] = _get_release_namespace(name, **kwargs)
-  return release
+  result = {'updated': [], 'skipped': [], 'failed': [], 'repos': {}}
+  for repo in refreshed:
+    if repo['status'] == 'updated':
+      result['updated'].append(repo['name'])
+    elif repo['status'] == 'failed':
+      result['failed'].append(repo['name'])
+    else:
+      result['skipped'].append(repo['name'])
+    result['repos'][repo.pop('name')] = repo
+  return result
 
-def release_exists(name, tiller_namespace="kube-system", **kwargs):
+_VERSION_RE = re.compile(
+  r'^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?(?:-([0-9A-Za-z.-]+))?(?:\+.*)?$')
+
+def _version_key(version):
   '''
-  Determine whether a release exists in the cluster with the supplied name
+  Build a sort key ordering chart versions by semantic version precedence;
+  versions that aren't semantic versions sort before all others.
   '''
-  kwargs['tiller_namespace'] = tiller_namespace
-  return get_release(name, **kwargs) is not None
+  match = _VERSION_RE.match('%s' % version)
+  if not match:
+    return (0, 0, 0, 0, 0, ())
+  major, minor, patch, prerelease = match.groups()
+  identifiers = tuple(
+    (0, int(part), '') if part.isdigit() else (1, 0, part)
+    for part in (prerelease or '').split('.') if part
+  )
+  return (1, int(major), int(minor or 0), int(patch or 0), 
+          0 if prerelease else 1, identifiers)
 
-def release_create(name, chart_name, namespace='default',
+def _is_prerelease(version):
+  match = _VERSION_RE.match('%s' % version)
+  return bool(match and match.group(4))
+
+def _load_repo_index(repo, **kwargs):
+  '''
+  Get the charts in the cached index of the supplied repository as a dict of
+  chart names to lists of version dicts (with `version` and `digest` keys),
+  newest first. Each index is only loaded once per run unless the cached 
+  file changes.
+  '''
+  cache_file = _repo_cache_file(repo, **kwargs)
+  try:
+    mtime = os.path.getmtime(cache_file)
+  except OSError:
+    return {}
+
+  key = 'helm.chart_index:%s' % cache_file
+  cached = __context__.get(key)
+  if cached and cached['mtime'] == mtime:
+    return cached['charts']
+
+  with _home_lock(**kwargs):
+    with open(cache_file) as index_stream:
+      index = _load_yaml(index_stream, Loader=_IndexLoader) or {}
+
+  charts = {}
+  for chart, entries in (index.get('entries') or {}).items():
+    versions = [{'version': '%s' % entry['version'], 
+                 'digest': entry.get('digest')} 
+                for entry in entries or [] if entry.get('version')]
+    versions.sort(key=lambda entry: _version_key(entry['version']), 
+                  reverse=True)
+    charts[chart] = versions
+
+  __context__[key] = {'mtime': mtime, 'charts': charts}
+  return charts
+
+def chart_versions(chart_name, **kwargs):
+  '''
+  Get the versions of the supplied chart available in the local repository
+  cache, without querying the repository, as a list of dicts with `version`
+  and `digest` keys, newest first. Returns None if the chart's repository 
+  isn't registered with the Helm client.
+
+  chart_name
+      The repository and chart name, such as `stable/mysql`
+  '''
+  if '/' not in chart_name:
+    return None
+  repo_name, chart = chart_name.split('/', 1)
+  for repo in _read_repositories(**kwargs):
+    if repo['name'] == repo_name:
+      return _load_repo_index(repo, **kwargs).get(chart, [])
+  return None
+
+def resolve_chart_version(chart_name, version=None, devel=False, **kwargs):
+  '''
+  Resolve the version of the supplied chart that installing it would use, 
+  from the local repository cache: the supplied version if it is set, 
+  otherwise the newest version that isn't a pre-release. Returns None if no
+  version can be resolved locally.
+
+  chart_name
+      The repository and chart name, such as `stable/mysql`
+
+  version : None
+      The version requested for the chart, if any
+
+  devel : False
+      Whether pre-release versions may be resolved as the newest version
+  '''
+  if version:
+    return version
+  try:
+    versions = chart_versions(chart_name, **kwargs)
+  except CommandExecutionError as e:
+    LOG.debug("unable to read the repository cache: %s" % e)
+    return None
+  for entry in versions or []:
+    if devel or not _is_prerelease(entry['version']):
+      return entry['version']
+  return None
+
+def _tiller_version(**kwargs):
+  '''
+  Ask Tiller for its version, the cheapest call it answers, raising a
+  CommandExecutionError if it can't be reached.
+  '''
+  if _backend(**kwargs) == 'grpc':
+    return __salt__['tiller.version'](**kwargs)
+
+  result = _cmd_and_result('version', '--server', '--short', **kwargs)
+  match = re.search(r'Server:\s*(\S+)', result['stdout'])
+  return match.group(1) if match else result['stdout'].strip()
+
+def wait_for_tiller(timeout=30, initial_delay=0.5, max_delay=5,
+                    tiller_namespace="kube-system", **kwargs):
+  '''
+  Wait for Tiller to answer requests, probing it with `helm version --server`
+  (rather than listing every release) and backing off exponentially, with 
+  random jitter, between failed probes until the deadline passes. Returns a 
+  dict with the following keys:
+
+    * ready: whether Tiller answered before the deadline
+    * version: the version reported by Tiller, if it answered
+    * duration: the number of seconds until Tiller answered or the deadline
+      passed
+    * attempts: the number of probes made
+    * error: the error from the last failed probe, if Tiller didn't answer
+
+  timeout : 30
+      The number of seconds to wait for Tiller; at least one probe is always
+      made.
+
+  initial_delay : 0.5
+      The upper bound in seconds of the wait after the first failed probe, 
+      doubled after each subsequent failure.
+
+  max_delay : 5
+      The maximum upper bound in seconds of the wait between probes.
+  '''
+  kwargs['tiller_namespace'] = tiller_namespace
+  start = time.time()
+  deadline = start + float(timeout)
+  delay = float(initial_delay)
+  attempts = 0
+  while True:
+    attempts += 1
+    try:
+      version = _tiller_version(**kwargs)
+      return {
+        'ready': True,
+        'version': version,
+        'duration': time.time() - start,
+        'attempts': attempts,
+      }
+    except CommandExecutionError as e:
+      error = '%s' % getattr(e, 'error', e)
+
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      return {
+        'ready': False,
+        'duration': time.time() - start,
+        'attempts': attempts,
+        'error': error,
+      }
+    LOG.debug("Tiller not ready after %s attempts: %s" % (attempts, error))
+    time.sleep(min(random.uniform(0, delay), remaining))
+    delay = min(delay * 2, float(max_delay))
+
+def list_releases(tiller_namespace="kube-system", refresh=False, 
+                  page_size=256, **kwargs):
+  '''
+  Get a summary of every release known to Tiller from `helm list --all`,
+  formatted as a dict keyed by release name. Each value is a dict with the
+  following keys:
+
+    * name
+    * revision
+    * status
+    * updated
+    * chart
+    * version
+    * namespace
+
+  The listing is fetched once and kept for the rest of the Salt run, so that
+  `get_release` and `release_exists` can answer from it instead of querying 
+  Tiller for each release. It is dropped whenever a release is created, 
+  upgraded or deleted through this module.
+
+  refresh : False
+      Ignore any listing already fetched during this run and query Tiller 
+      again.
+
+  page_size : 256
+      The number of releases to request per `helm list` call; Tiller caps the
+      size of a single listing, so larger installations are paged through.
+  '''
+  kwargs['tiller_namespace'] = tiller_namespace
+  key = _context_key('helm.releases', **kwargs)
+  if not refresh and key in __context__:
+    return __context__[key]
+
+  if _backend(**kwargs) == 'grpc':
+    __context__[key] = __salt__['tiller.list_releases'](
+      page_size=page_size, **kwargs)
+    return __context__[key]
+
+  releases = {}
+  offset = None
+  while True:
+    args = ['--all', '--max', '%s' % page_size]
+    if offset:
+      args += ['--offset', offset]
+    result = _cmd_and_result('list', *args, **kwargs)
+    page, offset = _timed_parse(_parse_release_list, result['stdout'])
+    releases.update(page)
+    if not offset or offset in releases:
+      break
+
+  __context__[key] = releases
+  return releases
+
+def _get_release_content(name, fields, **kwargs):
+  '''
+  Retrieve the supplied fields of a release from Tiller using the cheapest 
+  command that provides them, or None if the release isn't found.
+  '''
+  if _backend(**kwargs) == 'grpc':
+    return __salt__['tiller.get_release'](name, **kwargs)
+
+  if list(fields) in (['values'], ['computed_values']):
+    args = ['--all'] if fields[0] == 'computed_values' else []
+    result = _run(_helm_cmd('get', 'values', name, *args, **kwargs), **kwargs)
+    if result['retcode'] != 0:
+      return None
+    return {fields[0]: _timed_parse(yaml.deserialize, result['stdout'])
+                       if result['stdout'].strip() else None}
+
+  if list(fields) == ['manifest']:
+    cmd = _helm_cmd('get', 'manifest', name, **kwargs)
+    if _streaming(**kwargs):
+      result = _stream(cmd, lambda lines: ''.join(lines).rstrip(), **kwargs)
+      return {'manifest': result['result']} if result['retcode'] == 0 else None
+    result = _run(cmd, **kwargs)
+    if result['retcode'] != 0:
+      return None
+    return {'manifest': result['stdout']}
+
+  if _streaming(**kwargs):
+    result = _stream(_helm_cmd('get', name, **kwargs), 
+                     lambda lines: _parse_release(lines, fields), **kwargs)
+    return result['result'] if result['retcode'] == 0 else None
+
+  result = _run(_helm_cmd('get', name, **kwargs), **kwargs)['stdout']
+  if not result:
+    return None
+  return _timed_parse(_parse_release, result, fields)
+
+def get_release(name, tiller_namespace="kube-system", fields=None, **kwargs):
+  '''
+  Get the parsed release metadata from calling `helm get {{ release }}` for the 
+  supplied release name, or None if no release is found. The following keys may 
+  or may not be in the returned dict:
+
+    * chart
+    * version
+    * values
+    * computed_values
+    * manifest
+    * namespace
+    * revision
+    * status
+
+  Releases are first looked up in the listing from `list_releases`, so a 
+  missing release costs no extra call to Tiller and the parsed release is 
+  reused for the rest of the run until its revision changes. The release
+  content is also stored under the helm home's `cache/salt/releases` 
+  directory and reused by later runs while the listed revision and 
+  deployment time are unchanged; the `helm:client:release_cache_size` 
+  setting (default 512, 0 to disable) bounds the number of releases kept.
+
+  fields : None
+      A list (or comma separated string) of the keys above to retrieve; only
+      those keys are returned. The chart, version, namespace, revision and 
+      status come from the release listing, so requesting only those doesn't
+      query the release itself, and a single content field is retrieved with
+      `helm get values` or `helm get manifest` instead of the full release. 
+      Defaults to retrieving every key.
+  '''
+  kwargs['tiller_namespace'] = tiller_namespace
+  requested = _release_fields(fields)
+  summary = None
+  index = _release_index(**kwargs)
+  if index is not None:
+    summary = index.get(name)
+    if summary is None:
+      return None
+
+  cache = __context__.setdefault(_context_key('helm.release', **kwargs), {})
+  release = {}
+  if summary:
+    cached = cache.get(name)
+    if cached and cached.get('revision') == summary['revision']:
+      release = copy.deepcopy(cached)
+    release.update((key, summary[key]) for key in _SUMMARY_FIELDS)
+
+    if any(field not in release for field in requested):
+      stored = _read_cached_release(name, summary, **kwargs)
+      release.update((key, value) for (key, value) in stored.items()
+                     if key not in release)
+      if stored:
+        cache[name] = copy.deepcopy(release)
+
+  missing = [field for field in requested if field not in release]
+  if missing:
+    content = _get_release_content(name, missing, **kwargs)
+    if content is None:
+      return None
+    release.update((key, value) for (key, value) in content.items() 
+                   if key not in release)
+    if summary:
+      cache[name] = copy.deepcopy(release)
+      _write_cached_release(name, summary, release, **kwargs)
+
+  #
+  # `helm get {{ release }}` doesn't currently (2.6.2) return the namespace, so 
+  # separately retrieve it if it's not available
+  #
+  if 'namespace' in requested and not release.get('namespace'):
+    release['namespace'] = _get_release_namespace(name, **kwargs)
+
+  return dict((key, value) for (key, value) in release.items() 
+              if key in requested)
+
+def release_resources(name, tiller_namespace="kube-system", **kwargs):
+  '''
+  Get an index of the resources in the manifest of the supplied release, or 
+  None if no release is found. The index is a dict keyed by 
+  `apiVersion:kind:namespace:name` (the namespace is empty unless set in the
+  manifest), with a hash of the resource's canonical form as each value.
+  When streaming output (`helm:client:stream_output`), the manifest is 
+  indexed as helm writes it, one resource at a time.
+  '''
+  kwargs['tiller_namespace'] = tiller_namespace
+  if _streaming(**kwargs) and _backend(**kwargs) == 'cli':
+    index = _release_index(**kwargs)
+    if index is not None and name not in index:
+      return None
+    result = _stream(_helm_cmd('get', 'manifest', name, **kwargs), 
+                     _manifest_index, **kwargs)
+    return result['result'] if result['retcode'] == 0 else None
+
+  release = get_release(name, fields=['manifest'], **kwargs)
+  if release is None:
+    return None
+  return _manifest_index(release.get('manifest'))
+
+def release_exists(name, tiller_namespace="kube-system", **kwargs):
+  '''
+  Determine whether a release exists in the cluster with the supplied name
+  '''
+  kwargs['tiller_namespace'] = tiller_namespace
+  index = _release_index(**kwargs)
+  if index is not None:
+    return name in index
+  return get_release(name, **kwargs) is not None
+
+def _wait_args(wait=False, timeout=300, atomic=False):
+  if wait or atomic:
+    return ['--wait', '--timeout', '%s' % int(timeout)]
+  return []
+
+def release_create(name, chart_name, namespace='default',
                    version=None, values_file=None,
-                   tiller_namespace='kube-system', **kwargs):
+                   tiller_namespace='kube-system', wait=False, timeout=300,
+                   atomic=False, max_history=None, **kwargs):
     '''
     Install a release. There must not be a release with the supplied name 
     already installed to the Kubernetes cluster.
@@ -309,30 +1662,65 @@ def release_create(name, chart_name, namespace='default',
     different namespace, in which case you'll need to delete and purge the 
     existing release (using release_delete) and *then* use this function to
     install a new release to the desired namespace.
+
+    wait : False
+        Wait until the release's pods, PVCs and services are ready, as with
+        `helm install --wait`.
+
+    timeout : 300
+        The number of seconds to wait for the release to be ready.
+
+    atomic : False
+        Wait for the release to be ready, and delete and purge it if the 
+        install fails or the release doesn't become ready in time. This 
+        emulates the `--atomic` flag of later helm versions.
+
+    max_history : None
+        The number of revisions of the release to keep in Tiller's storage
+        (see `prune_release_history`). Defaults to keeping every revision.
     '''
-    args = []
-    if version is not None:
-        args += ['--version', version]
+    kwargs['tiller_namespace'] = tiller_namespace
+    chart, args = _chart_ref(chart_name, version, **kwargs)
     if values_file is not None:
         args += ['--values', values_file]
-    return _cmd_and_result(
-      'install', chart_name,
-      '--namespace', namespace, 
-      '--name', name,  
-      *args, **kwargs
-    )
+    args += _wait_args(wait, timeout, atomic)
+    _invalidate_release(name, **kwargs)
+    try:
+      result = _spool_output(_cmd_and_result(
+        'install', chart,
+        '--namespace', namespace, 
+        '--name', name,  
+        *args, **kwargs
+      ), name, **kwargs)
+    except HelmExecutionError as e:
+      if not atomic:
+        raise
+      LOG.debug("purging release %s after failed atomic install" % name)
+      try:
+        release_delete(name, **kwargs)
+        reverted = 'the release was purged'
+      except HelmExecutionError as purge_error:
+        reverted = 'failed to purge the release: %s' % purge_error.error
+      raise HelmExecutionError(e.cmd, CommandExecutionError(
+        '%s\n(atomic install: %s)' % (e.error, reverted)))
+    _limit_history(result, name, max_history, **kwargs)
+    return result
 
 def release_delete(name, tiller_namespace='kube-system', **kwargs):
     '''
     Delete and purge any release found with the supplied name.
     '''
     kwargs['tiller_namespace'] = tiller_namespace
-    return _cmd_and_result('delete', '--purge', name, **kwargs)
+    _invalidate_release(name, **kwargs)
+    return _spool_output(_cmd_and_result('delete', '--purge', name, **kwargs),
+                         name, **kwargs)
 
 
 def release_upgrade(name, chart_name, namespace='default',
                     version=None, values_file=None,
-                    tiller_namespace='kube-system', **kwargs):
+                    tiller_namespace='kube-system', dry_run=False, 
+                    wait=False, timeout=300, atomic=False, max_history=None,
+                    **kwargs):
     '''
     Upgrade an existing release. There must be a release with the supplied name
     already installed to the Kubernetes cluster.
@@ -340,42 +1728,977 @@ def release_upgrade(name, chart_name, namespace='default',
     If attempting to change the namespace for the release, this function will
     fail; you will need to first delete and purge the release and then use the
     release_create function to create a new release in the desired namespace.
+
+    dry_run : False
+        Only have Tiller render the upgraded release without applying it. The
+        result then also includes the rendered `manifest` and its 
+        `resources`, indexed as by `release_resources`.
+
+    wait : False
+        Wait until the release's pods, PVCs and services are ready, as with
+        `helm upgrade --wait`.
+
+    timeout : 300
+        The number of seconds to wait for the release to be ready.
+
+    atomic : False
+        Wait for the release to be ready, and roll it back to the revision 
+        deployed before the upgrade if the upgrade fails or the release 
+        doesn't become ready in time. This emulates the `--atomic` flag of 
+        later helm versions.
+
+    max_history : None
+        The number of revisions of the release to keep in Tiller's storage
+        after the upgrade (see `prune_release_history`). Defaults to keeping
+        every revision.
     '''
     kwargs['tiller_namespace'] = tiller_namespace
-    args = []
-    if version is not None:
-      args += ['--version', version]
+    chart, args = _chart_ref(chart_name, version, **kwargs)
     if values_file is not None:
       args += ['--values', values_file]
-    return _cmd_and_result(
-      'upgrade', name, chart_name,
-      '--namespace', namespace,  
-      *args, **kwargs
-    )
+    previous = None
+    if dry_run:
+      args += ['--dry-run', '--debug']
+    else:
+      args += _wait_args(wait, timeout, atomic)
+      if atomic:
+        previous = (_release_index(**kwargs) or {}).get(name, {}).get('revision')
+      _invalidate_release(name, **kwargs)
+    try:
+      if dry_run and _streaming(**kwargs):
+        result = _cmd_and_stream(
+          lambda lines: _parse_release(lines, ['manifest']),
+          'upgrade', name, chart,
+          '--namespace', namespace,  
+          *args, **kwargs
+        )
+      else:
+        result = _cmd_and_result(
+          'upgrade', name, chart,
+          '--namespace', namespace,  
+          *args, **kwargs
+        )
+    except HelmExecutionError as e:
+      if not atomic or dry_run:
+        raise
+      if not previous:
+        reverted = 'the previous revision is unknown, so it was not rolled back'
+      else:
+        LOG.debug("rolling back release %s to revision %s after failed atomic "
+                  "upgrade" % (name, previous))
+        try:
+          release_rollback(name, previous, **kwargs)
+          reverted = 'the release was rolled back to revision %s' % previous
+        except HelmExecutionError as rollback_error:
+          reverted = 'failed to roll back the release: %s' % (
+            rollback_error.error)
+      raise HelmExecutionError(e.cmd, CommandExecutionError(
+        '%s\n(atomic upgrade: %s)' % (e.error, reverted)))
+    if dry_run:
+      rendered = result.pop('result', None) or _timed_parse(
+        _parse_release, result['stdout'], ['manifest'])
+      result['manifest'] = rendered.get('manifest', '')
+      result['resources'] = _timed_parse(_manifest_index, result['manifest'])
+      return result
+    result = _spool_output(result, name, **kwargs)
+    _limit_history(result, name, max_history, **kwargs)
+    return result
+
+def release_rollback(name, revision, tiller_namespace='kube-system', 
+                     wait=False, timeout=300, **kwargs):
+    '''
+    Roll the release with the supplied name back to the supplied revision.
+
+    wait : False
+        Wait until the release's pods, PVCs and services are ready.
+
+    timeout : 300
+        The number of seconds to wait for the release to be ready.
+    '''
+    kwargs['tiller_namespace'] = tiller_namespace
+    _invalidate_release(name, **kwargs)
+    return _spool_output(_cmd_and_result('rollback', name, '%s' % revision, 
+                                          *_wait_args(wait, timeout), 
+                                          **kwargs), name, **kwargs)
+
+def _parse_release_history(output):
+  '''
+  Parse the tabular output of `helm history` into a list of revisions, 
+  oldest first.
+  '''
+  history = []
+  columns = None
+  for line in output.split("\n"):
+    fields = [field.strip() for field in line.split("\t")]
+    if not line.strip():
+      continue
+    if columns is None:
+      if fields[0] == 'REVISION':
+        columns = dict((column, i) for (i, column) in enumerate(fields))
+      continue
+
+    row = dict((column, fields[i]) for (column, i) in columns.items()
+               if i < len(fields))
+    if not row.get('REVISION', '').isdigit():
+      continue
+    chart, version = _parse_chart(row.get('CHART', ''))
+    history.append({
+      'revision': int(row['REVISION']),
+      'updated': row.get('UPDATED'),
+      'status': row.get('STATUS'),
+      'chart': chart,
+      'version': version,
+      'description': row.get('DESCRIPTION'),
+    })
+  return sorted(history, key=lambda revision: revision['revision'])
+
+def release_history(name, max_revisions=256, tiller_namespace='kube-system',
+                    **kwargs):
+    '''
+    Get the revisions of the release with the supplied name kept by Tiller,
+    oldest first, or None if no release is found. Each revision is a dict 
+    with the following keys:
+
+      * revision
+      * updated
+      * status
+      * chart
+      * version
+      * description
+
+    max_revisions : 256
+        The maximum number of the most recent revisions to return.
+    '''
+    kwargs['tiller_namespace'] = tiller_namespace
+    cmd = _helm_cmd('history', name, '--max', '%s' % max_revisions, **kwargs)
+    result = _run(cmd, **kwargs)
+    if result['retcode'] != 0:
+      if 'not found' in result['stderr']:
+        return None
+      raise HelmExecutionError(_cmd_string(cmd), 
+                               CommandExecutionError(result['stderr']))
+    return _timed_parse(_parse_release_history, result['stdout'])
+
+def _tiller_storage(tiller_namespace='kube-system', **kwargs):
+  '''
+  Determine the storage backend (`configmap`, `secret` or `memory`) of the
+  Tiller deployment (`tiller-deploy`, as created by `helm init`) in the 
+  supplied namespace from its `--storage` flag.
+  '''
+  key = _context_key('helm.tiller_storage', 
+                     tiller_namespace=tiller_namespace, **kwargs)
+  if key in __context__:
+    return __context__[key]
+
+  cmd = _kubectl_cmd('get', 'deployment', 'tiller-deploy', '--namespace',
+                     tiller_namespace, '-o', 'json', **kwargs)
+  result = _run(cmd, **kwargs)
+  if result['retcode'] != 0:
+    raise CommandExecutionError('Unable to find the Tiller deployment to '
+                                'determine its storage backend: %s' % 
+                                result['stderr'])
+
+  storage = 'configmap'
+  deployment = _timed_parse(json.loads, result['stdout'])
+  template = (deployment.get('spec') or {}).get('template') or {}
+  for container in (template.get('spec') or {}).get('containers') or []:
+    flags = (container.get('command') or []) + (container.get('args') or [])
+    for index, flag in enumerate(flags):
+      if flag.startswith('--storage='):
+        storage = flag.split('=', 1)[1]
+      elif flag == '--storage' and index + 1 < len(flags):
+        storage = flags[index + 1]
+  __context__[key] = storage
+  return storage
+
+def prune_release_history(name, max_history, tiller_namespace='kube-system',
+                          **kwargs):
+    '''
+    Delete all but the most recent `max_history` revisions of the release 
+    with the supplied name from Tiller's storage, so that the release 
+    listings and lookups made by Tiller stay fast. The deployed revision is
+    always kept. Prefer `helm init --history-max` (see 
+    `helm:client:tiller:history_max`) with helm 2.8 or later; helm 2.6 has
+    no option to bound the history, so the ConfigMaps in which Tiller stores
+    the revisions are deleted with kubectl. Tiller installations storing 
+    releases anywhere else (such as with `--storage=secret`) are refused. 
+    Returns a dict with the revisions that were removed and the number kept.
+
+    max_history
+        The number of revisions to keep.
+    '''
+    storage = _tiller_storage(tiller_namespace, **kwargs)
+    if storage != 'configmap':
+      raise CommandExecutionError(
+        'Tiller stores releases with the %s storage backend; only the '
+        'configmap backend can be pruned, bound the history with '
+        'helm:client:tiller:history_max instead' % storage)
+
+    cmd = _kubectl_cmd('get', 'configmaps', '--namespace', tiller_namespace, 
+                       '-l', 'OWNER=TILLER,NAME=%s' % name, '-o', 'json',
+                       **kwargs)
+    result = _run(cmd, **kwargs)
+    if result['retcode'] != 0:
+      raise CommandExecutionError('Unable to get the revisions of release %s: '
+                                  '%s' % (name, result['stderr']))
+
+    revisions = []
+    for item in _timed_parse(json.loads, result['stdout']).get('items', []):
+      metadata = item.get('metadata') or {}
+      labels = metadata.get('labels') or {}
+      if (labels.get('VERSION') or '').isdigit():
+        revisions.append((int(labels['VERSION']), labels.get('STATUS'), 
+                          metadata['name']))
+    revisions.sort(reverse=True)
+
+    keep = max(1, int(max_history))
+    removed = [(revision, configmap) for (revision, status, configmap) 
+               in revisions[keep:] if status != 'DEPLOYED']
+    if removed:
+      cmd = _kubectl_cmd('delete', 'configmaps', '--namespace', 
+                         tiller_namespace, 
+                         *[configmap for (_, configmap) in removed], **kwargs)
+      result = _run(cmd, **kwargs)
+      if result['retcode'] != 0:
+        raise CommandExecutionError('Unable to prune the revisions of release '
+                                    '%s: %s' % (name, result['stderr']))
+    return {
+      'removed': sorted(revision for (revision, _) in removed),
+      'kept': len(revisions) - len(removed),
+    }
+
+def _limit_history(result, name, max_history, **kwargs):
+  '''
+  Prune the history of a release just installed or upgraded, reporting the
+  revisions removed in the command's result. Failing to prune doesn't fail 
+  the install or upgrade.
+  '''
+  if not max_history:
+    return
+  try:
+    pruned = prune_release_history(name, max_history, **kwargs)
+    result['pruned_revisions'] = pruned['removed']
+  except CommandExecutionError as e:
+    LOG.warning('Unable to prune the history of release %s: %s', name, e)
+
+def _release_names(names):
+  if not isinstance(names, (list, tuple)):
+    names = [name.strip() for name in names.split(',') if name.strip()]
+  return list(names)
+
+def _kubectl_cmd(*args, **kwargs):
+  '''
+  Build a kubectl command against the supplied kube config, failing clearly
+  if kubectl isn't installed (the formula only installs it with 
+  `helm:client:kubectl:install`).
+  '''
+  if not __context__.get('helm.kubectl'):
+    __context__['helm.kubectl'] = __salt__['cmd.which']('kubectl')
+    if not __context__['helm.kubectl']:
+      raise CommandExecutionError(
+        'kubectl is required but was not found on the PATH; install it, '
+        'such as by setting helm:client:kubectl:install')
+  env = {}
+  if kwargs.get('kube_config'):
+    env['KUBECONFIG'] = kwargs['kube_config']
+  if kwargs.get('gce_service_token'):
+    env['GOOGLE_APPLICATION_CREDENTIALS'] = kwargs['gce_service_token']
+  return {
+    'cmd': ('kubectl',) + args,
+    'env': env,
+  }
+
+_READINESS_KINDS = 'deployments,statefulsets,daemonsets,jobs,persistentvolumeclaims'
+
+def _resource_ready(resource):
+  '''
+  Determine whether a workload or claim has rolled out as specified
+  '''
+  kind = resource.get('kind')
+  metadata = resource.get('metadata') or {}
+  spec = resource.get('spec') or {}
+  status = resource.get('status') or {}
+  if status.get('observedGeneration', 0) < metadata.get('generation', 0):
+    return False
+
+  if kind == 'Deployment':
+    replicas = spec.get('replicas', 1)
+    return (status.get('updatedReplicas', 0) >= replicas and
+            status.get('availableReplicas', 0) >= replicas)
+  if kind == 'StatefulSet':
+    replicas = spec.get('replicas', 1)
+    return status.get('readyReplicas', 0) >= replicas
+  if kind == 'DaemonSet':
+    desired = status.get('desiredNumberScheduled', 0)
+    return (status.get('numberReady', 0) >= desired and
+            status.get('updatedNumberScheduled', desired) >= desired)
+  if kind == 'Job':
+    return status.get('succeeded', 0) >= (spec.get('completions') or 1)
+  if kind == 'PersistentVolumeClaim':
+    return status.get('phase') == 'Bound'
+  return True
+
+def release_readiness(names, **kwargs):
+  '''
+  Check whether the deployments, stateful sets, daemon sets, jobs and 
+  persistent volume claims of each of the supplied releases have rolled out,
+  using a single `kubectl get` for all of the releases. Resources are matched
+  to releases by their `release` label (as set by most Helm 2 charts), or 
+  the label set by `helm:client:release_label`. Returns a dict keyed by 
+  release name, with each value a dict with the following keys:
+
+    * ready: whether every matched resource has rolled out
+    * pending: the `apiVersion:kind:namespace:name` keys of the resources 
+      that haven't
+
+  names
+      A list (or comma separated string) of release names
+  '''
+  names = _release_names(names)
+  label = _setting('release_label', 'release', **kwargs)
+  cmd = _kubectl_cmd('get', _READINESS_KINDS, '--all-namespaces', 
+                     '-l', '%s in (%s)' % (label, ','.join(names)),
+                     '-o', 'json', **kwargs)
+  result = _run(cmd, **kwargs)
+  if result['retcode'] != 0:
+    raise CommandExecutionError('Unable to get release resources: %s' % 
+                                result['stderr'])
+
+  pending = dict((name, []) for name in names)
+  for resource in _timed_parse(json.loads, result['stdout']).get('items', []):
+    labels = (resource.get('metadata') or {}).get('labels') or {}
+    if labels.get(label) in pending and not _resource_ready(resource):
+      pending[labels[label]].append(_resource_key(resource))
+  return dict((name, {'ready': not resources, 'pending': sorted(resources)})
+              for (name, resources) in pending.items())
+
+def _chart_cache_dir(**kwargs):
+  return os.path.join(_helm_home(**kwargs), 'cache', 'salt', 'charts')
+
+def _has_requirements(chart_path):
+  return os.path.exists(os.path.join(chart_path, 'requirements.yaml'))
+
+def _chart_digest(chart_path):
+  '''
+  Hash the content of a chart directory (its templates, values, requirements
+  and lock file and any other file), leaving out the dependency archives that
+  `helm dependency build` downloads into `charts/`.
+  '''
+  if not os.path.isdir(chart_path):
+    raise CommandExecutionError('No chart found at %s' % chart_path)
+  skip_archives = _has_requirements(chart_path)
+  digest = hashlib.sha256()
+  for root, dirs, files in os.walk(chart_path):
+    dirs[:] = sorted(directory for directory in dirs if directory != '.git')
+    relative_root = os.path.relpath(root, chart_path)
+    for filename in sorted(files):
+      if (skip_archives and relative_root == 'charts' and 
+          filename.endswith('.tgz')):
+        continue
+      relative = os.path.normpath(os.path.join(relative_root, filename))
+      with open(os.path.join(root, filename), 'rb') as stream:
+        content_digest = hashlib.sha256(stream.read()).digest()
+      digest.update(relative.encode('utf-8') + b'\0' + content_digest)
+  return digest.hexdigest()
+
+def _chart_cache_entry(chart_path, **kwargs):
+  return os.path.join(_chart_cache_dir(**kwargs), _chart_digest(chart_path))
+
+def _cached_chart_files(entry, kind):
+  '''
+  List the files of the supplied kind (`package` or `charts`) in a chart 
+  cache entry, or None if they aren't cached.
+  '''
+  directory = os.path.join(entry, kind)
+  if not os.path.isdir(directory):
+    return None
+  try:
+    os.utime(entry, None)
+  except OSError:
+    pass
+  return [os.path.join(directory, filename) for filename 
+          in sorted(os.listdir(directory))]
 
-def install_chart_dependencies(chart_path, **kwargs):
+def _cache_chart_files(entry, kind, paths, **kwargs):
+  '''
+  Copy the supplied files into a chart cache entry as its files of the 
+  supplied kind, moving them into place at once so that concurrent builds 
+  never see a partial entry, then evict the least recently used entries 
+  beyond the `helm:client:chart_cache_size` limit (default 64).
+  '''
+  try:
+    if not os.path.isdir(entry):
+      os.makedirs(entry)
+    staging = tempfile.mkdtemp(prefix='.%s-' % kind, dir=entry)
+    for path in paths:
+      shutil.copy2(path, staging)
+    try:
+      os.rename(staging, os.path.join(entry, kind))
+    except OSError:
+      # cached by a concurrent build of the same chart
+      shutil.rmtree(staging, ignore_errors=True)
+  except (IOError, OSError) as e:
+    LOG.warning('Unable to cache chart %s files in %s: %s', kind, entry, e)
+    return
+  _evict_oldest(os.path.dirname(entry), 
+                int(_setting('chart_cache_size', 64, **kwargs)), '')
+
+def _dependency_archives(chart_path):
+  charts = os.path.join(chart_path, 'charts')
+  if not os.path.isdir(charts):
+    return []
+  return [os.path.join(charts, filename) for filename 
+          in sorted(os.listdir(charts)) if filename.endswith('.tgz')]
+
+def install_chart_dependencies(chart_path, refresh=False, **kwargs):
   '''
   Install the chart dependencies for the chart definition located at the 
   specified chart_path.
 
+  The dependency archives are cached in the helm home (in 
+  `cache/salt/charts`) by a hash of the chart's content, so that they are 
+  restored from the cache rather than fetched again (`cached` is True in 
+  the result) until the chart changes.
+
   chart_path
       The path to the chart for which to install dependencies
+
+  refresh : False
+      Run `helm dependency build` even if the dependencies are cached.
+  '''
+  start = time.time()
+  cached = None if refresh else _cached_chart_files(
+    _chart_cache_entry(chart_path, **kwargs), 'charts')
+  if cached is not None:
+    charts = os.path.join(chart_path, 'charts')
+    if not os.path.isdir(charts):
+      os.makedirs(charts)
+    for path in cached:
+      shutil.copy2(path, charts)
+    return {
+      'cmd': None,
+      'stdout': '',
+      'stderr': '',
+      'duration': time.time() - start,
+      'cached': True,
+    }
+
+  result = _cmd_and_result('dependency', 'build', chart_path, **kwargs)
+  #
+  # the digest is taken after building, since the build may write the 
+  # requirements.lock file
+  #
+  _cache_chart_files(_chart_cache_entry(chart_path, **kwargs), 'charts',
+                     _dependency_archives(chart_path), **kwargs)
+  result['cached'] = False
+  return result
+
+def build_chart(chart_path, destination=None, refresh=False, **kwargs):
+  '''
+  Package a local chart, building its dependencies first if it has any, and
+  cache the package in the helm home (in `cache/salt/charts`) by a hash of 
+  the chart's content, so that an unchanged chart is never packaged again.
+  Returns a dict with the following keys:
+
+    * chart_path: the path of the chart
+    * digest: the hash of the chart's content
+    * package: the path of the packaged chart
+    * cached: whether the package was taken from the cache
+    * duration: the time taken in seconds
+
+  chart_path
+      The path to the chart definition to package.
+
+  destination : None
+      The directory to copy the package to. Defaults to returning the path 
+      of the package in the cache.
+
+  refresh : False
+      Build and package the chart even if it is cached.
   '''
-  return _cmd_and_result('dependency', 'build', chart_path, **kwargs)
+  start = time.time()
+  entry = _chart_cache_entry(chart_path, **kwargs)
+  packaged = None if refresh else _cached_chart_files(entry, 'package')
+  cached = bool(packaged)
+  staging = None
+  try:
+    if not cached:
+      if _has_requirements(chart_path):
+        install_chart_dependencies(chart_path, refresh=refresh, **kwargs)
+        entry = _chart_cache_entry(chart_path, **kwargs)
+      staging = tempfile.mkdtemp(prefix='helm-package-')
+      _cmd_and_result('package', chart_path, '-d', staging, **kwargs)
+      built = [os.path.join(staging, filename) for filename 
+               in os.listdir(staging)]
+      _cache_chart_files(entry, 'package', built, **kwargs)
+      packaged = _cached_chart_files(entry, 'package') or built
+      if packaged is built and not destination:
+        destination = os.getcwd()
+    if not packaged:
+      raise CommandExecutionError('helm package produced no package for %s' %
+                                  chart_path)
+
+    package_path = packaged[0]
+    if destination:
+      if not os.path.isdir(destination):
+        os.makedirs(destination)
+      package_path = os.path.join(destination, os.path.basename(packaged[0]))
+      shutil.copy2(packaged[0], package_path)
+  finally:
+    if staging:
+      shutil.rmtree(staging, ignore_errors=True)
+
+  return {
+    'chart_path': chart_path,
+    'digest': os.path.basename(entry),
+    'package': package_path,
+    'cached': cached,
+    'duration': time.time() - start,
+  }
 
-def package(path, destination = None, **kwargs):
+def build_charts(chart_paths, destination=None, concurrency=4, refresh=False,
+                 **kwargs):
+  '''
+  Package several local charts at once with `build_chart`, reusing the 
+  cached packages of unchanged charts. Returns a dict with the following 
+  keys:
+
+    * built: the paths of the charts that were packaged
+    * cached: the paths of the charts whose package was taken from the cache
+    * failed: the paths of the charts that could not be packaged
+    * charts: a dict keyed by chart path with the result of `build_chart`, 
+      or the error, for each chart
+
+  chart_paths
+      The list of paths of the charts to package.
+
+  destination : None
+      The directory to copy the packages to, as for `build_chart`.
+
+  concurrency : 4
+      The number of charts to build at once.
+
+  refresh : False
+      Build and package every chart even if it is cached.
+  '''
+  def build(chart_path):
+    try:
+      return build_chart(chart_path, destination=destination, 
+                         refresh=refresh, **kwargs)
+    except CommandExecutionError as e:
+      return {'chart_path': chart_path, 'error': getattr(e, 'error', e)}
+
+  pool = ThreadPool(max(1, min(int(concurrency), len(chart_paths) or 1)))
+  try:
+    built = pool.map(in_context(build), chart_paths)
+  finally:
+    pool.close()
+    pool.join()
+
+  result = {'built': [], 'cached': [], 'failed': [], 'charts': {}}
+  for chart in built:
+    if chart.get('error') is not None:
+      chart['error'] = '%s' % chart['error']
+      result['failed'].append(chart['chart_path'])
+    elif chart['cached']:
+      result['cached'].append(chart['chart_path'])
+    else:
+      result['built'].append(chart['chart_path'])
+    result['charts'][chart.pop('chart_path')] = chart
+  return result
+
+def package(path, destination = None, refresh=False, **kwargs):
   '''
   Package a chart definition, optionally to a specific destination. Proxies the
-  `helm package` command on the target minion
+  `helm package` command on the target minion, reusing the package cached by
+  `build_chart` if the chart hasn't changed (`cached` is True in the result).
 
   path
       The path to the chart definition to package.
 
   destination : None
       An optional alternative destination folder.
+
+  refresh : False
+      Run `helm package` even if the chart's package is cached.
   '''
+  start = time.time()
+  entry = _chart_cache_entry(path, **kwargs)
+  cached = None if refresh else _cached_chart_files(entry, 'package')
+  if cached:
+    destination = destination or os.getcwd()
+    if not os.path.isdir(destination):
+      os.makedirs(destination)
+    package_path = os.path.join(destination, os.path.basename(cached[0]))
+    shutil.copy2(cached[0], package_path)
+    return {
+      'cmd': None,
+      'stdout': ('Successfully packaged chart and saved it to: %s' % 
+                 package_path),
+      'stderr': '',
+      'duration': time.time() - start,
+      'cached': True,
+    }
+
   args = []
   if destination:
     args += ["-d", destination]
   
-  return _cmd_and_result('package', path, *args, **kwargs)
+  result = _cmd_and_result('package', path, *args, **kwargs)
+  match = re.search(r'saved it to: (\S+)', result['stdout'])
+  if match and os.path.exists(match.group(1)):
+    _cache_chart_files(entry, 'package', [match.group(1)], **kwargs)
+  result['cached'] = False
+  return result
+
+# what Tiller accepts as a release name (at most 53 characters)
+_RELEASE_NAME_RE = re.compile(r'^[A-Za-z0-9]([-A-Za-z0-9_.]*[A-Za-z0-9])?$')
+# a DNS-1123 label (at most 63 characters)
+_NAMESPACE_RE = re.compile(r'^[a-z0-9]([-a-z0-9]*[a-z0-9])?$')
+
+def _is_local_chart(chart_name):
+  # like helm, a path that exists is a local chart before it's `repo/chart`
+  return (os.path.exists(chart_name) or chart_name.startswith(('/', '.')) or
+          '/' not in chart_name)
+
+def _check_chart(release, repositories, **kwargs):
+  '''
+  Check a release's chart reference against the local repository cache (or
+  the local chart directory), returning a list of problems.
+  '''
+  chart_name = release.get('chart')
+  if not chart_name:
+    return ['no chart is set']
+  version = release.get('version')
+  if _is_local_chart(chart_name):
+    if not os.path.exists(os.path.join(chart_name, 'Chart.yaml')):
+      return ['no chart found at %s' % chart_name]
+    return []
+
+  repo_name, chart = chart_name.split('/', 1)
+  if repo_name not in repositories:
+    return ['repository "%s" of chart %s is not registered' % (
+      repo_name, chart_name)]
+  versions = _load_repo_index(repositories[repo_name], **kwargs).get(chart)
+  if not versions:
+    return ['chart %s is not in the cached index of repository "%s"' % (
+      chart_name, repo_name)]
+  if (version and _VERSION_RE.match('%s' % version) and 
+      '%s' % version not in [entry['version'] for entry in versions]):
+    return ['version %s of chart %s is not in the cached index of repository '
+            '"%s" (newest: %s)' % (version, chart_name, repo_name, 
+                                   versions[0]['version'])]
+  return []
+
+def _check_release(release_id, release, releases, repositories, **kwargs):
+  problems = []
+  name = release.get('name', release_id)
+  if not isinstance(name, (str, type(u''))):
+    # such as a release id YAML read as a number
+    problems.append('release name %s must be a string, not %s' % (
+      name, type(name).__name__))
+  elif len(name) > 53 or not _RELEASE_NAME_RE.match(name):
+    problems.append('release name "%s" must be at most 53 alphanumeric '
+                    'characters, "-", "_" or ".", starting and ending with '
+                    'an alphanumeric character' % name)
+  namespace = release.get('namespace') or 'default'
+  if not isinstance(namespace, (str, type(u''))):
+    problems.append('namespace %s must be a string, not %s' % (
+      namespace, type(namespace).__name__))
+  elif len(namespace) > 63 or not _NAMESPACE_RE.match(namespace):
+    problems.append('namespace "%s" is not a valid namespace name' % 
+                    namespace)
+  if release.get('values') is not None and not isinstance(
+      release['values'], dict):
+    problems.append('values must be a mapping, not %s' % 
+                    type(release['values']).__name__)
+  if release.get('values_file') and not os.path.exists(
+      release['values_file']):
+    problems.append('values file %s does not exist' % release['values_file'])
+  depends_on = release.get('depends_on') or []
+  if not isinstance(depends_on, list):
+    depends_on = [depends_on]
+  unknown = [dep for dep in depends_on if dep not in releases]
+  if unknown:
+    problems.append('depends on unknown releases: %s' % ', '.join(unknown))
+  try:
+    problems += _check_chart(release, repositories, **kwargs)
+  except (IOError, OSError, ValueError) as e:
+    problems.append('unable to read the cached index for chart %s: %s' % (
+      release.get('chart'), e))
+  return problems
+
+def _file_digest(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as stream:
+    for block in iter(lambda: stream.read(65536), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def _index_digest(chart_name, version, **kwargs):
+  '''
+  Get the digest the cached repository index lists for the supplied version
+  of a chart, or None if it lists none.
+  '''
+  try:
+    versions = chart_versions(chart_name, **kwargs) or []
+  except CommandExecutionError as e:
+    LOG.debug("unable to read the repository cache: %s" % e)
+    return None
+  for entry in versions:
+    if entry['version'] == '%s' % version:
+      return entry['digest']
+  return None
+
+def _fetch_chart_archive(chart_name, version, **kwargs):
+  '''
+  Get the path of the archive of a repository chart, fetching it into the
+  helm home's `cache/archive/<repository>` directory unless it was fetched
+  before and still matches the digest in the repository's cached index.
+  '''
+  repo_name, chart = chart_name.split('/', 1)
+  archive_dir = os.path.join(_helm_home(**kwargs), 'cache', 'archive', 
+                             repo_name)
+  exact = version and _VERSION_RE.match('%s' % version)
+  if exact:
+    archive = os.path.join(archive_dir, '%s-%s.tgz' % (chart, version))
+    if os.path.exists(archive):
+      digest = _index_digest(chart_name, version, **kwargs)
+      if digest and _file_digest(archive) == digest:
+        return archive
+      LOG.debug("refetching %s, which doesn't match the index digest" % 
+                archive)
+
+  if not os.path.isdir(archive_dir):
+    os.makedirs(archive_dir)
+  staging = tempfile.mkdtemp(prefix='.fetch-', dir=archive_dir)
+  try:
+    args = ['--version', '%s' % version] if version else []
+    _cmd_and_result('fetch', chart_name, '--destination', staging, *args,
+                    **kwargs)
+    fetched = os.listdir(staging)
+    if not fetched:
+      raise CommandExecutionError('helm fetch produced no archive for %s' % 
+                                  chart_name)
+    archive = os.path.join(archive_dir, fetched[0])
+    os.rename(os.path.join(staging, fetched[0]), archive)
+  finally:
+    shutil.rmtree(staging, ignore_errors=True)
+  return archive
+
+def _chart_ref(chart_name, version, **kwargs):
+  '''
+  Get the chart to install or upgrade a release from, along with the version
+  arguments for it. Repository charts are fetched first (see
+  `_fetch_chart_archive`), under the shared lock on the repositories, and
+  the release is installed from the archive without the lock, which would
+  otherwise be held while helm waits for the release to be ready.
+  '''
+  if _is_local_chart(chart_name):
+    return chart_name, ['--version', version] if version is not None else []
+  return _fetch_chart_archive(chart_name, version, **kwargs), []
+
+def _lint_release(release, **kwargs):
+  '''
+  Lint a release's chart with its values, returning a list of problems.
+  '''
+  chart_name = release['chart']
+  if _is_local_chart(chart_name):
+    chart_path = chart_name
+  else:
+    version = resolve_chart_version(chart_name, release.get('version'), 
+                                    **kwargs)
+    chart_path = _fetch_chart_archive(chart_name, version, **kwargs)
+
+  args = []
+  values_file = None
+  try:
+    if release.get('values'):
+      handle, values_file = tempfile.mkstemp(prefix='helm-lint-', 
+                                             suffix='.yaml')
+      with os.fdopen(handle, 'w') as values_stream:
+        values_stream.write(yaml.serialize(release['values'], 
+                                           default_flow_style=False))
+      args += ['--values', values_file]
+    elif release.get('values_file'):
+      args += ['--values', release['values_file']]
+    cmd = _helm_cmd('lint', chart_path, *args, **kwargs)
+    result = _run(cmd, **kwargs)
+  finally:
+    if values_file:
+      os.remove(values_file)
+
+  if result['retcode'] == 0:
+    return []
+  output = '%s\n%s' % (result['stdout'], result['stderr'])
+  problems = [line.strip() for line in output.split('\n') 
+              if line.strip().startswith(('[ERROR]', 'Error:'))]
+  return problems or ['helm lint failed: %s' % output.strip()]
+
+def validate_releases(releases, lint=False, concurrency=4, **kwargs):
+  '''
+  Check a map of releases for problems before any of them is installed or
+  upgraded, reporting every problem at once. Each release's name, 
+  namespace, values and dependencies are checked, and its chart (and 
+  version, if pinned) is looked up in the local repository cache, without
+  querying Tiller or the repositories. Disabled releases are only checked
+  as dependencies. Returns a dict with the following keys:
+
+    * valid: whether no problems were found
+    * checked: the number of releases checked
+    * problems: a dict keyed by release id with the list of problems found
+      for each release that has any
+
+  releases
+      A dict of release ids to release definitions, in the same format as 
+      the `helm:client:releases` pillar (see `helm_release.batch_present`)
+
+  lint : False
+      Also run `helm lint` on each release's chart with its values, 
+      fetching repository charts to the helm home's `cache/archive` 
+      directory. Releases whose chart reference is invalid aren't linted.
+
+  concurrency : 4
+      The number of releases to lint at once.
+  '''
+  repositories = dict((repo['name'], repo) 
+                      for repo in _read_repositories(**kwargs))
+  problems = {}
+  enabled = sorted((release_id for (release_id, release) in releases.items()
+                    if (release or {}).get('enabled', True)), key=str)
+  names = {}
+  for release_id in enabled:
+    release = releases[release_id] or {}
+    found = _check_release(release_id, release, releases, repositories, 
+                           **kwargs)
+    name = release.get('name', release_id)
+    if name in names:
+      found.append('release name "%s" is also used by release %s' % (
+        name, names[name]))
+    names.setdefault(name, release_id)
+    if found:
+      problems[release_id] = found
+
+  if lint:
+    lintable = [release_id for release_id in enabled 
+                if release_id not in problems]
+
+    def lint_release(release_id):
+      try:
+        return _lint_release(releases[release_id], **kwargs)
+      except CommandExecutionError as e:
+        return ['unable to lint chart: %s' % getattr(e, 'error', e)]
+
+    pool = ThreadPool(max(1, min(int(concurrency), len(lintable) or 1)))
+    try:
+      linted = pool.map(in_context(lint_release), lintable)
+    finally:
+      pool.close()
+      pool.join()
+    for release_id, found in zip(lintable, linted):
+      if found:
+        problems[release_id] = found
+
+  return {
+    'valid': not problems,
+    'checked': len(enabled),
+    'problems': problems,
+  }
+
+def compare_runners(iterations=5, **kwargs):
+  '''
+  Time a cheap helm command (`helm version --client`) with each of the
+  available runners, to help choose the cheapest way of executing helm on the
+  target minion (configured via the `helm:client:runner` value). Returns a 
+  dict keyed by runner name with the minimum, mean and maximum wall time in 
+  seconds, along with any error the runner reported.
+
+  iterations : 5
+      The number of times to run the command with each runner.
+  '''
+  cmd = _helm_cmd('version', '--client', **kwargs)
+  results = {}
+  for runner in sorted(_RUNNERS):
+    durations = []
+    error = None
+    for _ in range(int(iterations)):
+      result = _run(cmd, runner=runner)
+      if result['retcode'] != 0:
+        error = result['stderr']
+        break
+      durations.append(result['duration'])
+
+    results[runner] = {
+      'min': min(durations) if durations else None,
+      'mean': sum(durations) / len(durations) if durations else None,
+      'max': max(durations) if durations else None,
+    }
+    if error:
+      results[runner]['error'] = error
+  return results
+
+def stats(since=0, fire_event=False, label=None):
+  '''
+  Summarize the helm commands run by this module during the current Salt run:
+  the number of commands and failures, and the total wall time, output size 
+  and time spent parsing output, overall and per helm subcommand, along with
+  the slowest commands. The summary also includes the current `position` in
+  the run's list of commands.
+
+  since : 0
+      Only summarize the commands run from this position onwards; pass the
+      position from an earlier summary to measure the commands run since.
+
+  fire_event : False
+      Also send the summary to the master as a `helm/stats` event, so that
+      it can be aggregated across minions. The `helm_stats.reported` state
+      sends one such event for a whole run.
+
+  label : None
+      An optional label (such as the name of the state being run) to include
+      in the summary.
+  '''
+  commands = __context__.get('helm.stats', [])
+  position = len(commands)
+  commands = commands[int(since):position]
+
+  summary = {
+    'position': position,
+    'commands': len(commands),
+    'failures': 0,
+    'duration': 0.0,
+    'parse_time': 0.0,
+    'stdout_bytes': 0,
+    'by_command': {},
+    'slowest': [],
+  }
+  if label:
+    summary['label'] = label
+
+  for metrics in commands:
+    totals = summary['by_command'].setdefault(metrics['command'], {
+      'commands': 0,
+      'failures': 0,
+      'duration': 0.0,
+      'parse_time': 0.0,
+      'stdout_bytes': 0,
+    })
+    totals['commands'] += 1
+    for target in (summary, totals):
+      target['failures'] += int(metrics['retcode'] != 0)
+      target['duration'] += metrics['duration']
+      target['parse_time'] += metrics['parse_time']
+      target['stdout_bytes'] += metrics['stdout_bytes']
+
+  slowest = sorted(commands, key=lambda metrics: metrics['duration'],
+                   reverse=True)[:5]
+  summary['slowest'] = [dict((key, metrics[key]) for key in 
+                             ('cmd', 'retcode', 'duration', 'parse_time'))
+                        for metrics in slowest]
+
+  if fire_event and commands:
+    try:
+      __salt__['event.send']('helm/stats', summary)
+    except Exception as e:
+      LOG.warning('Unable to send helm stats event: %s', e)
+  return summary
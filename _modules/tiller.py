@@ -0,0 +1,278 @@
+'''
+A read-only client for Tiller's gRPC ReleaseService, used by the helm
+execution module as an optional backend to query releases without spawning
+the helm binary or parsing its human formatted output.
+
+Requires the `grpcio` library and a Tiller installation reachable at a known
+address (the `tiller_host` argument); TLS secured Tiller installations are
+not supported.
+'''
+import logging
+
+from salt.serializers import yaml
+from salt.exceptions import CommandExecutionError
+
+try:
+  import grpc
+  HAS_GRPC = True
+except ImportError:
+  HAS_GRPC = False
+
+LOG = logging.getLogger(__name__)
+
+__virtualname__ = 'tiller'
+
+_SERVICE = '/hapi.services.tiller.ReleaseService/'
+
+_STATUS_CODES = [
+  'UNKNOWN',
+  'DEPLOYED',
+  'DELETED',
+  'SUPERSEDED',
+  'FAILED',
+  'DELETING',
+  'PENDING_INSTALL',
+  'PENDING_UPGRADE',
+  'PENDING_ROLLBACK',
+]
+
+_VARINT = 0
+_FIXED64 = 1
+_LENGTH_DELIMITED = 2
+_FIXED32 = 5
+
+def __virtual__():
+  if not HAS_GRPC:
+    return False, 'The tiller module requires the grpcio library'
+  return __virtualname__
+
+def _encode_varint(value):
+  encoded = bytearray()
+  while True:
+    byte = value & 0x7f
+    value >>= 7
+    if value:
+      encoded.append(byte | 0x80)
+    else:
+      encoded.append(byte)
+      return bytes(encoded)
+
+def _encode_message(fields):
+  '''
+  Encode a protobuf message from a list of (field number, value) tuples; int
+  values are encoded as varints and strings as length-delimited fields.
+  '''
+  encoded = b''
+  for number, value in fields:
+    if isinstance(value, int):
+      encoded += _encode_varint(number << 3 | _VARINT) + _encode_varint(value)
+    else:
+      if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+      encoded += (_encode_varint(number << 3 | _LENGTH_DELIMITED) +
+                  _encode_varint(len(value)) + value)
+  return encoded
+
+def _decode_varint(data, position):
+  value = 0
+  shift = 0
+  while True:
+    byte = data[position]
+    position += 1
+    value |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return value, position
+    shift += 7
+
+def _decode_message(data):
+  '''
+  Decode the top level fields of a protobuf message into a dict of field
+  numbers to lists of raw values: ints for varint fields and bytes for
+  length-delimited fields. Nested messages are left encoded until needed.
+  '''
+  data = bytearray(data)
+  fields = {}
+  position = 0
+  while position < len(data):
+    key, position = _decode_varint(data, position)
+    number, wire_type = key >> 3, key & 0x7
+    if wire_type == _VARINT:
+      value, position = _decode_varint(data, position)
+    elif wire_type == _LENGTH_DELIMITED:
+      length, position = _decode_varint(data, position)
+      value = bytes(data[position:position + length])
+      position += length
+    elif wire_type == _FIXED64:
+      value = bytes(data[position:position + 8])
+      position += 8
+    elif wire_type == _FIXED32:
+      value = bytes(data[position:position + 4])
+      position += 4
+    else:
+      raise CommandExecutionError('Unsupported protobuf wire type %s in '
+                                  'Tiller response' % wire_type)
+    fields.setdefault(number, []).append(value)
+  return fields
+
+def _field(fields, number, default=None):
+  values = fields.get(number)
+  return values[-1] if values else default
+
+def _string(fields, number):
+  value = _field(fields, number)
+  return value.decode('utf-8') if value is not None else None
+
+def _decode_release(data):
+  fields = _decode_message(data)
+  release = {
+    'name': _string(fields, 1),
+    'manifest': _string(fields, 5) or '',
+    'revision': _field(fields, 7, 0),
+    'namespace': _string(fields, 8),
+    'chart': None,
+    'version': None,
+    'status': None,
+    'updated': None,
+    'values': None,
+  }
+
+  info = _field(fields, 2)
+  if info is not None:
+    info = _decode_message(info)
+    last_deployed = _field(info, 3)
+    if last_deployed is not None:
+      release['updated'] = '%s' % _field(_decode_message(last_deployed), 1, 0)
+    status = _field(info, 1)
+    if status is not None:
+      code = _field(_decode_message(status), 1, 0)
+      release['status'] = (_STATUS_CODES[code] if code < len(_STATUS_CODES)
+                           else 'UNKNOWN')
+
+  chart = _field(fields, 3)
+  if chart is not None:
+    metadata = _field(_decode_message(chart), 1)
+    if metadata is not None:
+      metadata = _decode_message(metadata)
+      release['chart'] = _string(metadata, 1)
+      release['version'] = _string(metadata, 4)
+
+  config = _field(fields, 4)
+  if config is not None:
+    raw = _string(_decode_message(config), 1)
+    if raw:
+      release['values'] = yaml.deserialize(raw)
+  return release
+
+def _api_version(**kwargs):
+  version = kwargs.get('tiller_version') or __salt__['config.get'](
+    'helm:client:version', '2.6.2')
+  return version if version.startswith('v') else 'v' + version
+
+def _channel(tiller_host):
+  '''
+  Get the gRPC channel to the supplied Tiller address, opening it only once
+  per Salt run.
+  '''
+  key = 'tiller.channel:%s' % tiller_host
+  if key not in __context__:
+    __context__[key] = grpc.insecure_channel(tiller_host)
+  return __context__[key]
+
+def _call(method, request, tiller_host=None, stream=False, timeout=60,
+          **kwargs):
+  if not tiller_host:
+    raise CommandExecutionError('The tiller_host argument is required to '
+                                'connect to Tiller over gRPC')
+  channel = _channel(tiller_host)
+  if stream:
+    rpc = channel.unary_stream(_SERVICE + method)
+  else:
+    rpc = channel.unary_unary(_SERVICE + method)
+  metadata = [('x-helm-api-client', _api_version(**kwargs))]
+  try:
+    response = rpc(request, timeout=timeout, metadata=metadata)
+    return list(response) if stream else response
+  except grpc.RpcError as e:
+    if e.code() == grpc.StatusCode.UNKNOWN and 'not found' in (e.details() or ''):
+      return None
+    raise CommandExecutionError('Tiller %s call failed: %s' % (
+      method, e.details() or e.code()))
+
+def version(tiller_host=None, **kwargs):
+  '''
+  Get the version of the Tiller installation at the supplied address.
+  '''
+  response = _call('GetVersion', b'', tiller_host=tiller_host, **kwargs)
+  version_message = _field(_decode_message(response), 1)
+  if version_message is None:
+    return None
+  return _string(_decode_message(version_message), 1)
+
+def list_releases(tiller_host=None, page_size=256, **kwargs):
+  '''
+  Get a summary of the latest revision of every release known to Tiller, in
+  any status other than superseded (as with `helm list --all`), formatted the
+  same way as `helm.list_releases`: a dict keyed by release name, with
+  each value a dict with the following keys:
+
+    * name
+    * revision
+    * status
+    * updated
+    * chart
+    * version
+    * namespace
+  '''
+  releases = {}
+  offset = ''
+  while True:
+    request = [(1, int(page_size))]
+    if offset:
+      request.append((2, offset))
+    request += [(6, code) for (code, status) in enumerate(_STATUS_CODES)
+                if status != 'SUPERSEDED']
+    responses = _call('ListReleases', _encode_message(request),
+                      tiller_host=tiller_host, stream=True, **kwargs) or []
+
+    offset = ''
+    for response in responses:
+      fields = _decode_message(response)
+      offset = _string(fields, 2) or offset
+      for data in fields.get(4, []):
+        release = _decode_release(data)
+        del release['manifest'], release['values']
+        existing = releases.get(release['name'])
+        if not existing or existing['revision'] < release['revision']:
+          releases[release['name']] = release
+
+    if not offset or offset in releases:
+      return releases
+
+def get_release(name, tiller_host=None, **kwargs):
+  '''
+  Get the latest revision of the release with the supplied name, or None if
+  no release is found. The returned dict has the following keys:
+
+    * chart
+    * version
+    * values
+    * manifest
+    * namespace
+    * revision
+    * status
+    * updated
+
+  Unlike `helm.get_release`, the computed values are not included since
+  Tiller only computes them when rendering the release.
+  '''
+  response = _call('GetReleaseContent', _encode_message([(1, name)]),
+                   tiller_host=tiller_host, **kwargs)
+  if response is None:
+    return None
+
+  data = _field(_decode_message(response), 1)
+  if data is None:
+    return None
+  release = _decode_release(data)
+  del release['name']
+  return release
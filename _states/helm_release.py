@@ -1,6 +1,17 @@
 import difflib
+import hashlib
+import json
 import os 
 import logging
+import re
+import time
+
+from multiprocessing.pool import ThreadPool
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
 
 from salt.exceptions import CommandExecutionError
 from salt.serializers import yaml
@@ -26,6 +37,193 @@ def _get_yaml_diff(new_yaml=None, old_yaml=None):
   new_str = yaml.serialize(new_yaml, default_flow_style=False)
   return difflib.unified_diff(old_str.split('\n'), new_str.split('\n'))
 
+def _release_hash(chart=None, version=None, namespace=None, values=None):
+  '''
+  Compute a canonical hash of the inputs that determine a release, so that
+  unchanged releases can be detected without serializing and diffing their
+  values.
+  '''
+  canonical = json.dumps({
+    'chart': chart,
+    'version': version,
+    'namespace': namespace,
+    'values': values or {},
+  }, sort_keys=True, separators=(',', ':'), default=str)
+  return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def _release_record_path(name, **kwargs):
+  scope = ':'.join([kwargs.get(key) or '' for key in
+                    ('tiller_host', 'tiller_namespace', 'kube_config', 
+                     'helm_home')])
+  return os.path.join(
+    __opts__['cachedir'], 'helm', 'releases',
+    hashlib.sha1(scope.encode('utf-8')).hexdigest(), '%s.json' % name
+  )
+
+def _release_fingerprint(release_hash, **kwargs):
+  '''
+  Combine the hash of a release's desired state with the content of the 
+  kubeconfig it is applied with, so that pointing the kubeconfig at another
+  cluster invalidates the release's record.
+  '''
+  fingerprint = hashlib.sha256(release_hash.encode('utf-8'))
+  if kwargs.get('kube_config'):
+    try:
+      with open(kwargs['kube_config'], 'rb') as kube_config_stream:
+        fingerprint.update(kube_config_stream.read())
+    except (IOError, OSError):
+      pass
+  return fingerprint.hexdigest()
+
+def _read_release_record(name, **kwargs):
+  try:
+    with open(_release_record_path(name, **kwargs)) as record_stream:
+      return json.load(record_stream)
+  except (IOError, OSError, ValueError):
+    return None
+
+def _write_release_record(name, record, **kwargs):
+  path = _release_record_path(name, **kwargs)
+  try:
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as record_stream:
+      json.dump(record, record_stream)
+    os.rename(tmp_path, path)
+  except (IOError, OSError) as e:
+    LOG.warning("unable to record state of release %s: %s" % (name, e))
+
+def _record_applied(name, fingerprint, **kwargs):
+  '''
+  Record the fingerprint of a release that was just installed or upgraded;
+  its new revision is only recorded once it is next found in the desired 
+  state.
+  '''
+  _write_release_record(name, {
+    'revision': None,
+    'hash': fingerprint,
+    'checked': time.time(),
+  }, **kwargs)
+
+def _record_checked(name, revision, fingerprint, **kwargs):
+  '''
+  Record that a release was found in its desired state at the supplied
+  revision, so that it isn't retrieved again while it stays at it.
+  '''
+  if revision is not None:
+    _write_release_record(name, {
+      'revision': revision,
+      'hash': fingerprint,
+      'checked': time.time(),
+    }, **kwargs)
+
+def _forget_release(name, **kwargs):
+  try:
+    os.remove(_release_record_path(name, **kwargs))
+  except OSError:
+    pass
+
+def _values_dir(values_dir=None):
+  return values_dir or os.path.join(__opts__['cachedir'], 'helm', 'values')
+
+def _values_files(name, values_dir):
+  '''
+  List the values files written for the supplied release by 
+  `_cached_values_file`, along with any written by earlier versions of the
+  formula as `<release>.yaml`.
+  '''
+  pattern = re.compile(r'^%s(-[0-9a-f]{16})?\.yaml$' % re.escape(name))
+  try:
+    return [os.path.join(values_dir, entry) for entry in 
+            os.listdir(values_dir) if pattern.match(entry)]
+  except OSError:
+    return []
+
+def _remove_values_files(name, values_dir=None, keep=None):
+  if __opts__['test']:
+    return
+  for path in _values_files(name, _values_dir(values_dir)):
+    if path != keep:
+      try:
+        os.remove(path)
+      except OSError as e:
+        LOG.debug("unable to remove values file %s: %s" % (path, e))
+
+def _cached_values_file(name, values, values_dir=None):
+  '''
+  Get the path of a values file holding the supplied values, named after a
+  hash of their content (`<values_dir>/<release>-<hash>.yaml`) so that it
+  is only written when the values change. Since values may hold secrets,
+  the file is only readable by the minion's user. Files holding the 
+  release's previous values are removed.
+  '''
+  canonical = json.dumps(values, sort_keys=True, separators=(',', ':'), 
+                         default=str)
+  digest = hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+  values_dir = _values_dir(values_dir)
+  path = os.path.join(values_dir, '%s-%s.yaml' % (name, digest))
+  try:
+    if not os.path.exists(path):
+      if not os.path.isdir(values_dir):
+        os.makedirs(values_dir, 0o700)
+      tmp_path = '%s.%s.tmp' % (path, os.getpid())
+      fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      os.fchmod(fd, 0o600)
+      with os.fdopen(fd, 'w') as values_stream:
+        values_stream.write(yaml.serialize(values, default_flow_style=False))
+      os.rename(tmp_path, path)
+    elif os.stat(path).st_mode & 0o077:
+      # written by an earlier version of the formula, with the umask's mode
+      os.chmod(path, 0o600)
+  except (IOError, OSError) as e:
+    raise CommandExecutionError("encountered error writing values file "
+                                "(%s): %s" % (path, e))
+  _remove_values_files(name, values_dir, keep=path)
+  return path
+
+def _resource_changes(old_resources, new_resources):
+  '''
+  Compare two resource indexes from `helm.release_resources`, returning the
+  keys of the resources that were added, removed or changed.
+  '''
+  changes = {
+    'added': sorted(key for key in new_resources if key not in old_resources),
+    'removed': sorted(key for key in old_resources if key not in new_resources),
+    'changed': sorted(key for key in new_resources if key in old_resources and
+                      new_resources[key] != old_resources[key]),
+  }
+  return dict((kind, keys) for (kind, keys) in changes.items() if keys)
+
+def _release_summary(name, **kwargs):
+  try:
+    return __salt__['helm.list_releases'](**kwargs).get(name)
+  except CommandExecutionError as e:
+    LOG.debug("unable to list releases: %s" % e)
+    return None
+
+def _chart_basename(chart_name):
+  return chart_name.split("/")[-1]
+
+def _release_dependencies(releases):
+  dependencies = {}
+  for release_id, release in releases.items():
+    depends_on = release.get('depends_on') or []
+    if not isinstance(depends_on, list):
+      depends_on = [depends_on]
+    dependencies[release_id] = set(depends_on)
+  return dependencies
+
+def _command_output(result):
+  '''
+  The output of a helm command to report in a state's changes; output too
+  large to embed is referenced by the file it was spooled to.
+  '''
+  output = {'stdout': result.get('stdout')}
+  if result.get('stdout_file'):
+    output['stdout_file'] = result['stdout_file']
+  return output
+
 def _failure(name, message, changes={}):
     return {
         'name': name,
@@ -35,7 +233,9 @@ def _failure(name, message, changes={}):
     }
 
 def present(name, chart_name, namespace, version=None, values_file=None,
-            tiller_namespace='kube-system', **kwargs):
+            values=None, values_dir=None, tiller_namespace='kube-system', 
+            diff_manifests=False, wait=False, timeout=300, atomic=False, 
+            max_history=None, drift_check_interval=0, **kwargs):
     '''
     Ensure that a release with the supplied name is in the desired state in the 
     Tiller installation. This state will handle change detection to determine 
@@ -46,6 +246,15 @@ def present(name, chart_name, namespace, version=None, values_file=None,
     the new namespace, since Helm does not support updating a release into a 
     new namespace.
 
+    Change detection first compares a canonical hash of the release's chart, 
+    version, namespace and values; a diff of the values is only computed for 
+    display when the hashes differ. The hash is recorded in the minion cache 
+    along with the release revision, so a release that hasn't been modified 
+    since it was last found in the desired state is not retrieved again.
+    With `drift_check_interval` set, Tiller isn't queried at all for a 
+    release whose hash (and kubeconfig) is unchanged since it was last 
+    applied or checked, until the interval has passed.
+
     name
         The name of the release to ensure is present
 
@@ -57,21 +266,143 @@ def present(name, chart_name, namespace, version=None, values_file=None,
         The namespace to which the release should be (re-)installed
 
     version
-        The version of the chart to install. Defaults to the latest version
+        The version of the chart to install. Defaults to the latest version,
+        as resolved from the local repository cache; an unpinned release is 
+        only upgraded when a newer chart version is available there
 
     values_file
         The path to the a values file containing all the chart values that 
         should be applied to the release. Note that this should not be passed
         if there are not chart value overrides required.
 
+    values
+        The chart values to apply to the release, as an alternative to 
+        `values_file`. The values are written to a file in `values_dir` 
+        named after a hash of their content, which is only rewritten when 
+        they change (including when running with `test=True`, since the 
+        file is needed to render the upgrade).
+
+    values_dir
+        The directory in which to write the files for `values`. Defaults to
+        `helm/values` in the minion cache directory.
+
+    diff_manifests
+        Before upgrading a release, have Tiller render the upgrade with 
+        `--dry-run` and compare the rendered resources with the release's 
+        current manifest, skipping the upgrade if they are identical. When
+        running with `test=True`, the dry run is always made and the resources
+        that would be added, removed or changed are reported. Defaults to 
+        False.
+
+    wait
+        Wait until the release's pods, PVCs and services are ready after 
+        installing or upgrading it, so that states depending on this one 
+        only run once it has rolled out. Defaults to False.
+
+    timeout
+        The number of seconds to wait for the release to be ready. Defaults
+        to 300.
+
+    atomic
+        Wait for the release to be ready, and roll back an upgrade (or purge
+        a new release) that fails or doesn't become ready in time. Defaults
+        to False.
+
+    max_history
+        The number of revisions of the release to keep in Tiller's storage 
+        after installing or upgrading it, so that Tiller queries stay fast.
+        Defaults to keeping every revision.
+
+    drift_check_interval
+        The number of seconds for which a release whose desired state is 
+        unchanged since it was last applied or checked is assumed to still 
+        be in that state, without querying Tiller; changes made to the 
+        release outside of Salt are only detected once the interval has 
+        passed. Defaults to 0, always checking the release.
+
+    '''
+    since = __salt__['helm.stats']()['position']
+    ret = _present(name, chart_name, namespace, version=version, 
+                   values_file=values_file, values=values, 
+                   values_dir=values_dir, tiller_namespace=tiller_namespace,
+                   diff_manifests=diff_manifests, wait=wait, timeout=timeout,
+                   atomic=atomic, max_history=max_history, 
+                   drift_check_interval=drift_check_interval, **kwargs)
+    ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+    return ret
+
+def absent(name, tiller_namespace='kube-system', values_dir=None, **kwargs):
+    '''
+    Ensure that any release with the supplied release name is absent from the
+    tiller installation.
+
+    name
+        The name of the release to ensure is absent
+
+    values_dir
+        The directory from which to remove any values files written for the
+        release by `present`. Defaults to `helm/values` in the minion cache 
+        directory.
     '''
+    since = __salt__['helm.stats']()['position']
+    ret = _absent(name, tiller_namespace=tiller_namespace, 
+                  values_dir=values_dir, **kwargs)
+    ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+    return ret
+
+def _present(name, chart_name, namespace, version=None, values_file=None,
+             values=None, values_dir=None, tiller_namespace='kube-system', 
+             diff_manifests=False, wait=False, timeout=300, atomic=False, 
+             max_history=None, drift_check_interval=0, **kwargs):
     kwargs['tiller_namespace'] = tiller_namespace
-    old_release = __salt__['helm.get_release'](name, **kwargs)
+    if values_file and values:
+      return _failure(name, 'Only one of values_file and values may be '
+                            'supplied')
+    if version is None:
+      version = __salt__['helm.resolve_chart_version'](chart_name, **kwargs)
+    if values:
+      values_file = _cached_values_file(name, values, values_dir)
+    else:
+      _remove_values_files(name, values_dir, keep=values_file)
+      values = _get_values_from_file(values_file)
+    desired_hash = _release_hash(_chart_basename(chart_name), version, 
+                                 namespace, values)
+    fingerprint = _release_fingerprint(desired_hash, **kwargs)
+
+    #
+    # if the release is still at the revision for which the desired state was
+    # last confirmed, there is no need to retrieve it from Tiller at all
+    #
+    record = _read_release_record(name, **kwargs)
+    if record and record.get('hash') == fingerprint:
+      checked = record.get('checked') or 0
+      if time.time() - checked < float(drift_check_interval or 0):
+        return {
+          'name': name,
+          'result': True,
+          'changes': {},
+          'comment': ('Release "%s" is unchanged since it was last applied; '
+                      'next drift check in %ds' % (
+                        name, checked + float(drift_check_interval) - 
+                        time.time()))
+        }
+      summary = _release_summary(name, **kwargs)
+      if summary and summary.get('revision') == record.get('revision'):
+        _write_release_record(name, dict(record, checked=time.time()), 
+                              **kwargs)
+        return {
+          'name': name,
+          'result': True,
+          'changes': {},
+          'comment': 'Release "{}" is already in the desired state'.format(name)
+        }
+
+    old_release = __salt__['helm.get_release'](
+      name, fields=['chart', 'version', 'namespace', 'revision', 'values'], 
+      **kwargs
+    )
     if not old_release:
-      try:
-        result = __salt__['helm.release_create'](
-            name, chart_name, namespace, version, values_file, **kwargs
-        )
+      if __opts__['test']:
         return {
           'name': name,
           'changes': {
@@ -79,9 +410,28 @@ def present(name, chart_name, namespace, version=None, values_file=None,
             'chart_name': chart_name,
             'namespace': namespace,
             'version': version,
-            'values': _get_values_from_file(values_file),
-            'stdout': result.get('stdout')
+            'values': values,
           },
+          'result': None,
+          'comment': 'Release "%s" would be created' % name
+        }
+      try:
+        result = __salt__['helm.release_create'](
+            name, chart_name, namespace, version, values_file, wait=wait,
+            timeout=timeout, atomic=atomic, max_history=max_history, **kwargs
+        )
+        changes = {
+          'name': name,
+          'chart_name': chart_name,
+          'namespace': namespace,
+          'version': version,
+          'values': values,
+        }
+        changes.update(_command_output(result))
+        _record_applied(name, fingerprint, **kwargs)
+        return {
+          'name': name,
+          'changes': changes,
           'result': True,
           'comment': ('Release "%s" was created' % name + 
                       '\nExecuted command: %s' % result['cmd'])
@@ -91,30 +441,36 @@ def present(name, chart_name, namespace, version=None, values_file=None,
                "\nExecuted command: %s" % e.cmd)
         return _failure(name, msg)
 
+    current_hash = _release_hash(old_release.get('chart'), 
+                                 old_release.get('version'),
+                                 old_release.get('namespace'),
+                                 old_release.get('values'))
     changes = {}
     warnings = []
-    if old_release.get('chart') != chart_name.split("/")[1]:
-      changes['chart'] = { 'old': old_release['chart'], 'new': chart_name }
+    if current_hash != desired_hash:
+      if old_release.get('chart') != _chart_basename(chart_name):
+        changes['chart'] = { 'old': old_release['chart'], 'new': chart_name }
 
-    if old_release.get('version') != version:
-      changes['version'] = { 'old': old_release['version'], 'new': version }
+      if old_release.get('version') != version:
+        changes['version'] = { 'old': old_release['version'], 'new': version }
 
-    if old_release.get('namespace') != namespace:
-        changes['namespace'] = { 'old': old_release['namespace'], 'new': namespace }
+      if old_release.get('namespace') != namespace:
+          changes['namespace'] = { 'old': old_release['namespace'], 'new': namespace }
 
-    if (not values_file and old_release.get("values") or
-        not old_release.get("values") and values_file):
-      changes['values'] = { 'old': old_release['values'], 'new': values_file }
+      if (not values_file and old_release.get("values") or
+          not old_release.get("values") and values_file):
+        changes['values'] = { 'old': old_release['values'], 'new': values_file }
 
-    values = _get_values_from_file(values_file)
-    diff = _get_yaml_diff(values, old_release.get('values'))
-    
-    if diff:
-      diff_string = '\n'.join(diff)
-      if diff_string:
-        changes['values'] = diff_string
+      diff = _get_yaml_diff(values, old_release.get('values'))
+      
+      if diff:
+        diff_string = '\n'.join(diff)
+        if diff_string:
+          changes['values'] = diff_string
 
     if not changes:
+      _record_checked(name, old_release.get('revision'), fingerprint, 
+                      **kwargs)
       return {
         'name': name,
         'result': True,
@@ -122,6 +478,54 @@ def present(name, chart_name, namespace, version=None, values_file=None,
         'comment': 'Release "{}" is already in the desired state'.format(name)
       }
 
+    if changes.get("namespace") and __opts__['test']:
+      return {
+        'name': name,
+        'changes': changes,
+        'result': None,
+        'comment': ('Release "%s" would be replaced due to namespace change' %
+                    name)
+      }
+
+    if diff_manifests or __opts__['test']:
+      try:
+        old_resources = __salt__['helm.release_resources'](name, **kwargs)
+        rendered = __salt__['helm.release_upgrade'](
+          name, chart_name, namespace, version, values_file, dry_run=True,
+          **kwargs
+        )
+      except CommandExecutionError as e:
+        msg = ("Failed to render upgraded release: %s" % e.error +
+               "\nExecuted command: %s" % e.cmd)
+        return _failure(name, msg, changes)
+
+      resource_changes = _resource_changes(old_resources or {}, 
+                                           rendered['resources'])
+      if resource_changes:
+        changes['resources'] = resource_changes
+      elif diff_manifests:
+        # the deployed release is as good as upgraded: skip the dry run too
+        # until it or its desired state changes
+        _record_checked(name, old_release.get('revision'), fingerprint, 
+                        **kwargs)
+        return {
+          'name': name,
+          'result': True,
+          'changes': {},
+          'comment': ('Release "%s" renders the same resources as deployed; '
+                      'skipped upgrade' % name)
+        }
+
+      if __opts__['test']:
+        return {
+          'name': name,
+          'changes': changes,
+          'result': None,
+          'comment': ('Release "%s" would be updated' % name +
+                      ('' if resource_changes else 
+                       '; the rendered resources are unchanged'))
+        }
+
     module_fn = 'helm.release_upgrade'
     if changes.get("namespace"):
       LOG.debug("purging old release (%s) due to namespace change" % name)
@@ -137,9 +541,11 @@ def present(name, chart_name, namespace, version=None, values_file=None,
 
     try:
       result = __salt__[module_fn](
-        name, chart_name, namespace, version, values_file, **kwargs
+        name, chart_name, namespace, version, values_file, wait=wait,
+        timeout=timeout, atomic=atomic, max_history=max_history, **kwargs
       )
-      changes.update({ 'stdout': result.get('stdout') })
+      changes.update(_command_output(result))
+      _record_applied(name, fingerprint, **kwargs)
       ret = {
         'name': name,
         'changes': changes,
@@ -156,15 +562,10 @@ def present(name, chart_name, namespace, version=None, values_file=None,
       return _failure(name, msg, changes)
 
 
-def absent(name, tiller_namespace='kube-system', **kwargs):
-    '''
-    Ensure that any release with the supplied release name is absent from the
-    tiller installation.
-
-    name
-        The name of the release to ensure is absent
-    '''
+def _absent(name, tiller_namespace='kube-system', values_dir=None, 
+            **kwargs):
     kwargs['tiller_namespace'] = tiller_namespace
+    _remove_values_files(name, values_dir)
     exists = __salt__['helm.release_exists'](name, **kwargs)
     if not exists:
         return {
@@ -173,14 +574,547 @@ def absent(name, tiller_namespace='kube-system', **kwargs):
             'result': True,
             'comment': 'Release "%s" doesn\'t exist' % name
         }
+    if __opts__['test']:
+        return {
+            'name': name,
+            'changes': { name: 'DELETED' },
+            'result': None,
+            'comment': 'Release "%s" would be deleted' % name
+        }
     try:
       result = __salt__['helm.release_delete'](name, **kwargs)
+      _forget_release(name, **kwargs)
+      changes = { name: 'DELETED' }
+      changes.update(_command_output(result))
       return {
         'name': name,
-        'changes': { name: 'DELETED', 'stdout': result['stdout'] },
+        'changes': changes,
         'result': True,
         'comment': 'Release "%s" was deleted\nExecuted command: %s' % (name, result['cmd'])
       }
     except CommandExecutionError as e:
       return _failure(e.cmd, e.error)
 
+
+
+def rolled_back(name, revision=None, wait=False, timeout=300, 
+                tiller_namespace='kube-system', **kwargs):
+    '''
+    Ensure that the release with the supplied name has been rolled back to
+    an earlier revision, such as to recover from a bad upgrade. The release
+    is considered rolled back when its latest revision is a rollback to the
+    supplied revision.
+
+    name
+        The name of the release to roll back
+
+    revision
+        The revision to roll the release back to. Defaults to the revision 
+        before the release's latest one, unless the latest revision is 
+        already a rollback.
+
+    wait
+        Wait until the release's pods, PVCs and services are ready after 
+        rolling it back. Defaults to False.
+
+    timeout
+        The number of seconds to wait for the release to be ready. Defaults
+        to 300.
+    '''
+    since = __salt__['helm.stats']()['position']
+    ret = _rolled_back(name, revision=revision, wait=wait, timeout=timeout,
+                       tiller_namespace=tiller_namespace, **kwargs)
+    ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+    return ret
+
+def _rolled_back(name, revision=None, wait=False, timeout=300,
+                 tiller_namespace='kube-system', **kwargs):
+    kwargs['tiller_namespace'] = tiller_namespace
+    try:
+      history = __salt__['helm.release_history'](name, **kwargs)
+    except CommandExecutionError as e:
+      return _failure(name, "Failed to get release history: %s" % e.error +
+                            "\nExecuted command: %s" % e.cmd)
+    if not history:
+      return _failure(name, 'Release "%s" doesn\'t exist' % name)
+
+    latest = history[-1]
+    description = latest.get('description') or ''
+    if revision is None:
+      if description.startswith('Rollback to '):
+        return {
+          'name': name,
+          'changes': {},
+          'result': True,
+          'comment': 'Release "%s" is already rolled back (%s)' % (
+            name, description)
+        }
+      if len(history) < 2:
+        return _failure(name, 'Release "%s" has no earlier revision to roll '
+                              'back to' % name)
+      revision = history[-2]['revision']
+    elif description == 'Rollback to %s' % revision:
+      return {
+        'name': name,
+        'changes': {},
+        'result': True,
+        'comment': 'Release "%s" is already rolled back to revision %s' % (
+          name, revision)
+      }
+    elif not any(entry['revision'] == int(revision) for entry in history):
+      return _failure(name, 'Release "%s" has no revision %s' % (
+        name, revision))
+
+    changes = {'revision': {'old': latest['revision'], 'rolled_back_to': 
+                            int(revision)}}
+    if __opts__['test']:
+      return {
+        'name': name,
+        'changes': changes,
+        'result': None,
+        'comment': 'Release "%s" would be rolled back to revision %s' % (
+          name, revision)
+      }
+    try:
+      result = __salt__['helm.release_rollback'](name, revision, wait=wait, 
+                                                 timeout=timeout, **kwargs)
+    except CommandExecutionError as e:
+      return _failure(name, "Failed to roll back release: %s" % e.error +
+                            "\nExecuted command: %s" % e.cmd)
+    _forget_release(name, **kwargs)
+    changes.update(_command_output(result))
+    return {
+      'name': name,
+      'changes': changes,
+      'result': True,
+      'comment': ('Release "%s" was rolled back to revision %s' % (
+                  name, revision) + '\nExecuted command: %s' % result['cmd'])
+    }
+
+def validated(name, releases, lint=False, concurrency=4, 
+              tiller_namespace='kube-system', **kwargs):
+    '''
+    Ensure that a map of releases is free of the problems that would only 
+    otherwise surface when installing or upgrading each release (see 
+    `helm.validate_releases`), so that states managing the releases can 
+    require this one and no release is touched while any is invalid. Every
+    problem found is reported at once in the comment.
+
+    name
+        The name of the state
+
+    releases
+        A dict of release ids to release definitions, in the same format as
+        for `batch_present`
+
+    lint
+        Also run `helm lint` on each release's chart with its values. 
+        Defaults to False.
+
+    concurrency
+        The number of releases to lint at once. Defaults to 4.
+    '''
+    kwargs['tiller_namespace'] = tiller_namespace
+    since = __salt__['helm.stats']()['position']
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+    try:
+      result = __salt__['helm.validate_releases'](
+        releases, lint=lint, concurrency=concurrency, **kwargs)
+    except CommandExecutionError as e:
+      ret['result'] = False
+      ret['comment'] = 'Failed to validate releases: %s' % e
+      ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+      return ret
+
+    if result['valid']:
+      ret['comment'] = 'All %s releases are valid' % result['checked']
+    else:
+      ret['result'] = False
+      ret['comment'] = '\n'.join(
+        ['%s of %s releases are invalid:' % (len(result['problems']), 
+                                            result['checked'])] +
+        ['%s: %s' % (release_id, problem) for release_id 
+         in sorted(result['problems']) 
+         for problem in result['problems'][release_id]])
+    ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+    return ret
+
+def _reconcile_release(release_id, release, **kwargs):
+  '''
+  Reconcile a single release of a batch, returning its outcome along with
+  the revision it was at beforehand (if any), so a release that doesn't 
+  become ready can be rolled back.
+  '''
+  name = release.get('name', release_id)
+  previous = None
+  if release.get('max_history'):
+    kwargs['max_history'] = release['max_history']
+  try:
+    if release.get('enabled', True):
+      summary = _release_summary(name, **kwargs)
+      previous = summary.get('revision') if summary else None
+      return _present(
+        name, release['chart'], release.get('namespace', 'default'),
+        version=release.get('version'),
+        values_file=release.get('values_file'),
+        values=release.get('values'),
+        **kwargs
+      ), previous
+    return _absent(name, **kwargs), previous
+  except Exception as e:
+    LOG.exception("unexpected error reconciling release %s" % name)
+    return _failure(name, 'Failed to reconcile release: %s' % e), previous
+
+def _revert_release(name, previous, **kwargs):
+  '''
+  Roll a release that didn't become ready back to its previous revision, or
+  purge it if it was newly installed, returning a description of the result.
+  '''
+  _forget_release(name, **kwargs)
+  try:
+    if previous:
+      __salt__['helm.release_rollback'](name, previous, **kwargs)
+      return 'rolled back to revision %s' % previous
+    __salt__['helm.release_delete'](name, **kwargs)
+    return 'purged'
+  except CommandExecutionError as e:
+    return 'failed to revert: %s' % getattr(e, 'error', e)
+
+def _poll_readiness(releases, watching, outcomes, **kwargs):
+  '''
+  Check the readiness of every release being waited for with a single call,
+  moving those that are ready, or whose deadline has passed, to the 
+  outcomes.
+  '''
+  names = dict((release_id, releases[release_id].get('name', release_id))
+               for release_id in watching)
+  error = None
+  try:
+    readiness = __salt__['helm.release_readiness'](
+      sorted(names.values()), **kwargs)
+  except CommandExecutionError as e:
+    LOG.debug("unable to check release readiness: %s" % e)
+    error = '%s' % e
+    readiness = {}
+
+  now = time.time()
+  for release_id, watch in list(watching.items()):
+    name = names[release_id]
+    status = readiness.get(name) or {'ready': False, 'pending': []}
+    outcome = watch['outcome']
+    if status['ready']:
+      outcome['comment'] += '\nRelease was ready after %.1fs' % (
+        now - watch['started'])
+    elif now >= watch['deadline']:
+      message = 'Release was not ready in time; pending resources: %s' % (
+        ', '.join(status['pending']) or 'unknown')
+      if error:
+        message += ' (the last readiness check failed: %s)' % error
+      if watch['atomic']:
+        message += '; release was %s' % _revert_release(
+          name, watch['previous'], **kwargs)
+      outcome = _failure(name, outcome['comment'] + '\n' + message,
+                         outcome['changes'])
+    else:
+      continue
+    outcomes[release_id] = outcome
+    del watching[release_id]
+
+def batch_present(name, releases, concurrency=4, wait=False, timeout=300,
+                  atomic=False, poll_interval=5, 
+                  tiller_namespace='kube-system', **kwargs):
+    '''
+    Ensure every release in the supplied map is in its desired state, running 
+    the installs, upgrades and deletions of independent releases concurrently
+    rather than one after another. Each release is reconciled exactly as the
+    `present` (or, if disabled, `absent`) state would, and the outcome for
+    every release is reported in this single state return.
+
+    A release is only started once all of the releases it depends on have 
+    been reconciled successfully; releases whose dependencies failed are 
+    reported as failed without being touched. When waiting for releases to
+    be ready, a release's dependencies must also have rolled out; rather 
+    than blocking on each release, the readiness of every release being 
+    waited for is polled together with a single `helm.release_readiness` 
+    call per interval.
+
+    name
+        The name of the state
+
+    releases
+        A dict of release ids to release definitions, in the same format as
+        the `helm:client:releases` pillar. Each definition supports the keys:
+
+          * name: the release name, defaulting to the release id
+          * chart: the chart to install, such as `stable/mysql`
+          * namespace: the namespace to install to, defaulting to `default`
+          * version: the chart version to install
+          * values_file: the path to the values file for the release
+          * values: the chart values for the release, as an alternative to
+            `values_file` (see `present`)
+          * enabled: whether the release should be present, defaulting to 
+            true
+          * depends_on: a release id, or list of release ids, that must be 
+            reconciled before this release
+          * wait, timeout, atomic: override the batch's settings below for
+            this release
+          * max_history: the number of revisions of the release to keep in
+            Tiller's storage (see `present`)
+
+    concurrency
+        The maximum number of releases to reconcile at the same time. 
+        Defaults to 4.
+
+    wait
+        Wait for installed or upgraded releases to be ready before 
+        considering them reconciled. Defaults to False.
+
+    timeout
+        The number of seconds to wait for each release to be ready. Defaults
+        to 300.
+
+    atomic
+        Wait for installed or upgraded releases to be ready, rolling back 
+        (or purging, if newly installed) those that don't become ready in 
+        time. Defaults to False.
+
+    poll_interval
+        The number of seconds between readiness polls. Defaults to 5.
+    '''
+    since = __salt__['helm.stats']()['position']
+    ret = _batch_present(name, releases, concurrency=concurrency, wait=wait,
+                         timeout=timeout, atomic=atomic, 
+                         poll_interval=poll_interval,
+                         tiller_namespace=tiller_namespace, **kwargs)
+    ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+    return ret
+
+def _batch_present(name, releases, concurrency=4, wait=False, timeout=300,
+                   atomic=False, poll_interval=5, 
+                   tiller_namespace='kube-system', **kwargs):
+    kwargs['tiller_namespace'] = tiller_namespace
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+
+    waiting = sorted(
+      release.get('name', release_id) for (release_id, release)
+      in releases.items() if release.get('enabled', True) and
+      (release.get('wait', wait) or release.get('atomic', atomic)))
+    if waiting and not __salt__['cmd.which']('kubectl'):
+      ret['result'] = False
+      ret['comment'] = ('kubectl is required to wait for releases (%s) but '
+                        'was not found on the PATH; install it, such as by '
+                        'setting helm:client:kubectl:install' % 
+                        ', '.join(waiting))
+      return ret
+
+    dependencies = _release_dependencies(releases)
+    outcomes = {}
+    for release_id, depends_on in dependencies.items():
+      unknown = [dep for dep in depends_on if dep not in releases]
+      if unknown:
+        outcomes[release_id] = _failure(
+          releases[release_id].get('name', release_id),
+          'Release depends on unknown releases: %s' % ', '.join(unknown))
+
+    pending = dict((release_id, depends_on) for (release_id, depends_on)
+                   in dependencies.items() if release_id not in outcomes)
+    finished = queue.Queue()
+    pool = ThreadPool(max(1, int(concurrency)))
+    running = 0
+    watching = {}
+    next_poll = None
+    try:
+      while pending or running or watching:
+        for release_id, depends_on in sorted(pending.items()):
+          failed = [dep for dep in depends_on
+                    if dep in outcomes and outcomes[dep]['result'] is False]
+          if failed:
+            del pending[release_id]
+            outcomes[release_id] = _failure(
+              releases[release_id].get('name', release_id),
+              'Not reconciled because dependencies failed: %s' % 
+              ', '.join(sorted(failed)))
+            continue
+
+          if not all(dep in outcomes for dep in depends_on):
+            continue
+
+          del pending[release_id]
+          running += 1
+          pool.apply_async(
+            __salt__['helm.in_context'](_reconcile_release),
+            (release_id, releases[release_id]), kwargs,
+            callback=lambda result, release_id=release_id: 
+              finished.put((release_id, result))
+          )
+
+        if not running and not watching:
+          for release_id in pending:
+            outcomes[release_id] = _failure(
+              releases[release_id].get('name', release_id),
+              'Release has circular dependencies: %s' % 
+              ', '.join(sorted(pending[release_id])))
+          break
+
+        try:
+          release_id, (outcome, previous) = finished.get(
+            timeout=max(0, next_poll - time.time()) if watching else None)
+          running -= 1
+          release = releases[release_id]
+          release_atomic = release.get('atomic', atomic)
+          if (outcome['result'] and outcome['changes'] and 
+              release.get('enabled', True) and 
+              (release.get('wait', wait) or release_atomic)):
+            watching[release_id] = {
+              'outcome': outcome,
+              'previous': previous,
+              'atomic': release_atomic,
+              'started': time.time(),
+              'deadline': time.time() + float(release.get('timeout', timeout)),
+            }
+            next_poll = time.time()
+          else:
+            outcomes[release_id] = outcome
+        except queue.Empty:
+          pass
+
+        if watching and time.time() >= next_poll:
+          _poll_readiness(releases, watching, outcomes, **kwargs)
+          next_poll = time.time() + float(poll_interval)
+    finally:
+      pool.close()
+      pool.join()
+
+    comments = []
+    for release_id in sorted(outcomes):
+      outcome = outcomes[release_id]
+      release_name = releases[release_id].get('name', release_id)
+      if outcome['result'] is False:
+        ret['result'] = False
+      elif outcome['result'] is None and ret['result'] is True:
+        ret['result'] = None
+      if outcome['changes'] or outcome['result'] is False:
+        ret['changes'][release_name] = {
+          'result': outcome['result'],
+          'changes': outcome['changes'],
+          'comment': outcome['comment'],
+        }
+      comments.append('%s: %s' % (release_name, outcome['comment']))
+
+    ret['comment'] = '\n'.join(comments)
+    return ret
+
+def _cluster_present(cluster_id, cluster, releases, helm_home=None, 
+                     **kwargs):
+  '''
+  Reconcile the supplied releases, with the cluster's own release overrides
+  merged over them, in a single cluster from its own helm home.
+  '''
+  cluster_releases = dict((release_id, dict(release)) for (release_id, release)
+                          in releases.items())
+  for release_id, overrides in (cluster.get('releases') or {}).items():
+    cluster_releases.setdefault(release_id, {}).update(overrides)
+
+  cluster_kwargs = dict(kwargs)
+  if cluster.get('tiller_host') or cluster.get('tiller_namespace'):
+    cluster_kwargs.pop('tiller_host', None)
+    cluster_kwargs.pop('tiller_namespace', None)
+  for key in ('kube_config', 'tiller_host', 'tiller_namespace',
+              'gce_service_token'):
+    if cluster.get(key):
+      cluster_kwargs[key] = cluster[key]
+  cluster_kwargs['helm_home'] = cluster.get('helm_home') or os.path.join(
+    helm_home or os.path.expanduser('~/.helm'), 'clusters', cluster_id)
+  cluster_kwargs['values_dir'] = os.path.join(
+    _values_dir(kwargs.get('values_dir')), 'clusters', cluster_id)
+
+  try:
+    __salt__['helm.prepare_home'](cluster_kwargs['helm_home'], 
+                                  repository_home=helm_home)
+    return _batch_present(cluster_id, cluster_releases, **cluster_kwargs)
+  except Exception as e:
+    LOG.exception("unexpected error reconciling cluster %s" % cluster_id)
+    return _failure(cluster_id, 'Failed to reconcile cluster: %s' % e)
+
+def clusters_present(name, clusters, releases, cluster_concurrency=4, 
+                     helm_home=None, **kwargs):
+    '''
+    Ensure the same set of releases is in its desired state in each of the 
+    supplied clusters, reconciling several clusters at once. Each cluster is
+    reconciled as by `batch_present`, from its own helm home that shares the
+    repositories of the main helm home, and the outcome for every cluster is
+    reported in this single state return.
+
+    name
+        The name of the state
+
+    clusters
+        A dict of cluster ids to cluster definitions, each supporting the 
+        keys:
+
+          * kube_config: the path to the cluster's kubeconfig
+          * tiller_host or tiller_namespace: how to reach the cluster's Tiller
+          * gce_service_token: the path to the cluster's GCE service token
+          * helm_home: the cluster's helm home, defaulting to the 
+            `clusters/<cluster id>` directory of the main helm home
+          * releases: a dict of release ids to release definition keys that
+            override (or add to) the shared releases in this cluster
+
+    releases
+        The releases to reconcile in every cluster, in the same format as for
+        `batch_present`
+
+    cluster_concurrency
+        The maximum number of clusters to reconcile at the same time. The 
+        number of releases reconciled at once within each cluster is capped 
+        separately by `concurrency`. Defaults to 4.
+
+    helm_home
+        The main helm home, whose repositories are shared by every cluster
+
+    Any other arguments (such as `concurrency`, `wait` or `atomic`) are 
+    passed on to `batch_present` for every cluster; `kube_config`, 
+    `tiller_host` or `tiller_namespace`, and `gce_service_token` only apply
+    to the clusters that don't set their own.
+    '''
+    ret = {'name': name,
+           'changes': {},
+           'result': True,
+           'comment': ''}
+    since = __salt__['helm.stats']()['position']
+
+    cluster_ids = sorted(cluster_id for (cluster_id, cluster) 
+                         in clusters.items() 
+                         if (cluster or {}).get('enabled', True))
+    pool = ThreadPool(max(1, min(int(cluster_concurrency), 
+                                 len(cluster_ids) or 1)))
+    try:
+      outcomes = pool.map(
+        __salt__['helm.in_context'](lambda cluster_id: _cluster_present(
+          cluster_id, clusters[cluster_id] or {}, releases, 
+          helm_home=helm_home, **kwargs)),
+        cluster_ids)
+    finally:
+      pool.close()
+      pool.join()
+
+    comments = []
+    for cluster_id, outcome in zip(cluster_ids, outcomes):
+      if outcome['result'] is False:
+        ret['result'] = False
+      elif outcome['result'] is None and ret['result'] is True:
+        ret['result'] = None
+      if outcome['changes']:
+        ret['changes'][cluster_id] = outcome['changes']
+      comments.append('Cluster %s:\n  %s' % (
+        cluster_id, outcome['comment'].replace('\n', '\n  ')))
+
+    ret['comment'] = '\n'.join(comments)
+    ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+    return ret
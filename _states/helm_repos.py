@@ -2,7 +2,8 @@ import re
 
 from salt.exceptions import CommandExecutionError
 
-def managed(name, present={}, absent=[], exclusive=False, helm_home=None):
+def managed(name, present={}, absent=[], exclusive=False, helm_home=None,
+            batch=False):
   '''
   Ensure the supplied repositories are available to the helm client. If the
   `exclusive` flag is set to a truthy value, any extra repositories in the 
@@ -24,7 +25,20 @@ def managed(name, present={}, absent=[], exclusive=False, helm_home=None):
 
   helm_home
       An optional path to the Helm home directory 
+
+  batch
+      A boolean flag indicating whether all additions and removals should be
+      applied with a single rewrite of the repositories file, fetching the
+      indexes of new repositories concurrently.
   '''
+  since = __salt__['helm.stats']()['position']
+  ret = _managed(name, present=present, absent=absent, exclusive=exclusive,
+                 helm_home=helm_home, batch=batch)
+  ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+  return ret
+
+def _managed(name, present={}, absent=[], exclusive=False, helm_home=None,
+             batch=False):
   ret = {'name': name,
          'changes': {},
          'result': True,
@@ -35,7 +49,8 @@ def managed(name, present={}, absent=[], exclusive=False, helm_home=None):
       present=present, 
       absent=absent, 
       exclusive=exclusive,
-      helm_home=helm_home
+      helm_home=helm_home,
+      batch=batch
     )
 
     if result['failed']:
@@ -50,14 +65,35 @@ def managed(name, present={}, absent=[], exclusive=False, helm_home=None):
       return ret
 
     ret['comment'] = ("Repositories were in the desired state: "
-                     "%s" % [name for (name, url) in present.iteritems()])
+                     "%s" % [name for (name, url) in present.items()])
     return ret
   except CommandExecutionError as e:
     ret['result'] = False
     ret['comment'] = "Failed to add some repositories: %s" % e
     return ret
 
-def updated(name, helm_home=None):
+def _conditional_update(ret, helm_home=None, ttl=0):
+  result = __salt__['helm.update_repos'](
+    conditional=True, ttl=ttl, helm_home=helm_home)
+
+  timings = ["%s: %s (%.2fs)" % (repo, details['status'], details['duration'])
+             for (repo, details) in sorted(result['repos'].items())]
+  ret['comment'] = ("Updated %s, skipped %s and failed to update %s "
+                    "repositories:\n" % (len(result['updated']), 
+                                         len(result['skipped']), 
+                                         len(result['failed'])) +
+                    "\n".join(timings))
+
+  if result['updated']:
+    ret['changes']['updated'] = result['updated']
+
+  if result['failed']:
+    ret['result'] = False
+    ret['changes']['failed'] = dict(
+      (repo, result['repos'][repo].get('error')) for repo in result['failed'])
+  return ret
+
+def updated(name, helm_home=None, conditional=False, ttl=0):
   '''
   Ensure the local Helm repository cache is up to date with each of the 
   helm client's configured remote chart repositories. Because the `helm repo 
@@ -66,17 +102,44 @@ def updated(name, helm_home=None):
   an update from one or more of the repositories, regardless of whether an 
   update was made to the local Helm chart repository cache.
 
+  If `conditional` is set, each repository index is instead only downloaded
+  if it changed upstream, and the state reports which repositories were
+  updated, skipped or failed along with the time spent on each.
+
   name
       The name of the state
 
   helm_home
       An optional path to the Helm home directory 
+
+  conditional
+      Whether to only download repository indexes that changed upstream, 
+      using their ETag and Last-Modified headers. Defaults to False.
+
+  ttl
+      When `conditional` is set, the number of seconds after a repository
+      index was last checked during which it isn't checked again. Defaults
+      to 0.
   '''
+  since = __salt__['helm.stats']()['position']
+  ret = _updated(name, helm_home=helm_home, conditional=conditional,
+                 ttl=ttl)
+  ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+  return ret
+
+def _updated(name, helm_home=None, conditional=False, ttl=0):
   ret = {'name': name,
          'changes': {},
          'result': True,
          'comment': 'Successfully synced repositories: ' }
   
+  if conditional:
+    try:
+      return _conditional_update(ret, helm_home=helm_home, ttl=ttl)
+    except CommandExecutionError as e:
+      ret['result'] = False
+      ret['comment'] = "Failed to update repos: %s" % e
+      return ret
 
   try:
     result = __salt__['helm.update_repos'](helm_home=helm_home)
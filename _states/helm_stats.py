@@ -0,0 +1,24 @@
+def reported(name):
+  '''
+  Send a summary of every helm command run during this Salt run (see 
+  `helm.stats`) to the master as a single `helm/stats` event, so that the
+  cost of helm runs can be aggregated across minions. Order this state last
+  (`- order: last`) so that it covers the whole run.
+  '''
+  ret = {'name': name,
+         'changes': {},
+         'result': True,
+         'comment': ''}
+
+  if __opts__['test']:
+    summary = __salt__['helm.stats'](label=name)
+    ret['result'] = None
+    ret['comment'] = 'The stats of %s helm commands would be reported' % (
+      summary['commands'])
+    return ret
+
+  summary = __salt__['helm.stats'](fire_event=True, label=name)
+  ret['stats'] = summary
+  ret['comment'] = ('Reported %s helm commands (%s failed) taking %.2fs' % (
+    summary['commands'], summary['failures'], summary['duration']))
+  return ret
@@ -0,0 +1,49 @@
+def ready(name, timeout=30, initial_delay=0.5, max_delay=5,
+          tiller_namespace='kube-system', **kwargs):
+  '''
+  Ensure Tiller is answering requests, waiting for it with exponential
+  backoff (such as after installing or upgrading it) until the supplied
+  timeout. The time taken for Tiller to become ready is reported in the
+  comment. When running with `test=True`, Tiller is probed only once.
+
+  name
+      The name of the state
+
+  timeout
+      The number of seconds to wait for Tiller. Defaults to 30.
+
+  initial_delay
+      The upper bound in seconds of the wait after the first failed probe,
+      doubled after each subsequent failure. Defaults to 0.5.
+
+  max_delay
+      The maximum upper bound in seconds of the wait between probes. Defaults
+      to 5.
+  '''
+  kwargs['tiller_namespace'] = tiller_namespace
+  ret = {'name': name,
+         'changes': {},
+         'result': True,
+         'comment': ''}
+  since = __salt__['helm.stats']()['position']
+
+  result = __salt__['helm.wait_for_tiller'](
+    timeout=0 if __opts__['test'] else timeout,
+    initial_delay=initial_delay,
+    max_delay=max_delay,
+    **kwargs
+  )
+
+  if result['ready']:
+    ret['comment'] = ('Tiller %s was ready after %.2fs (%s attempts)' % (
+      result['version'], result['duration'], result['attempts']))
+  elif __opts__['test']:
+    ret['result'] = None
+    ret['comment'] = ('Tiller is not ready yet; would wait up to %ss for it: '
+                      '%s' % (timeout, result['error']))
+  else:
+    ret['result'] = False
+    ret['comment'] = ('Tiller was not ready after %.2fs (%s attempts): %s' % (
+      result['duration'], result['attempts'], result['error']))
+  ret['stats'] = __salt__['helm.stats'](since=since, label=name)
+  return ret
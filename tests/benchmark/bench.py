@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+'''
+Benchmarks for the helm execution module and the helm_release and helm_repos
+states. The modules are loaded outside of Salt with a minimal `__salt__`, and
+run against fake_helm.py (installed as `helm` on a temporary PATH) and local
+file:// chart repositories, generated at the requested sizes:
+
+  python tests/benchmark/bench.py --releases 1000 --manifest-size 1M \
+    --repos 20 --output results.json
+
+Each scenario reports the minimum, median and maximum wall time over the
+requested iterations, along with the peak memory allocated by a separate
+traced run (on Python 3). Passing the results of an earlier run with
+`--baseline` adds the ratio of each median to the baseline's, making
+regressions visible at a glance.
+
+The helm module imports salt, so run this from an environment with salt
+installed, such as the virtualenv created by `run_tests.sh prepare`.
+'''
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+import yaml
+
+CURDIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(os.path.dirname(CURDIR))
+
+def load_module(name, path):
+  if sys.version_info[0] < 3:
+    import imp
+    return imp.load_source(name, path)
+  import importlib.util
+  spec = importlib.util.spec_from_file_location(name, path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+def parse_size(size):
+  units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+  size = size.strip().upper().rstrip('B')
+  if size and size[-1] in units:
+    return int(float(size[:-1]) * units[size[-1]])
+  return int(size)
+
+def regex_parse_release(helm, output):
+  '''
+  The regular expression based parsing of `helm get` output that
+  `helm._parse_release` replaced, kept to compare the two: every section is
+  found with its own search over the whole output.
+  '''
+  result = {}
+  chart_match = re.search(r'CHART\: ([^0-9]+)-([^\s]+)', output)
+  if chart_match:
+    result['chart'] = chart_match.group(1)
+    result['version'] = chart_match.group(2)
+
+  user_values_match = re.search(r"(?<=USER-SUPPLIED VALUES\:\n)(\n*.+)+?(?=\n*COMPUTED VALUES\:)", output, re.MULTILINE)
+  if user_values_match:
+    result['values'] = helm.yaml.deserialize(user_values_match.group(0))
+
+  computed_values_match = re.search(r"(?<=COMPUTED VALUES\:\n)(\n*.+)+?(?=\n*HOOKS\:)", output, re.MULTILINE)
+  if computed_values_match:
+    result['computed_values'] = helm.yaml.deserialize(
+      computed_values_match.group(0))
+
+  manifest_match = re.search(r"(?<=MANIFEST\:\n)(\n*(?!Release \".+\" has been upgraded).*)+", output, re.MULTILINE)
+  if manifest_match:
+    result['manifest'] = manifest_match.group(0)
+
+  namespace_match = re.search(r"(?<=NAMESPACE\: )(.*)", output)
+  if namespace_match:
+    result['namespace'] = namespace_match.group(0)
+
+  return result
+
+class Environment(object):
+  '''
+  A scratch directory holding the fake helm binary, the helm home (also
+  exported as $HELM_HOME, so that nothing falls back to ~/.helm) and the
+  generated chart repositories, along with the loaded modules sharing a
+  `__salt__` and a `__context__` as they would within a Salt run.
+  '''
+  def __init__(self, args):
+    self.args = args
+    self.root = tempfile.mkdtemp(prefix='helm-bench-')
+    self.bin_dir = os.path.join(self.root, 'bin')
+    self.cachedir = os.path.join(self.root, 'minion-cache')
+    self.repos_dir = os.path.join(self.root, 'repos')
+    os.makedirs(self.bin_dir)
+    os.makedirs(self.cachedir)
+
+    helm = os.path.join(self.bin_dir, 'helm')
+    shutil.copy(os.path.join(CURDIR, 'fake_helm.py'), helm)
+    os.chmod(helm, os.stat(helm).st_mode | stat.S_IEXEC | stat.S_IXGRP |
+             stat.S_IXOTH)
+    os.environ['PATH'] = self.bin_dir + os.pathsep + os.environ['PATH']
+    os.environ['FAKE_HELM_RELEASES'] = '%s' % args.releases
+    os.environ['FAKE_HELM_MANIFEST_SIZE'] = '%s' % args.manifest_size
+    os.environ['FAKE_HELM_VALUES'] = '%s' % args.values
+
+    self.repos = self._generate_repos()
+    self.home = self.helm_home('helm-home', repos=self.repos)
+    os.environ['HELM_HOME'] = self.home
+    self.config = {
+      'helm:client:runner': 'subprocess',
+      'helm:client:release_cache_size': 0,
+    }
+    self.salt = {
+      'config.get': lambda key, default=None: self.config.get(key, default),
+      'event.send': lambda tag, data: True,
+    }
+    self.helm = self._load('helm', '_modules/helm.py')
+    self.helm_release = self._load('helm_release', '_states/helm_release.py')
+    self.helm_repos = self._load('helm_repos', '_states/helm_repos.py')
+    for name in dir(self.helm):
+      function = getattr(self.helm, name)
+      if callable(function) and not name.startswith('_'):
+        self.salt['helm.%s' % name] = function
+    self.reset()
+
+  def _load(self, name, path):
+    module = load_module('bench_%s' % name, os.path.join(ROOT, path))
+    module.__salt__ = self.salt
+    module.__opts__ = {'test': False, 'cachedir': self.cachedir}
+    return module
+
+  def _generate_repos(self):
+    repos = {}
+    entries = {'chart': [{
+      'name': 'chart',
+      'version': '1.%s.0' % minor,
+      'urls': ['chart-1.%s.0.tgz' % minor],
+      'digest': '0' * 64,
+    } for minor in range(20)]}
+    for index in range(self.args.repos):
+      name = 'repo-%03d' % index
+      path = os.path.join(self.repos_dir, name)
+      os.makedirs(path)
+      with open(os.path.join(path, 'index.yaml'), 'w') as stream:
+        yaml.safe_dump({'apiVersion': 'v1', 'entries': entries}, stream)
+      repos[name] = 'file://' + path
+    return repos
+
+  def reset(self):
+    '''
+    Start a new "Salt run": every module gets a fresh, shared __context__
+    '''
+    context = {}
+    for module in (self.helm, self.helm_release, self.helm_repos):
+      module.__context__ = context
+
+  def helm_home(self, name='home', repos=None):
+    '''
+    Create an empty helm home, optionally with the supplied repositories
+    already registered and their indexes cached.
+    '''
+    home = os.path.join(self.root, name)
+    if os.path.isdir(home):
+      shutil.rmtree(home)
+    cache = os.path.join(home, 'repository', 'cache')
+    os.makedirs(cache)
+    registered = []
+    for repo in sorted(repos or []):
+      cache_file = os.path.join(cache, '%s-index.yaml' % repo)
+      shutil.copy(os.path.join(self.repos_dir, repo, 'index.yaml'), cache_file)
+      registered.append({'name': repo, 'url': self.repos[repo],
+                         'cache': cache_file, 'caFile': '', 'certFile': '',
+                         'keyFile': ''})
+    with open(os.path.join(home, 'repository', 'repositories.yaml'),
+              'w') as stream:
+      yaml.safe_dump({'apiVersion': 'v1', 'repositories': registered}, stream)
+    return home
+
+  def values_file(self, index):
+    path = os.path.join(self.root, 'values-%s.yaml' % index)
+    with open(path, 'w') as stream:
+      yaml.safe_dump(dict(('key%03d' % i, 'value-%s-%s' % (index, i))
+                          for i in range(self.args.values)), stream)
+    return path
+
+  def cleanup(self):
+    shutil.rmtree(self.root, ignore_errors=True)
+
+def scenarios(env):
+  '''
+  Build the list of (name, setup, run) benchmarks; setup is called before
+  every iteration, outside of the measurement, and returns the argument
+  passed to run.
+  '''
+  helm = env.helm
+  helm_release = env.helm_release
+  helm_repos = env.helm_repos
+  last = 'release-%05d' % (env.args.releases - 1)
+  repo_names = sorted(env.repos)
+
+  sample = {}
+  def release_output():
+    if 'get' not in sample:
+      sample['get'] = helm._run(helm._helm_cmd(
+        'get', last, helm_home=env.home))['stdout']
+    return sample['get']
+
+  def list_output():
+    if 'list' not in sample:
+      sample['list'] = helm._run(helm._helm_cmd(
+        'list', '--all', '--max', '%s' % env.args.releases,
+        helm_home=env.home))['stdout']
+    return sample['list']
+
+  def cached_home():
+    return env.helm_home(repos=repo_names)
+
+  def recorded_present():
+    env.reset()
+    values_file = env.values_file(env.args.releases - 1)
+    helm_release.present(last, 'repo-000/chart', 'default', version='1.0.0',
+                         values_file=values_file, helm_home=env.home)
+    return values_file
+
+  def cold_present():
+    shutil.rmtree(os.path.join(env.cachedir, 'helm'), ignore_errors=True)
+    return env.values_file(env.args.releases - 1)
+
+  return [
+    ('parse_release_list', list_output,
+     lambda output: helm._parse_release_list(output)),
+    ('parse_release', release_output,
+     lambda output: helm._parse_release(output)),
+    ('parse_release_manifest', release_output,
+     lambda output: helm._parse_release(output, ['manifest'])),
+    ('parse_release_regex', release_output,
+     lambda output: regex_parse_release(helm, output)),
+    ('manifest_index', release_output,
+     lambda output: helm._manifest_index(
+       helm._parse_release(output, ['manifest'])['manifest'])),
+    ('list_releases', None,
+     lambda _: helm.list_releases(helm_home=env.home)),
+    ('get_release', None,
+     lambda _: helm.get_release(last, helm_home=env.home)),
+    ('get_release_values', None,
+     lambda _: helm.get_release(last, fields=['values'],
+                                helm_home=env.home)),
+    ('release_resources', None,
+     lambda _: helm.release_resources(last, helm_home=env.home)),
+    ('release_upgrade_dry_run', None,
+     lambda _: helm.release_upgrade(last, 'repo-000/chart', version='1.0.0',
+                                    dry_run=True, helm_home=env.home)),
+    ('manage_repos', lambda: env.helm_home(),
+     lambda home: helm.manage_repos(present=dict(env.repos), helm_home=home)),
+    ('manage_repos_batch', lambda: env.helm_home(),
+     lambda home: helm.manage_repos(present=dict(env.repos), batch=True,
+                                    helm_home=home)),
+    ('update_repos', cached_home,
+     lambda home: helm.update_repos(helm_home=home)),
+    ('update_repos_conditional', cached_home,
+     lambda home: helm.update_repos(conditional=True, helm_home=home)),
+    ('resolve_chart_version', cached_home,
+     lambda home: helm.resolve_chart_version('repo-000/chart',
+                                             helm_home=home)),
+    ('helm_release.present', cold_present,
+     lambda values_file: helm_release.present(
+       last, 'repo-000/chart', 'default', version='1.0.0',
+       values_file=values_file, helm_home=env.home)),
+    ('helm_release.present_recorded', recorded_present,
+     lambda values_file: helm_release.present(
+       last, 'repo-000/chart', 'default', version='1.0.0',
+       values_file=values_file, helm_home=env.home)),
+    ('helm_repos.managed_batch', lambda: env.helm_home(),
+     lambda home: helm_repos.managed('repos', present=dict(env.repos),
+                                     helm_home=home, batch=True)),
+  ]
+
+def measure(env, setup, run, iterations):
+  durations = []
+  for _ in range(iterations):
+    argument = setup() if setup else None
+    env.reset()
+    start = time.time()
+    run(argument)
+    durations.append(time.time() - start)
+
+  peak = None
+  if tracemalloc is not None:
+    argument = setup() if setup else None
+    env.reset()
+    tracemalloc.start()
+    try:
+      run(argument)
+      peak = tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+
+  durations.sort()
+  return {
+    'min': durations[0],
+    'median': durations[len(durations) // 2],
+    'max': durations[-1],
+    'peak_memory': peak,
+  }
+
+def report(results, baseline):
+  print('%-32s %10s %10s %10s %12s %8s' % (
+    'scenario', 'min ms', 'median ms', 'max ms', 'peak KiB', 'ratio'))
+  for name, result in results:
+    if 'error' in result:
+      print('%-32s error: %s' % (name, result['error']))
+      continue
+    ratio = ''
+    previous = baseline.get(name) or {}
+    if previous.get('median'):
+      ratio = '%.2fx' % (result['median'] / previous['median'])
+    print('%-32s %10.1f %10.1f %10.1f %12s %8s' % (
+      name, result['min'] * 1000, result['median'] * 1000,
+      result['max'] * 1000,
+      '%.0f' % (result['peak_memory'] / 1024.0)
+      if result['peak_memory'] is not None else '-', ratio))
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                   formatter_class=argparse.RawTextHelpFormatter)
+  parser.add_argument('--releases', type=int, default=100,
+                      help='number of installed releases (default 100)')
+  parser.add_argument('--manifest-size', type=parse_size, default='10K',
+                      help='size of each release manifest, such as 1K or 10M '
+                           '(default 10K)')
+  parser.add_argument('--values', type=int, default=20,
+                      help='number of values set on each release (default 20)')
+  parser.add_argument('--repos', type=int, default=10,
+                      help='number of chart repositories (default 10)')
+  parser.add_argument('--iterations', type=int, default=5,
+                      help='timed runs of each scenario (default 5)')
+  parser.add_argument('--only', action='append', default=[],
+                      help='only run scenarios whose name contains this; may '
+                           'be repeated')
+  parser.add_argument('--output', help='write the results as JSON to this file')
+  parser.add_argument('--baseline', help='compare with the JSON results of an '
+                                         'earlier run')
+  args = parser.parse_args()
+
+  baseline = {}
+  if args.baseline:
+    with open(args.baseline) as stream:
+      baseline = json.load(stream).get('results', {})
+
+  env = Environment(args)
+  results = []
+  try:
+    for name, setup, run in scenarios(env):
+      if args.only and not any(only in name for only in args.only):
+        continue
+      try:
+        results.append((name, measure(env, setup, run, args.iterations)))
+      except Exception as e:
+        results.append((name, {'error': '%s: %s' % (type(e).__name__, e)}))
+  finally:
+    env.cleanup()
+
+  print('releases: %s, manifest size: %s bytes, values: %s, repos: %s, '
+        'iterations: %s\n' % (args.releases, args.manifest_size, args.values,
+                              args.repos, args.iterations))
+  report(results, baseline)
+  if args.output:
+    with open(args.output, 'w') as stream:
+      json.dump({
+        'parameters': {
+          'releases': args.releases,
+          'manifest_size': args.manifest_size,
+          'values': args.values,
+          'repos': args.repos,
+          'iterations': args.iterations,
+        },
+        'results': dict(results),
+      }, stream, indent=2, sort_keys=True)
+  return 1 if any('error' in result for _, result in results) else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+'''
+A stand-in for the helm 2 client used by the benchmarks. It answers the
+commands run by the helm execution module with realistic output generated at
+a configurable size, without a Kubernetes cluster or Tiller:
+
+  FAKE_HELM_RELEASES        the number of installed releases (default 10)
+  FAKE_HELM_MANIFEST_SIZE   the approximate size in bytes of each release's
+                            manifest (default 1024)
+  FAKE_HELM_VALUES          the number of values set on each release
+                            (default 20)
+
+Repositories are read from and written to the repositories.yaml of the helm
+home (`--home` or $HELM_HOME), as the real client does.
+'''
+import os
+import sys
+
+import yaml
+
+RELEASES = int(os.environ.get('FAKE_HELM_RELEASES', 10))
+MANIFEST_SIZE = int(os.environ.get('FAKE_HELM_MANIFEST_SIZE', 1024))
+VALUES = int(os.environ.get('FAKE_HELM_VALUES', 20))
+
+UPDATED = 'Mon Jan  1 00:00:00 2018'
+
+def release_name(index):
+  return 'release-%05d' % index
+
+def release_index(name):
+  if not name.startswith('release-') or not name[8:].isdigit():
+    return None
+  index = int(name[8:])
+  return index if index < RELEASES else None
+
+def values(index):
+  return dict(('key%03d' % i, 'value-%s-%s' % (index, i))
+              for i in range(VALUES))
+
+def manifest(index):
+  '''
+  Generate a manifest of ConfigMaps, each with up to 100 entries, adding up to
+  roughly MANIFEST_SIZE bytes
+  '''
+  documents = []
+  size = 0
+  resource = 0
+  while size < MANIFEST_SIZE or not documents:
+    entries = max(1, min(100, (MANIFEST_SIZE - size) // 80))
+    document = ''.join(
+      ['---\n# Source: chart/templates/configmap.yaml\n',
+       'apiVersion: v1\nkind: ConfigMap\nmetadata:\n',
+       '  name: %s-%s\ndata:\n' % (release_name(index), resource)] +
+      ['  entry%03d: %s\n' % (i, 'x' * 64) for i in range(entries)])
+    documents.append(document)
+    size += len(document)
+    resource += 1
+  return ''.join(documents)
+
+def release_output(index):
+  user_values = values(index)
+  computed = dict(user_values, replicaCount=1, image='chart:1.0.0')
+  return '\n'.join([
+    'REVISION: %s' % (index % 7 + 1),
+    'RELEASED: %s' % UPDATED,
+    'CHART: chart-1.0.0',
+    'USER-SUPPLIED VALUES:',
+    yaml.dump(user_values, default_flow_style=False),
+    'COMPUTED VALUES:',
+    yaml.dump(computed, default_flow_style=False),
+    'HOOKS:',
+    'MANIFEST:',
+    '',
+    manifest(index),
+  ])
+
+def option(args, name, default=None):
+  if name in args:
+    position = args.index(name)
+    value = args[position + 1]
+    del args[position:position + 2]
+    return value
+  return default
+
+def flag(args, name):
+  if name in args:
+    args.remove(name)
+    return True
+  return False
+
+def repositories_file(home):
+  return os.path.join(home, 'repository', 'repositories.yaml')
+
+def read_repositories(home):
+  try:
+    with open(repositories_file(home)) as stream:
+      return yaml.safe_load(stream) or {}
+  except IOError:
+    return {}
+
+def write_repositories(home, repositories):
+  path = repositories_file(home)
+  if not os.path.isdir(os.path.dirname(path)):
+    os.makedirs(os.path.dirname(path))
+  with open(path, 'w') as stream:
+    yaml.safe_dump(repositories, stream, default_flow_style=False)
+
+def fail(message):
+  sys.stderr.write('Error: %s\n' % message)
+  return 1
+
+def main(args):
+  home = (option(args, '--home') or os.environ.get('HELM_HOME') or
+          os.path.expanduser('~/.helm'))
+  option(args, '--host')
+  option(args, '--tiller-namespace')
+  if not args:
+    return fail('no command supplied')
+
+  command = args.pop(0)
+  if command == 'version':
+    print('Client: &version.Version{SemVer:"v2.6.2", GitCommit:"", '
+          'GitTreeState:"clean"}')
+    if not flag(args, '--client'):
+      print('Server: &version.Version{SemVer:"v2.6.2", GitCommit:"", '
+            'GitTreeState:"clean"}')
+    return 0
+
+  if command == 'list':
+    flag(args, '--all')
+    limit = int(option(args, '--max', 256))
+    offset = option(args, '--offset')
+    start = release_index(offset) if offset else 0
+    if start is None:
+      return 0
+    end = min(start + limit, RELEASES)
+    if end < RELEASES:
+      print('\tnext: %s' % release_name(end))
+    print('NAME\tREVISION\tUPDATED\tSTATUS\tCHART\tNAMESPACE')
+    for index in range(start, end):
+      print('%s\t%s\t%s\tDEPLOYED\tchart-1.0.0\tdefault' % (
+        release_name(index), index % 7 + 1, UPDATED))
+    return 0
+
+  if command == 'get':
+    subcommand = args[0] if args and args[0] in ('values', 'manifest') else None
+    if subcommand:
+      args.pop(0)
+    computed = flag(args, '--all')
+    index = release_index(args[0]) if args else None
+    if index is None:
+      return fail('release: "%s" not found' % (args[0] if args else ''))
+    if subcommand == 'values':
+      output = values(index)
+      if computed:
+        output = dict(output, replicaCount=1, image='chart:1.0.0')
+      sys.stdout.write(yaml.dump(output, default_flow_style=False))
+    elif subcommand == 'manifest':
+      sys.stdout.write(manifest(index))
+    else:
+      sys.stdout.write(release_output(index))
+    return 0
+
+  if command in ('install', 'upgrade'):
+    name = option(args, '--name') or (args[0] if args else '')
+    index = release_index(name)
+    if flag(args, '--dry-run'):
+      sys.stdout.write(release_output(index or 0))
+      return 0
+    print('Release "%s" has been %s. Happy Helming!' % (
+      name, 'upgraded' if command == 'upgrade' else 'installed'))
+    return 0
+
+  if command == 'delete':
+    print('release "%s" deleted' % args[-1])
+    return 0
+
+  if command == 'repo':
+    subcommand = args.pop(0) if args else None
+    repositories = read_repositories(home)
+    repos = repositories.setdefault('repositories', []) or []
+    if subcommand == 'list':
+      print('NAME\tURL')
+      for repo in repos:
+        print('%s\t%s' % (repo['name'], repo['url']))
+      return 0
+    if subcommand == 'add':
+      name, url = args[0], args[1]
+      repositories['repositories'] = [repo for repo in repos
+                                      if repo['name'] != name] + [{
+        'name': name, 'url': url, 'cache': '%s-index.yaml' % name,
+        'caFile': '', 'certFile': '', 'keyFile': ''}]
+      write_repositories(home, repositories)
+      print('"%s" has been added to your repositories' % name)
+      return 0
+    if subcommand == 'remove':
+      if not any(repo['name'] == args[0] for repo in repos):
+        return fail('no repo named "%s" found' % args[0])
+      repositories['repositories'] = [repo for repo in repos
+                                      if repo['name'] != args[0]]
+      write_repositories(home, repositories)
+      print('"%s" has been removed from your repositories' % args[0])
+      return 0
+    if subcommand == 'update':
+      print('Hang tight while we grab the latest from your chart '
+            'repositories...')
+      for repo in repos:
+        print('...Successfully got an update from the "%s" chart repository' %
+              repo['name'])
+      print('Update Complete. Happy Helming!')
+      return 0
+
+  if command == 'fetch':
+    destination = option(args, '--destination') or '.'
+    version = option(args, '--version') or '1.0.0'
+    archive = os.path.join(destination, '%s-%s.tgz' % (
+      args[0].split('/')[-1], version))
+    with open(archive, 'wb') as stream:
+      stream.write(b'')
+    return 0
+
+  if command in ('dependency', 'package', 'lint'):
+    return 0
+
+  return fail('unknown command "%s"' % command)
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -130,6 +130,11 @@ run() {
     done
 }
 
+unit() {
+    [ -e ${VENV_DIR}/bin/activate ] && source ${VENV_DIR}/bin/activate
+    python -m unittest discover -s ${CURDIR}/unit -p 'test_*.py'
+}
+
 _atexit() {
     RETVAL=$?
     trap true INT TERM EXIT
@@ -155,8 +160,12 @@ case $1 in
     run)
         run
         ;;
+    unit)
+        unit
+        ;;
     *)
         prepare
+        unit
         run
         ;;
 esac
@@ -0,0 +1,28 @@
+'''
+Helpers shared by the unit tests: the execution and state modules are loaded
+outside of Salt, with just the loader globals each test needs.
+'''
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+  os.path.abspath(__file__))))
+
+def load_module(name, path, **globals_):
+  '''
+  Load the module at the supplied path (relative to the formula root) under
+  a private name, setting the supplied loader globals (`__salt__`,
+  `__context__`, `__opts__`, ...) on it.
+  '''
+  try:
+    import importlib.util
+  except ImportError:
+    import imp
+    module = imp.load_source('unit_%s' % name, os.path.join(ROOT, path))
+  else:
+    spec = importlib.util.spec_from_file_location('unit_%s' % name,
+                                                  os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+  for key, value in globals_.items():
+    setattr(module, key, value)
+  return module
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import yaml
+
+from common import load_module
+
+helm = load_module('helm', '_modules/helm.py', __context__={}, __opts__={},
+                   __salt__={'config.get': lambda key, default=None:
+                             default})
+
+class FetchChartArchiveTest(unittest.TestCase):
+  '''
+  Fetch `mysql` 1.0.0 from two repositories whose archives differ, with a
+  `helm fetch` that writes `<repo>:<chart>` into the archive.
+  '''
+
+  def setUp(self):
+    helm.__context__ = {}
+    self.home = tempfile.mkdtemp()
+    self.fetched = []
+    self.cmd_and_result = helm._cmd_and_result
+    helm._cmd_and_result = self.fake_fetch
+
+    cache = os.path.join(self.home, 'repository', 'cache')
+    os.makedirs(cache)
+    repositories = []
+    for repo in ('stable', 'other'):
+      digest = hashlib.sha256(self.content(repo + '/mysql')).hexdigest()
+      with open(os.path.join(cache, '%s-index.yaml' % repo), 'w') as stream:
+        yaml.safe_dump({'apiVersion': 'v1', 'entries': {'mysql': [
+          {'name': 'mysql', 'version': '1.0.0', 'digest': digest},
+        ]}}, stream)
+      repositories.append({'name': repo, 'url': 'http://%s' % repo,
+                           'cache': '%s-index.yaml' % repo})
+    with open(os.path.join(self.home, 'repository', 'repositories.yaml'),
+              'w') as stream:
+      yaml.safe_dump({'repositories': repositories}, stream)
+
+  def tearDown(self):
+    helm._cmd_and_result = self.cmd_and_result
+    shutil.rmtree(self.home)
+
+  @staticmethod
+  def content(chart_name):
+    return chart_name.encode('utf-8')
+
+  def fake_fetch(self, command, chart_name, *args, **kwargs):
+    self.assertEqual(command, 'fetch')
+    self.fetched.append(chart_name)
+    destination = args[list(args).index('--destination') + 1]
+    archive = os.path.join(destination, '%s-1.0.0.tgz' %
+                           chart_name.split('/')[-1])
+    with open(archive, 'wb') as stream:
+      stream.write(self.content(chart_name))
+    return {'stdout': '', 'stderr': ''}
+
+  def fetch(self, chart_name):
+    archive = helm._fetch_chart_archive(chart_name, '1.0.0',
+                                        helm_home=self.home)
+    with open(archive, 'rb') as stream:
+      return stream.read()
+
+  def test_repositories_do_not_share_archives(self):
+    self.assertEqual(self.fetch('stable/mysql'), b'stable/mysql')
+    self.assertEqual(self.fetch('other/mysql'), b'other/mysql')
+    self.assertEqual(self.fetch('stable/mysql'), b'stable/mysql')
+    self.assertEqual(self.fetched, ['stable/mysql', 'other/mysql'])
+
+  def test_refetches_archives_not_matching_the_index(self):
+    self.fetch('stable/mysql')
+    archive = os.path.join(self.home, 'cache', 'archive', 'stable',
+                           'mysql-1.0.0.tgz')
+    with open(archive, 'wb') as stream:
+      stream.write(b'truncated')
+    self.assertEqual(self.fetch('stable/mysql'), b'stable/mysql')
+    self.assertEqual(self.fetched, ['stable/mysql', 'stable/mysql'])
+
+class IsLocalChartTest(unittest.TestCase):
+
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.root = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.root, 'charts', 'foo'))
+    os.chdir(self.root)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.root)
+
+  def test_existing_relative_path_is_local(self):
+    self.assertTrue(helm._is_local_chart('charts/foo'))
+
+  def test_repository_chart_is_not_local(self):
+    self.assertFalse(helm._is_local_chart('stable/mysql'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,221 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from multiprocessing.pool import ThreadPool
+
+try:
+  import contextvars
+except ImportError:
+  contextvars = None
+
+from common import load_module
+
+helm = load_module('helm', '_modules/helm.py', __context__={}, __opts__={},
+                   __salt__={'config.get': lambda key, default=None:
+                             default})
+
+# `helm list --all --max 2` from helm 2: the paging marker comes first,
+# indented by a tab, and the table's cells are padded and tab separated
+LIST_OUTPUT = (
+  "\tnext: release-00002\n"
+  "NAME         \tREVISION\tUPDATED                 \tSTATUS  \t"
+  "CHART        \tNAMESPACE\n"
+  "release-00000\t1       \tMon Oct 16 10:12:01 2017\tDEPLOYED\t"
+  "chart-1.0.0  \tdefault  \n"
+  "release-00001\t3       \tMon Oct 16 10:14:27 2017\tFAILED  \t"
+  "nginx-ingress-0.8.2\tkube-system\n"
+)
+
+class ParseReleaseListTest(unittest.TestCase):
+
+  def test_parses_rows(self):
+    releases, _ = helm._parse_release_list(LIST_OUTPUT)
+    self.assertEqual(sorted(releases), ['release-00000', 'release-00001'])
+    self.assertEqual(releases['release-00001'], {
+      'name': 'release-00001',
+      'revision': 3,
+      'status': 'FAILED',
+      'updated': 'Mon Oct 16 10:14:27 2017',
+      'chart': 'nginx-ingress',
+      'version': '0.8.2',
+      'namespace': 'kube-system',
+    })
+
+  def test_detects_next_marker(self):
+    _, next_release = helm._parse_release_list(LIST_OUTPUT)
+    self.assertEqual(next_release, 'release-00002')
+
+  def test_last_page_has_no_marker(self):
+    output = LIST_OUTPUT.split("\n", 1)[1]
+    releases, next_release = helm._parse_release_list(output)
+    self.assertEqual(len(releases), 2)
+    self.assertIsNone(next_release)
+
+# `helm upgrade --dry-run --debug` output: `helm get`'s fields and sections,
+# followed by the upgrade's own status line
+RELEASE_OUTPUT = """REVISION: 4
+RELEASED: Mon Oct 16 10:14:27 2017
+CHART: nginx-ingress-0.8.2
+USER-SUPPLIED VALUES:
+replicaCount: 2
+
+COMPUTED VALUES:
+image: nginx:1.13
+replicaCount: 2
+
+HOOKS:
+MANIFEST:
+
+---
+# Source: nginx-ingress/templates/service.yaml
+apiVersion: v1
+kind: Service
+metadata:
+  name: web
+  namespace: default
+spec:
+  ports: [{port: 80}]
+---
+# Source: nginx-ingress/templates/configmap.yaml
+apiVersion: v1
+kind: ConfigMap
+metadata:
+  name: web
+data:
+  note: "USER-SUPPLIED VALUES:"
+Release "web" has been upgraded. Happy Helming!
+"""
+
+class ReleaseSectionsTest(unittest.TestCase):
+
+  def test_splits_fields_and_sections(self):
+    sections = helm._ReleaseSections(RELEASE_OUTPUT.split('\n'))
+    self.assertEqual(sections.fields['REVISION'], '4')
+    self.assertEqual(sections.fields['CHART'], 'nginx-ingress-0.8.2')
+    self.assertEqual(sections.deserialize('USER-SUPPLIED VALUES'),
+                     {'replicaCount': 2})
+    self.assertEqual(sections.deserialize('COMPUTED VALUES'),
+                     {'image': 'nginx:1.13', 'replicaCount': 2})
+    self.assertIsNone(sections.text('HOOKS'))
+
+  def test_manifest_runs_to_the_upgrade_status(self):
+    manifest = helm._ReleaseSections(RELEASE_OUTPUT.split('\n')).text(
+      'MANIFEST')
+    self.assertTrue(manifest.startswith('---'))
+    self.assertIn('note: "USER-SUPPLIED VALUES:"', manifest)
+    self.assertNotIn('Happy Helming', manifest)
+
+  def test_skips_sections_not_kept(self):
+    sections = helm._ReleaseSections(RELEASE_OUTPUT.split('\n'),
+                                     keep=['USER-SUPPLIED VALUES'])
+    self.assertIn('MANIFEST', sections)
+    self.assertIsNone(sections.text('MANIFEST'))
+    self.assertEqual(sections.deserialize('USER-SUPPLIED VALUES'),
+                     {'replicaCount': 2})
+
+class ManifestIndexTest(unittest.TestCase):
+
+  def manifest(self):
+    return helm._parse_release(RELEASE_OUTPUT, ['manifest'])['manifest']
+
+  def test_indexes_resources_by_key(self):
+    index = helm._manifest_index(self.manifest())
+    self.assertEqual(sorted(index), ['v1:ConfigMap::web',
+                                     'v1:Service:default:web'])
+
+  def test_hashes_resources_canonically(self):
+    reordered = self.manifest().replace(
+      'apiVersion: v1\nkind: Service', 'kind: Service\napiVersion: v1')
+    self.assertEqual(helm._manifest_index(reordered),
+                     helm._manifest_index(self.manifest()))
+    changed = self.manifest().replace('port: 80', 'port: 8080')
+    self.assertNotEqual(
+      helm._manifest_index(changed)['v1:Service:default:web'],
+      helm._manifest_index(self.manifest())['v1:Service:default:web'])
+
+  def test_streamed_lines_index_the_same(self):
+    lines = [line + '\n' for line in self.manifest().split('\n')]
+    self.assertEqual(helm._manifest_index(iter(lines)),
+                     helm._manifest_index(self.manifest()))
+
+class ReleaseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    helm.__context__ = {}
+    self.home = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.home)
+
+  def test_cached_values_are_private(self):
+    helm._write_cached_release('secret', {'revision': 1},
+                               {'values': {'password': 'hunter2'}},
+                               helm_home=self.home)
+    path = helm._release_cache_file('secret', helm_home=self.home)
+    self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+    self.assertEqual(
+      helm._read_cached_release('secret', {'revision': 1},
+                                helm_home=self.home),
+      {'values': {'password': 'hunter2'}})
+
+class CheckReleaseTest(unittest.TestCase):
+
+  def name_problems(self, name, namespace='default'):
+    release = {'name': name, 'namespace': namespace, 'chart': 'stable/chart'}
+    problems = helm._check_release(name, release, {name: release}, {})
+    return [problem for problem in problems
+            if problem.startswith(('release name', 'namespace'))]
+
+  def test_accepts_names_tiller_accepts(self):
+    for name in ('zoo1', 'my.release', 'My_Release-2', 'a' * 53):
+      self.assertEqual(self.name_problems(name), [], name)
+
+  def test_rejects_invalid_names(self):
+    for name in ('-zoo', 'zoo.', 'zoo/1', 'a' * 54):
+      self.assertEqual(len(self.name_problems(name)), 1, name)
+
+  def test_namespace_must_be_a_dns_label(self):
+    self.assertEqual(len(self.name_problems('zoo', 'my.namespace')), 1)
+
+  def test_names_must_be_strings(self):
+    problems = self.name_problems(1234, 5678)
+    self.assertEqual(problems, [
+      'release name 1234 must be a string, not int',
+      'namespace 5678 must be a string, not int'])
+
+  def test_numeric_release_ids_are_reported(self):
+    home = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, home)
+    os.makedirs(os.path.join(home, 'repository'))
+    with open(os.path.join(home, 'repository', 'repositories.yaml'),
+              'w') as stream:
+      stream.write('repositories: []\n')
+    result = helm.validate_releases({
+      1234: {'chart': './missing'},
+      'web': {'chart': './missing'},
+    }, helm_home=home)
+    self.assertFalse(result['valid'])
+    self.assertIn('release name 1234 must be a string, not int',
+                  result['problems'][1234])
+
+@unittest.skipIf(contextvars is None, 'contextvars is not available')
+class InContextTest(unittest.TestCase):
+
+  def test_pool_workers_see_the_callers_context(self):
+    var = contextvars.ContextVar('loader')
+    token = var.set('caller')
+    try:
+      read = helm.in_context(lambda _: var.get(None))
+    finally:
+      var.reset(token)
+    pool = ThreadPool(2)
+    try:
+      self.assertEqual(pool.map(read, range(4)), ['caller'] * 4)
+    finally:
+      pool.close()
+      pool.join()
+
+if __name__ == '__main__':
+  unittest.main()
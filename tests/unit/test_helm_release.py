@@ -0,0 +1,376 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import yaml
+
+from common import load_module
+
+class FakeTiller(object):
+  '''
+  The `helm.*` execution functions the release states call, answering from
+  an in-memory set of releases and recording every call made.
+  '''
+  def __init__(self):
+    self.module = load_module('helm', '_modules/helm.py')
+    self.releases = {}
+    self.resources = {}
+    self.rendered = {}
+    self.calls = []
+    self.fail = set()
+
+  def salt(self):
+    return {
+      'helm.stats': lambda since=0, fire_event=False, label=None: {
+        'position': 0},
+      'helm.in_context': self.module.in_context,
+      'helm.list_releases': self.list_releases,
+      'helm.get_release': self.get_release,
+      'helm.release_exists': self.release_exists,
+      'helm.release_create': self.release_create,
+      'helm.release_upgrade': self.release_upgrade,
+      'helm.release_delete': self.release_delete,
+      'helm.release_resources': self.release_resources,
+      'cmd.which': lambda command: '/usr/bin/%s' % command,
+      'config.get': lambda key, default=None: default,
+    }
+
+  def names(self, function):
+    return [args[0] for (called, args) in self.calls if called == function]
+
+  def deploy(self, name, chart='chart', version='1.0.0', namespace='default',
+             values=None, revision=1):
+    self.releases[name] = {'chart': chart, 'version': version,
+                           'namespace': namespace, 'values': values,
+                           'revision': revision}
+
+  def list_releases(self, **kwargs):
+    self.calls.append(('list_releases', ()))
+    return dict((name, {'name': name, 'revision': release['revision']})
+                for (name, release) in self.releases.items())
+
+  def get_release(self, name, fields=None, **kwargs):
+    self.calls.append(('get_release', (name,)))
+    release = self.releases.get(name)
+    return dict(release) if release else None
+
+  def release_exists(self, name, **kwargs):
+    self.calls.append(('release_exists', (name,)))
+    return name in self.releases
+
+  def _apply(self, command, name, chart_name, namespace, version,
+             values_file):
+    self.calls.append((command, (name,)))
+    if name in self.fail:
+      raise self.module.HelmExecutionError('helm %s %s' % (command, name),
+                                           'failed')
+    values = None
+    if values_file:
+      with open(values_file) as stream:
+        values = yaml.safe_load(stream)
+    previous = self.releases.get(name, {'revision': 0})
+    self.deploy(name, chart_name.split('/')[-1], version, namespace, values,
+                previous['revision'] + 1)
+    return {'cmd': 'helm %s %s' % (command, name), 'stdout': ''}
+
+  def release_create(self, name, chart_name, namespace='default',
+                     version=None, values_file=None, **kwargs):
+    return self._apply('release_create', name, chart_name, namespace,
+                       version, values_file)
+
+  def release_upgrade(self, name, chart_name, namespace='default',
+                      version=None, values_file=None, dry_run=False,
+                      **kwargs):
+    if dry_run:
+      self.calls.append(('release_upgrade_dry_run', (name,)))
+      return {'resources': dict(self.rendered)}
+    return self._apply('release_upgrade', name, chart_name, namespace,
+                       version, values_file)
+
+  def release_delete(self, name, **kwargs):
+    self.calls.append(('release_delete', (name,)))
+    del self.releases[name]
+    return {'cmd': 'helm delete --purge %s' % name, 'stdout': ''}
+
+  def release_resources(self, name, **kwargs):
+    self.calls.append(('release_resources', (name,)))
+    return dict(self.resources)
+
+class StateTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.cachedir = tempfile.mkdtemp()
+    self.tiller = FakeTiller()
+    self.state = load_module('helm_release', '_states/helm_release.py',
+                             __salt__=self.tiller.salt(), __context__={},
+                             __opts__={'test': False,
+                                       'cachedir': self.cachedir})
+
+  def tearDown(self):
+    shutil.rmtree(self.cachedir)
+
+  def present(self, name='web', **kwargs):
+    kwargs.setdefault('version', '1.0.0')
+    self.tiller.calls = []
+    return self.state.present(name, 'stable/chart', 'default', **kwargs)
+
+  def record(self, name='web', **kwargs):
+    kwargs.setdefault('tiller_namespace', 'kube-system')
+    return self.state._read_release_record(name, **kwargs)
+
+class DiffManifestsTest(StateTestCase):
+
+  def setUp(self):
+    super(DiffManifestsTest, self).setUp()
+    self.tiller.deploy('web', values={'replicaCount': 2})
+    self.tiller.resources = {'v1:Service:default:web': 'a'}
+    self.tiller.rendered = dict(self.tiller.resources)
+
+  def test_unchanged_render_is_recorded(self):
+    values = {'replicaCount': 2, 'unused': True}
+    ret = self.present(values=values, diff_manifests=True)
+    self.assertTrue(ret['result'])
+    self.assertEqual(ret['changes'], {})
+    self.assertIn('skipped upgrade', ret['comment'])
+    self.assertEqual(self.record()['revision'], 1)
+
+    ret = self.present(values=values, diff_manifests=True)
+    self.assertEqual(ret['changes'], {})
+    self.assertEqual(self.tiller.names('get_release'), [])
+    self.assertEqual(self.tiller.names('release_upgrade_dry_run'), [])
+
+  def test_changed_render_is_upgraded(self):
+    self.tiller.rendered = {'v1:Service:default:web': 'b'}
+    ret = self.present(values={'replicaCount': 3}, diff_manifests=True)
+    self.assertEqual(ret['changes']['resources'],
+                     {'changed': ['v1:Service:default:web']})
+    self.assertEqual(self.tiller.names('release_upgrade'), ['web'])
+    self.assertEqual(self.tiller.releases['web']['revision'], 2)
+
+class ReleaseHashTest(StateTestCase):
+
+  def setUp(self):
+    super(ReleaseHashTest, self).setUp()
+    self.tiller.deploy('web', values={'replicaCount': 2})
+    self.diffs = []
+    get_yaml_diff = self.state._get_yaml_diff
+    def recorded_diff(*args):
+      self.diffs.append(args)
+      return get_yaml_diff(*args)
+    self.state._get_yaml_diff = recorded_diff
+
+  def test_matching_hash_skips_the_diff(self):
+    ret = self.present(values={'replicaCount': 2})
+    self.assertEqual(ret['changes'], {})
+    self.assertEqual(self.diffs, [])
+    self.assertEqual(self.tiller.names('release_upgrade'), [])
+
+  def test_mismatched_hash_computes_the_diff(self):
+    ret = self.present(values={'replicaCount': 3})
+    self.assertEqual(len(self.diffs), 1)
+    self.assertIn('+replicaCount: 3', ret['changes']['values'])
+    self.assertEqual(self.tiller.names('release_upgrade'), ['web'])
+
+  def test_record_is_kept_in_the_minion_cache(self):
+    self.present(values={'replicaCount': 2})
+    path = self.state._release_record_path('web',
+                                           tiller_namespace='kube-system')
+    self.assertTrue(path.startswith(
+      os.path.join(self.cachedir, 'helm', 'releases') + os.sep))
+    self.assertTrue(os.path.exists(path))
+    self.assertEqual(self.record()['revision'], 1)
+
+  def test_record_skips_retrieving_unmodified_releases(self):
+    self.present(values={'replicaCount': 2})
+    ret = self.present(values={'replicaCount': 2})
+    self.assertEqual(ret['changes'], {})
+    self.assertEqual(self.tiller.names('get_release'), [])
+
+  def test_applied_release_is_confirmed_at_its_new_revision(self):
+    self.present(values={'replicaCount': 3})
+    self.assertIsNone(self.record()['revision'])
+    self.present(values={'replicaCount': 3})
+    self.assertEqual(self.tiller.names('get_release'), ['web'])
+    self.assertEqual(self.record()['revision'], 2)
+
+  def test_modified_release_is_retrieved_again(self):
+    self.present(values={'replicaCount': 2})
+    self.tiller.deploy('web', values={'replicaCount': 5}, revision=2)
+    ret = self.present(values={'replicaCount': 2})
+    self.assertEqual(self.tiller.names('get_release'), ['web'])
+    self.assertEqual(self.tiller.names('release_upgrade'), ['web'])
+    self.assertIn('-replicaCount: 5', ret['changes']['values'])
+
+class DriftCheckTest(StateTestCase):
+
+  def setUp(self):
+    super(DriftCheckTest, self).setUp()
+    self.tiller.deploy('web', values={'replicaCount': 2})
+    self.kube_config = os.path.join(self.cachedir, 'kubeconfig')
+    self.write_kube_config('cluster-a')
+    self.present(values={'replicaCount': 2}, drift_check_interval=600,
+                 kube_config=self.kube_config)
+
+  def write_kube_config(self, cluster):
+    with open(self.kube_config, 'w') as stream:
+      stream.write('current-context: %s\n' % cluster)
+
+  def age_record(self, seconds):
+    record = self.record(kube_config=self.kube_config)
+    record['checked'] -= seconds
+    self.state._write_release_record('web', record,
+                                     tiller_namespace='kube-system',
+                                     kube_config=self.kube_config)
+    return record['checked']
+
+  def check(self):
+    return self.present(values={'replicaCount': 2}, drift_check_interval=600,
+                        kube_config=self.kube_config)
+
+  def test_skips_tiller_within_the_interval(self):
+    ret = self.check()
+    self.assertEqual(ret['changes'], {})
+    self.assertIn('next drift check in', ret['comment'])
+    self.assertEqual(self.tiller.calls, [])
+
+  def test_checks_tiller_after_the_interval(self):
+    checked = self.age_record(601)
+    ret = self.check()
+    self.assertEqual(ret['changes'], {})
+    self.assertEqual([call for (call, _) in self.tiller.calls],
+                     ['list_releases'])
+    # the unchanged revision restarts the interval
+    self.assertGreater(self.record(kube_config=self.kube_config)['checked'],
+                       checked)
+    self.assertEqual(self.check()['changes'], {})
+    self.assertEqual(self.tiller.calls, [])
+
+  def test_kube_config_change_invalidates_the_fingerprint(self):
+    self.write_kube_config('cluster-b')
+    ret = self.check()
+    self.assertNotIn('next drift check in', ret['comment'])
+    self.assertEqual(self.tiller.names('get_release'), ['web'])
+
+class ValuesFileTest(StateTestCase):
+
+  def values_files(self):
+    values_dir = os.path.join(self.cachedir, 'helm', 'values')
+    return sorted(os.listdir(values_dir)) if os.path.isdir(values_dir) else []
+
+  def test_same_values_reuse_one_private_file(self):
+    first = self.state._cached_values_file('web', {'password': 'hunter2'})
+    mtime = os.stat(first).st_mtime
+    second = self.state._cached_values_file('web', {'password': 'hunter2'})
+    self.assertEqual(first, second)
+    self.assertEqual(os.stat(second).st_mtime, mtime)
+    self.assertEqual(stat.S_IMODE(os.stat(second).st_mode), 0o600)
+    self.assertEqual(self.values_files(), [os.path.basename(first)])
+
+  def test_changed_values_replace_the_file(self):
+    first = self.state._cached_values_file('web', {'password': 'hunter2'})
+    second = self.state._cached_values_file('web', {'password': 'hunter3'})
+    self.assertNotEqual(first, second)
+    self.assertEqual(self.values_files(), [os.path.basename(second)])
+
+  def test_absent_removes_the_files(self):
+    self.present(values={'password': 'hunter2'})
+    self.state._cached_values_file('webapp', {'password': 'other'})
+    self.assertEqual(len(self.values_files()), 2)
+    ret = self.state.absent('web')
+    self.assertEqual(ret['changes']['web'], 'DELETED')
+    self.assertEqual([entry for entry in self.values_files()
+                      if entry.startswith('web-')], [])
+    self.assertEqual(len(self.values_files()), 1)
+
+class BatchPresentTest(StateTestCase):
+
+  def batch(self, releases, **kwargs):
+    for release_id, release in releases.items():
+      release.setdefault('chart', 'stable/chart')
+      release.setdefault('version', '1.0.0')
+    self.tiller.calls = []
+    return self.state.batch_present('releases', releases, **kwargs)
+
+  def test_dependencies_are_reconciled_first(self):
+    ret = self.batch({
+      'db': {},
+      'api': {'depends_on': 'db'},
+      'web': {'depends_on': ['api', 'db']},
+      'cache': {},
+    }, concurrency=4)
+    self.assertTrue(ret['result'])
+    created = self.tiller.names('release_create')
+    self.assertEqual(sorted(created), ['api', 'cache', 'db', 'web'])
+    self.assertLess(created.index('db'), created.index('api'))
+    self.assertLess(created.index('api'), created.index('web'))
+
+  def test_circular_dependencies_fail(self):
+    ret = self.batch({
+      'a': {'depends_on': 'b'},
+      'b': {'depends_on': 'a'},
+      'c': {},
+    })
+    self.assertFalse(ret['result'])
+    self.assertEqual(self.tiller.names('release_create'), ['c'])
+    for release_id in ('a', 'b'):
+      self.assertIn('circular dependencies',
+                    ret['changes'][release_id]['comment'])
+
+  def test_dependents_of_failed_releases_are_skipped(self):
+    self.tiller.fail.add('db')
+    ret = self.batch({
+      'db': {},
+      'api': {'depends_on': 'db'},
+      'web': {'depends_on': 'api'},
+      'cache': {},
+    })
+    self.assertFalse(ret['result'])
+    self.assertEqual(sorted(self.tiller.names('release_create')),
+                     ['cache', 'db'])
+    self.assertIn('dependencies failed: db',
+                  ret['changes']['api']['comment'])
+    self.assertIn('dependencies failed: api',
+                  ret['changes']['web']['comment'])
+    self.assertTrue(ret['changes']['cache']['result'])
+
+  def test_unknown_dependencies_fail(self):
+    ret = self.batch({'web': {'depends_on': 'missing'}})
+    self.assertFalse(ret['result'])
+    self.assertIn('unknown releases: missing',
+                  ret['changes']['web']['comment'])
+    self.assertEqual(self.tiller.names('release_create'), [])
+
+class ClustersPresentTest(StateTestCase):
+
+  def test_clusters_fall_back_to_the_main_settings(self):
+    reconciled = {}
+    def batch_present(cluster_id, releases, **kwargs):
+      reconciled[cluster_id] = kwargs
+      return {'name': cluster_id, 'result': True, 'changes': {},
+              'comment': ''}
+    self.state._batch_present = batch_present
+    self.state.__salt__['helm.prepare_home'] = lambda *args, **kwargs: None
+
+    ret = self.state.clusters_present('releases', {
+      'main': {},
+      'namespaced': {'tiller_namespace': 'tiller',
+                     'kube_config': '/srv/helm/namespaced.yaml'},
+      'hosted': {'tiller_host': '10.0.0.1:44134'},
+    }, {}, helm_home=self.cachedir, kube_config='/srv/helm/kubeconfig.yaml',
+      tiller_namespace='helm')
+    self.assertTrue(ret['result'])
+
+    settings = dict((cluster_id, (kwargs.get('kube_config'),
+                                  kwargs.get('tiller_namespace'),
+                                  kwargs.get('tiller_host')))
+                    for (cluster_id, kwargs) in reconciled.items())
+    self.assertEqual(settings, {
+      'main': ('/srv/helm/kubeconfig.yaml', 'helm', None),
+      'namespaced': ('/srv/helm/namespaced.yaml', 'tiller', None),
+      'hosted': ('/srv/helm/kubeconfig.yaml', None, '10.0.0.1:44134'),
+    })
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+try:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import yaml
+
+from common import load_module
+
+helm = load_module('helm', '_modules/helm.py', __context__={}, __opts__={},
+                   __salt__={'config.get': lambda key, default=None:
+                             default})
+
+INDEX = yaml.safe_dump({'apiVersion': 'v1', 'entries': {'chart': [
+  {'name': 'chart', 'version': '1.0.0', 'urls': ['chart-1.0.0.tgz']},
+]}}).encode('utf-8')
+
+class RepoHandler(BaseHTTPRequestHandler):
+  '''
+  Serve the repository's index.yaml with an ETag, answering conditional
+  requests for an unchanged index with a 304.
+  '''
+  def do_GET(self):
+    server = self.server
+    server.requests.append(dict(self.headers.items()))
+    etag = '"%s"' % len(server.body)
+    if self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.end_headers()
+      return
+    self.send_response(200)
+    self.send_header('ETag', etag)
+    self.send_header('Content-Length', '%s' % len(server.body))
+    self.end_headers()
+    self.wfile.write(server.body)
+
+  def log_message(self, *args):
+    pass
+
+class FetchRepoIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    helm.__context__ = {}
+    self.server = HTTPServer(('127.0.0.1', 0), RepoHandler)
+    self.server.body = INDEX
+    self.server.requests = []
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    self.home = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.home, 'repository', 'cache'))
+    self.cache_file = os.path.join(self.home, 'repository', 'cache',
+                                   'stable-index.yaml')
+    with open(os.path.join(self.home, 'repository', 'repositories.yaml'),
+              'w') as stream:
+      yaml.safe_dump({'apiVersion': 'v1', 'repositories': [{
+        'name': 'stable',
+        'url': 'http://127.0.0.1:%s/charts' % self.server.server_port,
+        'cache': self.cache_file,
+      }]}, stream)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.home)
+
+  def update(self, **kwargs):
+    return helm.update_repos(conditional=True, helm_home=self.home, **kwargs)
+
+  def test_downloads_then_revalidates(self):
+    result = self.update()
+    self.assertEqual(result['updated'], ['stable'])
+    with open(self.cache_file, 'rb') as stream:
+      self.assertEqual(stream.read(), INDEX)
+    with open(self.cache_file + '.meta') as stream:
+      self.assertEqual(json.load(stream)['etag'], '"%s"' % len(INDEX))
+
+    result = self.update()
+    self.assertEqual(result['updated'], [])
+    self.assertEqual(result['skipped'], ['stable'])
+    self.assertEqual(result['repos']['stable']['status'], 'not_modified')
+    self.assertEqual(self.server.requests[-1].get('If-None-Match'),
+                     '"%s"' % len(INDEX))
+    self.assertEqual(len(self.server.requests), 2)
+
+  def test_fresh_within_ttl(self):
+    self.update()
+    result = self.update(ttl=3600)
+    self.assertEqual(result['skipped'], ['stable'])
+    self.assertEqual(result['repos']['stable']['status'], 'fresh')
+    self.assertEqual(len(self.server.requests), 1)
+
+  def test_keeps_cache_when_body_is_not_an_index(self):
+    self.update()
+    self.server.body = b'<html><body>Service Unavailable</body></html>'
+    result = self.update()
+    self.assertEqual(result['failed'], ['stable'])
+    self.assertIn('not a chart repository index',
+                  result['repos']['stable']['error'])
+    with open(self.cache_file, 'rb') as stream:
+      self.assertEqual(stream.read(), INDEX)
+
+class ManageReposBatchTest(unittest.TestCase):
+
+  def setUp(self):
+    helm.__context__ = {}
+    self.home = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.home, 'repository', 'cache'))
+    with open(os.path.join(self.home, 'repository', 'repositories.yaml'),
+              'w') as stream:
+      yaml.safe_dump({'apiVersion': 'v1', 'repositories': [
+        {'name': name, 'url': 'http://%s.example.com' % name}
+        for name in ('stable', 'incubator', 'local')]}, stream)
+
+  def tearDown(self):
+    shutil.rmtree(self.home)
+
+  def test_exclusive_leaves_present_unchanged(self):
+    present = {'incubator': 'http://incubator.example.com'}
+    result = helm.manage_repos(present=present, exclusive=True, batch=True,
+                               helm_home=self.home)
+    self.assertEqual(present, {'incubator': 'http://incubator.example.com'})
+    self.assertEqual([repo['name'] for repo in result['removed']], ['local'])
+    self.assertEqual(result['already_present'], [
+      {'name': 'incubator', 'url': 'http://incubator.example.com'}])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,182 @@
+import unittest
+from concurrent import futures
+
+try:
+  import grpc
+except ImportError:
+  grpc = None
+
+from common import load_module
+
+tiller = load_module('tiller', '_modules/tiller.py', __context__={},
+                     __salt__={'config.get': lambda key, default=None:
+                               default})
+encode = tiller._encode_message
+decode = tiller._decode_message
+
+def release_message(name, revision, status='DEPLOYED', chart='chart',
+                    version='1.0.0', namespace='default', values='',
+                    manifest=''):
+  '''
+  Encode a hapi.release.Release message the way Tiller does.
+  '''
+  info = encode([
+    (1, encode([(1, tiller._STATUS_CODES.index(status))])),
+    (3, encode([(1, 1508148721)])),
+  ])
+  metadata = encode([(1, chart), (4, version)])
+  return encode([
+    (1, name),
+    (2, info),
+    (3, encode([(1, metadata)])),
+    (4, encode([(1, values)])),
+    (5, manifest),
+    (7, revision),
+    (8, namespace),
+  ])
+
+class FakeTiller(object):
+  '''
+  A minimal in-process Tiller ReleaseService: the releases it knows about
+  are (name, revision, status) tuples, and every request it receives is
+  recorded, decoded, along with its metadata.
+  '''
+  def __init__(self, releases):
+    self.releases = releases
+    self.requests = []
+    self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    self.server.add_generic_rpc_handlers((
+      grpc.method_handlers_generic_handler(
+        'hapi.services.tiller.ReleaseService', {
+          'ListReleases':
+            grpc.unary_stream_rpc_method_handler(self.list_releases),
+          'GetReleaseContent':
+            grpc.unary_unary_rpc_method_handler(self.get_release_content),
+          'GetVersion':
+            grpc.unary_unary_rpc_method_handler(self.get_version),
+        }),
+    ))
+    self.host = '127.0.0.1:%s' % self.server.add_insecure_port(
+      '127.0.0.1:0')
+    self.server.start()
+
+  def stop(self):
+    self.server.stop(None)
+
+  def _record(self, method, request, context):
+    self.requests.append((method, decode(request),
+                          dict(context.invocation_metadata())))
+
+  def list_releases(self, request, context):
+    self._record('ListReleases', request, context)
+    fields = decode(request)
+    limit = tiller._field(fields, 1)
+    offset = (tiller._field(fields, 2) or b'').decode('utf-8')
+    codes = fields.get(6, [])
+    matching = sorted(
+      release for release in self.releases
+      if tiller._STATUS_CODES.index(release[2]) in codes and
+      release[0] >= offset)
+    page, rest = matching[:limit], matching[limit:]
+    # Tiller streams a page as several messages, with the offset to page
+    # from in the last one
+    for index in range(0, len(page), 2):
+      response = [(1, len(page[index:index + 2]))]
+      if rest and index + 2 >= len(page):
+        response.append((2, rest[0][0]))
+      response += [(4, release_message(*release))
+                   for release in page[index:index + 2]]
+      yield encode(response)
+
+  def get_release_content(self, request, context):
+    self._record('GetReleaseContent', request, context)
+    name = tiller._string(decode(request), 1)
+    revisions = [release for release in self.releases if release[0] == name]
+    if not revisions:
+      context.abort(grpc.StatusCode.UNKNOWN,
+                    'getting deployed release "%s": release: "%s" not found'
+                    % (name, name))
+    name, revision, status = max(revisions, key=lambda release: release[1])
+    return encode([(1, release_message(
+      name, revision, status, chart='nginx-ingress', version='0.8.2',
+      namespace='kube-system', values='controller:\n  replicaCount: 2\n',
+      manifest='---\nkind: Service\n'))])
+
+  def get_version(self, request, context):
+    self._record('GetVersion', request, context)
+    return encode([(1, encode([(1, 'v2.6.2'), (2, 'abc123')]))])
+
+@unittest.skipIf(grpc is None, 'requires grpcio')
+class TillerTest(unittest.TestCase):
+
+  def setUp(self):
+    tiller.__context__ = {}
+    self.tiller = FakeTiller([
+      ('alpha', 1, 'SUPERSEDED'),
+      ('alpha', 2, 'DEPLOYED'),
+      ('bravo', 1, 'FAILED'),
+      ('charlie', 3, 'DELETED'),
+      ('delta', 1, 'PENDING_UPGRADE'),
+      ('echo', 7, 'DEPLOYED'),
+    ])
+
+  def tearDown(self):
+    self.tiller.stop()
+
+  def test_list_releases_request(self):
+    tiller.list_releases(tiller_host=self.tiller.host, page_size=10,
+                         tiller_version='2.6.2')
+    method, fields, metadata = self.tiller.requests[0]
+    self.assertEqual(method, 'ListReleases')
+    self.assertEqual(fields[1], [10])
+    self.assertNotIn(2, fields)
+    self.assertEqual(
+      sorted(tiller._STATUS_CODES[code] for code in fields[6]),
+      sorted(status for status in tiller._STATUS_CODES
+             if status != 'SUPERSEDED'))
+    self.assertEqual(metadata['x-helm-api-client'], 'v2.6.2')
+
+  def test_list_releases_pages(self):
+    releases = tiller.list_releases(tiller_host=self.tiller.host,
+                                    page_size=2)
+    self.assertEqual(sorted(releases),
+                     ['alpha', 'bravo', 'charlie', 'delta', 'echo'])
+    self.assertEqual(releases['echo'], {
+      'name': 'echo',
+      'revision': 7,
+      'status': 'DEPLOYED',
+      'updated': '1508148721',
+      'chart': 'chart',
+      'version': '1.0.0',
+      'namespace': 'default',
+    })
+    self.assertEqual(releases['alpha']['revision'], 2)
+    offsets = [tiller._string(fields, 2) for (method, fields, metadata)
+               in self.tiller.requests]
+    self.assertEqual(offsets, [None, 'charlie', 'echo'])
+
+  def test_get_release(self):
+    release = tiller.get_release('alpha', tiller_host=self.tiller.host)
+    method, fields, metadata = self.tiller.requests[0]
+    self.assertEqual(method, 'GetReleaseContent')
+    self.assertEqual(tiller._string(fields, 1), 'alpha')
+    self.assertEqual(release, {
+      'chart': 'nginx-ingress',
+      'version': '0.8.2',
+      'values': {'controller': {'replicaCount': 2}},
+      'manifest': '---\nkind: Service\n',
+      'namespace': 'kube-system',
+      'revision': 2,
+      'status': 'DEPLOYED',
+      'updated': '1508148721',
+    })
+
+  def test_get_missing_release(self):
+    self.assertIsNone(tiller.get_release('zulu',
+                                         tiller_host=self.tiller.host))
+
+  def test_version(self):
+    self.assertEqual(tiller.version(tiller_host=self.tiller.host), 'v2.6.2')
+
+if __name__ == '__main__':
+  unittest.main()